@@ -6,10 +6,18 @@ from __future__ import annotations
 import argparse
 import json
 import logging
+import os
+import queue
 import re
+import threading
+import time
+import traceback
+from collections import ChainMap
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import torch
 from openai import OpenAI
@@ -19,7 +27,7 @@ from transformers import AutoProcessor, BitsAndBytesConfig, Glm4vForConditionalG
 
 from qwen_vl_utils import process_vision_info
 
-from train_qlora import TrainingRunResult, parse_args as parse_train_args, run_training
+from train_qlora import TrainingRunResult, decode_image, parse_args as parse_train_args, run_training
 from rag.retriever import KnowledgeRetriever, RetrievalResult
 
 try:  # pragma: no cover - optional dependency provided by transformers
@@ -27,6 +35,11 @@ try:  # pragma: no cover - optional dependency provided by transformers
 except ImportError:  # pragma: no cover
     TemplateError = RuntimeError  # fallback type
 
+try:  # pragma: no cover - optional faster JSON backend
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 JUDGE_DIALOG_SYSTEM_PROMPT = (
     """Ты — требовательный, но реальный клиент, который переписывается с цифровым клоном эксперта. 
@@ -67,6 +80,14 @@ JUDGE_EVALUATION_SYSTEM_PROMPT = (
 """
 )
 
+JUDGE_BATCH_EVALUATION_INSTRUCTIONS = (
+    """Сейчас нужно оценить не одну, а несколько реплик клона из одного диалога. Оценивай каждую реплику так, как если бы диалог обрывался на ней: учитывай только историю до неё и её собственный контекст знаний.
+
+Ответ только чистый JSON, по одному элементу на каждую указанную реплику в том же порядке:
+{"evaluations": [{"turn": <номер реплики>, "score": <0-100>, "feedback": "..."}]}
+"""
+)
+
 PROMPT_COACH_SYSTEM_PROMPT = (
     """Ты — эксперт по prompt engineering. Твоя задача: анализировать системный промт диалогового клона и обновлять его так, чтобы стиль общения максимально совпадал с индивидуальностью оригинала (его речью, культурой, привычками, реакцией на просьбы клиента). 
 
@@ -128,13 +149,27 @@ class PromptOptimizationSummary:
     iterations: List[IterationResult]
 
 
+def json_loads(payload: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+@lru_cache(maxsize=16)
+def _load_train_config_cached(path_str: str, mtime_ns: int) -> Dict[str, Any]:
+    # mtime_ns входит в ключ кэша: правка файла сбрасывает закэшированную версию.
+    return json_loads(Path(path_str).read_bytes())
+
+
 def load_train_config(config_path: Path) -> Dict[str, Any]:
     if not config_path.exists():
         raise FileNotFoundError(f"Train config not found: {config_path}")
     try:
-        return json.loads(config_path.read_text(encoding="utf-8"))
+        config = _load_train_config_cached(str(config_path.resolve()), config_path.stat().st_mtime_ns)
     except json.JSONDecodeError as exc:  # pragma: no cover - runtime validation
         raise ValueError(f"Failed to parse JSON config {config_path}: {exc}") from exc
+    # Возвращаем копию, чтобы вызывающий код не портил закэшированный словарь.
+    return dict(config)
 
 
 def resolve_text_arg(direct: Optional[str], file_path: Optional[Path]) -> Optional[str]:
@@ -210,25 +245,25 @@ def format_retrieval_snippets(snippets: Sequence[RetrievalResult]) -> str:
     return "\n".join(lines)
 
 
-def config_to_cli_args(config: Dict[str, Any]) -> List[str]:
+def config_to_cli_args(config: Mapping[str, Any]) -> List[str]:
     args: List[str] = []
+    append = args.append
+    extend = args.extend
     for key, value in config.items():
-        if value is None:
+        if value is None or value is False:
             continue
-        flag = f"--{key.replace('_', '-')}"
-        if isinstance(value, bool):
-            if value:
-                args.append(flag)
+        if value is True:
+            append("--" + key.replace("_", "-"))
             continue
-        if isinstance(value, (list, tuple)):
-            if not value:
-                continue
-            args.append(flag)
-            args.extend(str(item) for item in value)
+        value_type = type(value)
+        if value_type is list or value_type is tuple:
+            if value:
+                append("--" + key.replace("_", "-"))
+                extend(map(str, value))
             continue
-        if isinstance(value, dict):
+        if value_type is dict:
             raise ValueError(f"Nested config is not supported for key '{key}'")
-        args.extend([flag, str(value)])
+        extend(("--" + key.replace("_", "-"), str(value)))
     return args
 
 
@@ -245,15 +280,21 @@ def infer_backend_from_model_id(model_id: str, explicit: Optional[str] = None) -
 
 def extract_image_refs_from_message(message: Dict[str, Any]) -> List[str]:
     refs: List[str] = []
+    seen: set[str] = set()
+
+    def _add(ref: str) -> None:
+        if ref not in seen:
+            seen.add(ref)
+            refs.append(ref)
 
     def _extend(value: Any) -> None:
         if isinstance(value, str) and value:
-            refs.append(value)
+            _add(value)
             return
         if isinstance(value, dict):
             candidate = value.get("image") or value.get("url") or value.get("path")
             if isinstance(candidate, str) and candidate:
-                refs.append(candidate)
+                _add(candidate)
             for key in ("images", "media", "attachments", "value"):
                 if key in value:
                     _extend(value[key])
@@ -272,13 +313,7 @@ def extract_image_refs_from_message(message: Dict[str, Any]) -> List[str]:
             if key in metadata:
                 _extend(metadata[key])
 
-    seen: set[str] = set()
-    result: List[str] = []
-    for ref in refs:
-        if ref not in seen:
-            seen.add(ref)
-            result.append(ref)
-    return result
+    return refs
 
 
 def load_image_from_ref(ref: Optional[str]) -> Optional[Image.Image]:
@@ -289,18 +324,30 @@ def load_image_from_ref(ref: Optional[str]) -> Optional[Image.Image]:
         return None
     if ref.startswith("file://"):
         ref = ref[7:]
-    path = Path(ref)
-    if not path.exists():
+    # Одни и те же картинки приходят в каждом ходе диалога: decode_image из train_qlora держит
+    # LRU по (path, mtime), ограниченный по пикселям, и отдаёт копии — процессоры судьи
+    # и клона могут менять картинку на месте. Файл при попадании в кэш не читается.
+    try:
+        return decode_image(ref, os.stat(ref).st_mtime_ns)
+    except FileNotFoundError:
         logging.warning("Изображение %s не найдено.", ref)
         return None
-    try:
-        with Image.open(path) as img:
-            return img.convert("RGB")
     except Exception as exc:
         logging.warning("Не удалось загрузить изображение %s: %s", ref, exc)
         return None
 
 
+def attach_decoded_images(messages: Sequence[Dict[str, Any]]) -> None:
+    """Replaces image refs in VL messages with cached decoded images (in place)."""
+    for message in messages:
+        for block in message.get("content") or ():
+            if block.get("type") != "image" or not isinstance(block.get("image"), str):
+                continue
+            image = load_image_from_ref(block["image"])
+            if image is not None:
+                block["image"] = image
+
+
 def to_multimodal_blocks(content: Any) -> List[Dict[str, Any]]:
     blocks: List[Dict[str, Any]] = []
 
@@ -363,24 +410,37 @@ def to_multimodal_blocks(content: Any) -> List[Dict[str, Any]]:
     return blocks
 
 
-def convert_message_for_vl(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+def convert_message_for_vl_with_media(message: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], bool, bool]:
+    """Converts a message and reports whether it carries image / video blocks."""
     role = str(message.get("role") or "user")
     blocks = to_multimodal_blocks(message.get("content"))
-    existing_images = {
-        block.get("image")
-        for block in blocks
-        if block.get("type") == "image" and block.get("image")
-    }
+    existing_images: set[str] = set()
+    has_image = False
+    has_video = False
+    for block in blocks:
+        block_type = block.get("type")
+        if block_type == "image":
+            has_image = True
+            ref = block.get("image")
+            if ref:
+                existing_images.add(ref)
+        elif block_type == "video":
+            has_video = True
     for ref in extract_image_refs_from_message(message):
         if ref not in existing_images:
             blocks.append({"type": "image", "image": ref})
             existing_images.add(ref)
+            has_image = True
     if not blocks:
         text = extract_text_from_content(message.get("content"))
         if not text:
-            return None
+            return None, False, False
         blocks.append({"type": "text", "text": text})
-    return {"role": role, "content": blocks}
+    return {"role": role, "content": blocks}, has_image, has_video
+
+
+def convert_message_for_vl(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    return convert_message_for_vl_with_media(message)[0]
 
 
 def prepare_glm_messages(messages: Sequence[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Image.Image]]:
@@ -435,11 +495,83 @@ def extract_json_object(payload: str) -> Dict[str, Any]:
         return json.loads(match.group(0))
 
 
+class JsonObjectScanner:
+    """Incrementally tracks where the first top-level JSON object ends in a text stream."""
+
+    __slots__ = ("depth", "started", "in_string", "escaped")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        for char in chunk:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+
 def empty_cuda_cache() -> None:
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
 
+class RateLimiter:
+    """Thread-safe token bucket: at most ``rate`` acquisitions per second on average."""
+
+    def __init__(self, rate: float, burst: Optional[int] = None) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = float(burst or max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=None)
+def get_provider_limits(
+    base_url: str,
+    max_concurrency: int,
+    requests_per_second: Optional[float],
+) -> Tuple[threading.BoundedSemaphore, Optional[RateLimiter]]:
+    # Один набор лимитов на провайдера: все JudgeClient с тем же base_url делят квоту.
+    semaphore = threading.BoundedSemaphore(max(1, max_concurrency))
+    limiter = RateLimiter(requests_per_second) if requests_per_second else None
+    return semaphore, limiter
+
+
 class JudgeClient:
     def __init__(
         self,
@@ -449,20 +581,71 @@ class JudgeClient:
         temperature: float = 0.75,
         retriever: Optional[KnowledgeRetriever] = None,
         rag_top_k: int = 4,
+        stream: bool = True,
+        max_concurrency: int = 5,
+        requests_per_second: Optional[float] = None,
     ) -> None:
         self.client = OpenAI(base_url=base_url, api_key=api_key)
+        self._semaphore, self._rate_limiter = get_provider_limits(
+            base_url.rstrip("/"),
+            max_concurrency,
+            requests_per_second,
+        )
         self.model = model
         self.temperature = temperature
         self.retriever = retriever
         self.rag_top_k = rag_top_k
+        self.stream = stream
+
+    def _chat(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float] = None,
+        stop_at_json: bool = False,
+    ) -> str:
+        with self._semaphore:
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            return self._chat_unlimited(messages, temperature, stop_at_json)
 
-    def _chat(self, messages: List[Dict[str, str]], temperature: Optional[float] = None) -> str:
-        completion = self.client.chat.completions.create(
+    def _chat_unlimited(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: Optional[float],
+        stop_at_json: bool,
+    ) -> str:
+        request_temperature = self.temperature if temperature is None else temperature
+        if not self.stream:
+            completion = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=request_temperature,
+            )
+            return (completion.choices[0].message.content or "").strip()
+
+        stream = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
-            temperature=self.temperature if temperature is None else temperature,
+            temperature=request_temperature,
+            stream=True,
         )
-        return (completion.choices[0].message.content or "").strip()
+        # Для JSON-ответов обрываем поток, как только закрылся верхнеуровневый объект:
+        # хвост после него (пояснения, markdown) всё равно отбрасывается парсером.
+        scanner = JsonObjectScanner() if stop_at_json else None
+        parts: List[str] = []
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if scanner is not None and scanner.feed(delta):
+                    break
+        finally:
+            stream.close()
+        return "".join(parts).strip()
 
     def ask_question(
         self,
@@ -487,22 +670,78 @@ class JudgeClient:
         history: Sequence[Dict[str, Any]],
         expected_style: str,
     ) -> Dict[str, Any]:
+        knowledge_section = self._knowledge_section(history)
+        messages = [
+            {"role": "system", "content": JUDGE_EVALUATION_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": (
+                    f"Эталонный стиль: {expected_style}.\n"
+                    "Оцени соответствие последней реплики ассистента ожиданиям.\n"
+                    f"{knowledge_section}\n\n"
+                    f"Диалог:\n{format_history(history)}"
+                ),
+            },
+        ]
+        logging.debug("Judge evaluation контекст:\n%s", knowledge_section)
+        response = self._chat(messages, temperature=0.0, stop_at_json=True)
+        return extract_json_object(response)
+
+    def evaluate_turns_batch(
+        self,
+        history_snapshots: Sequence[Sequence[Dict[str, Any]]],
+        expected_style: str,
+    ) -> List[Dict[str, Any]]:
+        """Evaluates several clone replies of one dialog in a single judge request.
+
+        Every snapshot is a prefix of the dialog ending with the reply to score; the last
+        snapshot is the full dialog. Raises ValueError when the judge answers out of format.
+        """
+        if not history_snapshots:
+            return []
+        turn_sections: List[str] = []
+        for snapshot in history_snapshots:
+            # Номер реплики совпадает с нумерацией format_history для полного диалога.
+            turn_sections.append(
+                f"Реплика {len(snapshot):02d}.\n{self._knowledge_section(snapshot)}"
+            )
+        messages = [
+            {
+                "role": "system",
+                "content": f"{JUDGE_EVALUATION_SYSTEM_PROMPT}\n{JUDGE_BATCH_EVALUATION_INSTRUCTIONS}",
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"Эталонный стиль: {expected_style}.\n"
+                    "Оцени соответствие каждой из перечисленных реплик ассистента ожиданиям.\n\n"
+                    + "\n\n".join(turn_sections)
+                    + f"\n\nДиалог:\n{format_history(history_snapshots[-1])}"
+                ),
+            },
+        ]
+        response = self._chat(messages, temperature=0.0, stop_at_json=True)
+        evaluations = extract_json_object(response).get("evaluations")
+        if not isinstance(evaluations, list) or len(evaluations) != len(history_snapshots):
+            raise ValueError(f"Судья вернул пакетную оценку не в том формате: {response}")
+        if not all(isinstance(item, dict) and "score" in item for item in evaluations):
+            raise ValueError(f"В пакетной оценке судьи нет баллов: {response}")
+        return evaluations
+
+    def _knowledge_section(self, history: Sequence[Dict[str, Any]]) -> str:
         knowledge_section = "Контекст знаний для проверки: данных нет. Если факт отсутствует, честно укажи, что данных нет, и не выдумывай." 
         if self.retriever is not None:
-            queries: List[str] = []
-            question_text = last_user_message(history)
-            answer_text = last_assistant_message(history)
-            if question_text:
-                queries.append(question_text)
-            if answer_text:
-                queries.append(answer_text)
+            queries = [
+                query
+                for query in (last_user_message(history), last_assistant_message(history))
+                if query
+            ]
 
             seen: set[str] = set()
             snippets: List[RetrievalResult] = []
-            for query in queries:
-                if not query:
-                    continue
-                for snippet in self.retriever.search(query, k=self.rag_top_k):
+            # Вопрос и ответ кодируются одним батчем эмбеддера.
+            for query_results in self.retriever.batch_search(queries, k=self.rag_top_k):
+                for snippet in query_results:
                     key = (snippet.content or "").strip()
                     if not key or key in seen:
                         continue
@@ -515,21 +754,7 @@ class JudgeClient:
                     "Контекст знаний для проверки (используй только перечисленные факты; если факта нет, признай, что данных нет и не придумывай):\n"
                     f"{formatted}"
                 )
-        messages = [
-            {"role": "system", "content": JUDGE_EVALUATION_SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": (
-                    f"Эталонный стиль: {expected_style}.\n"
-                    "Оцени соответствие последней реплики ассистента ожиданиям.\n"
-                    f"{knowledge_section}\n\n"
-                    f"Диалог:\n{format_history(history)}"
-                ),
-            },
-        ]
-        logging.debug("Judge evaluation контекст:\n%s", knowledge_section)
-        response = self._chat(messages, temperature=0.0)
-        return extract_json_object(response)
+        return knowledge_section
 
     def improve_prompt(
         self,
@@ -551,10 +776,34 @@ class JudgeClient:
                 ),
             },
         ]
-        response = self._chat(messages, temperature=0.2)
+        response = self._chat(messages, temperature=0.2, stop_at_json=True)
         return extract_json_object(response)
 
 
+@dataclass(slots=True)
+class DialogCacheState:
+    sequences: torch.Tensor
+    past_key_values: Any
+    # Qwen-VL хранит сдвиги mRoPE в самой модели; их перезаписывает префилл любого сценария.
+    rope_deltas: Optional[torch.Tensor] = None
+
+
+# Квантованный KV-кэш HF (cache_implementation="quantized"): декод упирается в пропускную
+# способность памяти, а кэш занимает вдвое-вчетверо меньше места.
+KV_CACHE_CONFIGS: Dict[str, Optional[Dict[str, Any]]] = {
+    "fp16": None,
+    "int8": {"backend": "HQQ", "nbits": 8, "axis_key": 0, "axis_value": 0, "q_group_size": 64},
+    "int4": {"backend": "quanto", "nbits": 4},
+}
+
+# Со статическим кэшем длина промта выравнивается до кратной этому значению (паддинг слева),
+# чтобы скомпилированный граф переиспользовался между ходами, а не перезаписывался.
+STATIC_CACHE_PAD_MULTIPLE = 128
+
+# Префикс короче этого порога дешевле пересчитать, чем обрезать и переиспользовать кэш.
+MIN_REUSABLE_PREFIX_TOKENS = 16
+
+
 class CloneResponder:
     def __init__(
         self,
@@ -565,13 +814,31 @@ class CloneResponder:
         retriever: Optional[KnowledgeRetriever] = None,
         rag_top_k: int = 4,
         vl_backend: Optional[str] = None,
+        quantized_model_id: Optional[str] = None,
+        compile_model: bool = False,
+        kv_cache_dtype: str = "fp16",
+        static_cache: bool = False,
     ) -> None:
         self.precision = precision
+        if kv_cache_dtype not in KV_CACHE_CONFIGS:
+            raise ValueError(f"Неизвестный тип KV-кэша: {kv_cache_dtype}")
+        cache_config = KV_CACHE_CONFIGS[kv_cache_dtype]
+        if static_cache and cache_config is not None:
+            raise ValueError("Статический KV-кэш несовместим с квантованным: выберите что-то одно.")
+        self.static_cache = static_cache
+        self.cache_kwargs: Dict[str, Any] = {}
+        self.padding_kwargs: Dict[str, Any] = {}
+        if cache_config is not None:
+            self.cache_kwargs = {"cache_implementation": "quantized", "cache_config": dict(cache_config)}
+        elif static_cache:
+            self.cache_kwargs = {"cache_implementation": "static"}
+            self.padding_kwargs = {"pad_to_multiple_of": STATIC_CACHE_PAD_MULTIPLE}
         self.retriever = retriever
         self.rag_top_k = rag_top_k
         self.backend = infer_backend_from_model_id(model_id, vl_backend)
         self.supports_videos = self.backend == "qwen2_vl"
         quant_config = None
+        model_source = model_id
         load_kwargs: Dict[str, Any] = {
             "device_map": "auto",
             "trust_remote_code": trust_remote_code,
@@ -589,6 +856,19 @@ class CloneResponder:
             load_kwargs["torch_dtype"] = torch.float16
         elif precision == "fp32":
             load_kwargs["torch_dtype"] = torch.float32
+        elif precision in ("awq", "gptq"):
+            # Готовый int4-чекпойнт той же архитектуры: квантизация описана в его config.json,
+            # а ядра AWQ/exllama объединяют деквантизацию с matmul (быстрее bnb nf4 на декоде).
+            model_source = quantized_model_id or model_id
+            load_kwargs["torch_dtype"] = torch.float16
+            if precision == "gptq":
+                from transformers import GPTQConfig
+
+                load_kwargs["quantization_config"] = GPTQConfig(
+                    bits=4,
+                    use_exllama=True,
+                    exllama_config={"version": 2},
+                )
         else:
             raise ValueError(f"Неизвестная точность загрузки модели: {precision}")
 
@@ -604,16 +884,29 @@ class CloneResponder:
                 continue
         if not processor_loaded:
             raise RuntimeError(f"Не удалось загрузить процессор для модели {model_id}")
+        self.pad_token_id: Optional[int] = None
+        # Текстовые промты токенизируются по приращению: переносим id прошлого хода и
+        # токенизируем только дописанный хвост. Резать безопасно лишь после перевода строки
+        # или спецтокена — там токенизатор всё равно начинает новый фрагмент.
+        self._prompt_tokens: Dict[Any, Tuple[str, torch.Tensor]] = {}
+        self._delta_tokenization = False
+        self._delta_tokenization_checked = False
+        self._safe_split_suffixes: Tuple[str, ...] = ("\n",)
         if hasattr(self.processor, "tokenizer") and self.processor.tokenizer is not None:
             tokenizer = self.processor.tokenizer
             if getattr(tokenizer, "pad_token_id", None) is None and getattr(tokenizer, "eos_token_id", None) is not None:
                 tokenizer.pad_token_id = tokenizer.eos_token_id
-            tokenizer.padding_side = "right"
+            # Процессор используется только для генерации: паддинг слева, чтобы
+            # последним токеном каждой строки батча был реальный токен промта.
+            tokenizer.padding_side = "left"
+            self.pad_token_id = getattr(tokenizer, "pad_token_id", None)
+            self._delta_tokenization = True
+            self._safe_split_suffixes += tuple(getattr(tokenizer, "all_special_tokens", ()) or ())
 
         if self.backend == "qwen2_vl":
-            self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_id, **load_kwargs)
+            self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_source, **load_kwargs)
         else:
-            self.model = Glm4vForConditionalGeneration.from_pretrained(model_id, **load_kwargs)
+            self.model = Glm4vForConditionalGeneration.from_pretrained(model_source, **load_kwargs)
         if not adapter_dir.exists():
             raise FileNotFoundError(f"LoRA adapter not found: {adapter_dir}")
 
@@ -625,6 +918,44 @@ class CloneResponder:
             self.device = next(self.model.parameters()).device
         except StopIteration:  # pragma: no cover - defensive for empty parameters
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self._dialog_cache: Dict[Any, DialogCacheState] = {}
+        self._generation_kwargs_cache: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        # Шаблон GLM рендерится по приращению: префикс (system + прошлые ходы) хранится строкой,
+        # а Jinja прогоняется только для новых сообщений. Режим проверяется сверкой с полным рендером.
+        self._rendered_prefix: Dict[Any, Tuple[int, str]] = {}
+        self._incremental_template = True
+        self._incremental_template_checked = False
+        self._template_header: Optional[str] = None
+        self._generation_suffix: Optional[str] = None
+        self._eager_forward: Optional[Any] = None
+        if compile_model:
+            # Со статическим кэшем формы фиксированы, и граф можно компилировать без динамических размеров.
+            self._enable_compile(dynamic=not static_cache)
+
+    def _enable_compile(self, dynamic: bool = True) -> None:
+        if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (7, 0):
+            logging.warning("torch.compile для клона пропущен: нужна CUDA GPU с compute capability >= 7.0.")
+            return
+        try:
+            import torch._dynamo
+
+            # Длина промта растёт от хода к ходу — без запаса dynamo быстро упрётся в лимит перекомпиляций.
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            # Компилируем forward внутренней модели: generate() вызывает именно его на каждом шаге декода.
+            base_model = self.model.get_base_model()
+            eager_forward = base_model.forward
+            base_model.forward = torch.compile(eager_forward, mode="reduce-overhead", dynamic=dynamic)
+            self._eager_forward = eager_forward
+            logging.info("Forward модели клона скомпилирован (torch.compile, reduce-overhead).")
+        except Exception as exc:  # pragma: no cover - зависит от версии torch и GPU
+            logging.warning("Не удалось включить torch.compile для клона: %s", exc)
+
+    def _disable_compile(self) -> None:
+        if self._eager_forward is None:
+            return
+        self.model.get_base_model().forward = self._eager_forward
+        self._eager_forward = None
+        empty_cuda_cache()
 
     def generate(
         self,
@@ -635,6 +966,7 @@ class CloneResponder:
         top_p: float,
         top_k: int,
         do_sample: bool,
+        scenario_id: Optional[Any] = None,
     ) -> str:
         if self.backend == "qwen2_vl":
             return self._generate_qwen(
@@ -645,6 +977,7 @@ class CloneResponder:
                 top_p,
                 top_k,
                 do_sample,
+                scenario_id,
             )
         return self._generate_glm(
             system_prompt,
@@ -654,7 +987,250 @@ class CloneResponder:
             top_p,
             top_k,
             do_sample,
+            scenario_id,
+        )
+
+    def reset_dialog_cache(self, scenario_id: Any) -> None:
+        self._dialog_cache.pop(scenario_id, None)
+        self._prompt_tokens.pop(scenario_id, None)
+        self._rendered_prefix.pop(scenario_id, None)
+
+    def _render_glm_prompt(self, glm_messages: List[Dict[str, Any]], scenario_id: Optional[Any]) -> str:
+        state = self._rendered_prefix.get(scenario_id) if scenario_id is not None else None
+        if state is not None and self._incremental_template:
+            prefix_turns, rendered_prefix = state
+            fragment = (
+                self._render_template_fragment(glm_messages[prefix_turns:])
+                if len(glm_messages) > prefix_turns
+                else None
+            )
+            if fragment is not None:
+                rendered = rendered_prefix + fragment
+                prompt_text = rendered + (self._generation_suffix or "")
+                if not self._incremental_template_checked:
+                    # Однократная сверка: шаблоны, зависящие от позиции сообщения, отключают режим.
+                    self._incremental_template_checked = True
+                    full_text = self.processor.apply_chat_template(
+                        glm_messages,
+                        tokenize=False,
+                        add_generation_prompt=True,
+                    )
+                    if full_text != prompt_text:
+                        logging.info("Шаблон GLM не рендерится по приращению — отключаю режим для клона.")
+                        self._incremental_template = False
+                        self._rendered_prefix.clear()
+                        return full_text
+                self._rendered_prefix[scenario_id] = (len(glm_messages), rendered)
+                return prompt_text
+
+        prompt_text = self.processor.apply_chat_template(
+            glm_messages,
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        if scenario_id is not None and self._incremental_template:
+            rendered = self.processor.apply_chat_template(
+                glm_messages,
+                tokenize=False,
+                add_generation_prompt=False,
+            )
+            suffix = prompt_text[len(rendered):] if prompt_text.startswith(rendered) else None
+            if suffix is None or (self._generation_suffix is not None and suffix != self._generation_suffix):
+                self._incremental_template = False
+                self._rendered_prefix.clear()
+            else:
+                self._generation_suffix = suffix
+                self._rendered_prefix[scenario_id] = (len(glm_messages), rendered)
+        return prompt_text
+
+    def _render_template_fragment(self, messages: Sequence[Dict[str, Any]]) -> Optional[str]:
+        try:
+            if self._template_header is None:
+                # Всё, что шаблон выводит до первого сообщения (например, [gMASK]<sop>).
+                self._template_header = self.processor.apply_chat_template(
+                    [],
+                    tokenize=False,
+                    add_generation_prompt=False,
+                )
+            fragment = self.processor.apply_chat_template(
+                list(messages),
+                tokenize=False,
+                add_generation_prompt=False,
+            )
+        except Exception as exc:  # pragma: no cover - зависит от шаблона модели
+            logging.debug("Инкрементальный рендер шаблона GLM недоступен: %s", exc)
+            self._incremental_template = False
+            return None
+        if not fragment.startswith(self._template_header):
+            self._incremental_template = False
+            return None
+        return fragment[len(self._template_header):]
+
+    def _extend_prompt_tokens(self, scenario_id: Any, prompt_text: str) -> Optional[torch.Tensor]:
+        state = self._prompt_tokens.get(scenario_id)
+        if state is None:
+            return None
+        previous_text, previous_ids = state
+        if len(prompt_text) <= len(previous_text) or not prompt_text.startswith(previous_text):
+            return None
+        if not previous_text.endswith(self._safe_split_suffixes):
+            return None
+        suffix_ids = self.processor.tokenizer(
+            prompt_text[len(previous_text):],
+            add_special_tokens=False,
+            return_tensors="pt",
+        )["input_ids"]
+        input_ids = torch.cat([previous_ids, suffix_ids], dim=-1)
+        if not self._delta_tokenization_checked:
+            # Однократная сверка с полной токенизацией: шаблоны с нестандартной склейкой отключают режим.
+            self._delta_tokenization_checked = True
+            full_ids = self.processor(text=[prompt_text], padding=True, return_tensors="pt")["input_ids"]
+            if not torch.equal(full_ids, input_ids):
+                logging.info("Токенизация по приращению расходится с полной — отключаю её для клона.")
+                self._delta_tokenization = False
+                return None
+        return input_ids
+
+    def _encode_prompt(
+        self,
+        processor_kwargs: Dict[str, Any],
+        scenario_id: Optional[Any],
+        has_media: bool,
+    ) -> Dict[str, Any]:
+        prompt_text = processor_kwargs["text"][0]
+        track = scenario_id is not None and not has_media and not self.padding_kwargs
+        input_ids: Optional[torch.Tensor] = None
+        if track and self._delta_tokenization:
+            input_ids = self._extend_prompt_tokens(scenario_id, prompt_text)
+        if input_ids is None:
+            outputs = self.processor(**processor_kwargs)
+            if track:
+                self._prompt_tokens[scenario_id] = (prompt_text, outputs["input_ids"])
+            elif scenario_id is not None:
+                self._prompt_tokens.pop(scenario_id, None)
+            return self._move_to_device(outputs)
+        self._prompt_tokens[scenario_id] = (prompt_text, input_ids)
+        return self._move_to_device({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+    def _move_to_device(self, batch: Any) -> Dict[str, Any]:
+        # Из закреплённой памяти копирование на GPU асинхронно и перекрывается с подготовкой generate().
+        non_blocking = self.device.type == "cuda"
+        moved: Dict[str, Any] = {}
+        for key, value in batch.items():
+            if isinstance(value, torch.Tensor):
+                if non_blocking and not value.is_cuda:
+                    value = value.pin_memory()
+                value = value.to(self.device, non_blocking=non_blocking)
+            moved[key] = value
+        return moved
+
+    def _take_reusable_cache(self, scenario_id: Any, input_ids: torch.Tensor) -> Optional[Any]:
+        """Returns the previous turn's KV cache cropped to the prefix it shares with input_ids."""
+        state = self._dialog_cache.pop(scenario_id, None)
+        if state is None:
+            return None
+        cache = state.past_key_values
+        if not hasattr(cache, "crop") or not hasattr(cache, "get_seq_length"):
+            return None
+        # Хотя бы один токен нового промта должен пройти через модель.
+        limit = min(int(cache.get_seq_length()), state.sequences.shape[-1], input_ids.shape[-1] - 1)
+        if limit < MIN_REUSABLE_PREFIX_TOKENS:
+            return None
+        current = input_ids[0, :limit]
+        previous = state.sequences[0, :limit].to(current.device)
+        mismatch = torch.nonzero(current != previous)
+        prefix_length = int(mismatch[0]) if mismatch.numel() else limit
+        if prefix_length < MIN_REUSABLE_PREFIX_TOKENS:
+            return None
+        cache.crop(prefix_length)
+        # Продолжение с обрезанного кэша берёт позиции декода из model.rope_deltas, а их мог
+        # оставить префилл другого сценария (с картинками): возвращаем сдвиги этого диалога.
+        holder = self._rope_deltas_holder()
+        if holder is not None:
+            holder.rope_deltas = state.rope_deltas
+        return cache
+
+    def _rope_deltas_holder(self) -> Optional[Any]:
+        """Модуль, в котором Qwen-VL хранит rope_deltas (внутренний model или сама модель), либо None."""
+        model = self.model.get_base_model() if hasattr(self.model, "get_base_model") else self.model
+        for candidate in (getattr(model, "model", None), model):
+            if candidate is not None and hasattr(candidate, "rope_deltas"):
+                return candidate
+        return None
+
+    def _generation_kwargs(
+        self,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        do_sample: bool,
+    ) -> Dict[str, Any]:
+        # Настройки сэмплинга фиксированы на весь прогон: словарь собирается один раз на режим.
+        key = (do_sample, temperature, top_p, top_k) if do_sample else (False,)
+        base = self._generation_kwargs_cache.get(key)
+        if base is None:
+            base = {"do_sample": do_sample}
+            if do_sample:
+                base.update({"temperature": temperature, "top_p": top_p, "top_k": top_k})
+            base.update(self.cache_kwargs)
+            if self.pad_token_id is not None:
+                base["pad_token_id"] = self.pad_token_id
+            self._generation_kwargs_cache[key] = base
+        return {**base, "max_new_tokens": max_new_tokens}
+
+    def _run_generate(
+        self,
+        inputs: Dict[str, Any],
+        generation_kwargs: Dict[str, Any],
+        scenario_id: Optional[Any],
+    ) -> torch.Tensor:
+        input_ids = inputs["input_ids"]
+        # Кэш переиспользуем только для текстовых диалогов: с картинками позиции mRoPE
+        # пересчитываются на первом проходе и со старым префиксом не совпадут.
+        # Квантованный кэш не поддерживает обрезку, поэтому между ходами не переиспользуется.
+        reusable = (
+            scenario_id is not None
+            and not self.cache_kwargs
+            and input_ids.shape[0] == 1
+            and "pixel_values" not in inputs
+            and "pixel_values_videos" not in inputs
         )
+        call_kwargs = dict(generation_kwargs)
+        if reusable:
+            cache = self._take_reusable_cache(scenario_id, input_ids)
+            if cache is not None:
+                call_kwargs["past_key_values"] = cache
+            call_kwargs["return_dict_in_generate"] = True
+        elif scenario_id is not None:
+            self.reset_dialog_cache(scenario_id)
+
+        try:
+            with torch.inference_mode():
+                output = self.model.generate(**inputs, **call_kwargs)
+        except Exception as exc:
+            if self._eager_forward is None:
+                raise
+            # Ошибка компиляции или OOM при записи CUDA-графов: продолжаем в eager-режиме.
+            logging.warning("Скомпилированный forward клона упал (%s), возвращаюсь к eager-режиму.", exc)
+            self._disable_compile()
+            call_kwargs.pop("past_key_values", None)
+            with torch.inference_mode():
+                output = self.model.generate(**inputs, **call_kwargs)
+
+        if reusable:
+            sequences = output.sequences
+            past_key_values = getattr(output, "past_key_values", None)
+            if past_key_values is not None:
+                holder = self._rope_deltas_holder()
+                self._dialog_cache[scenario_id] = DialogCacheState(
+                    sequences=sequences,
+                    past_key_values=past_key_values,
+                    rope_deltas=holder.rope_deltas if holder is not None else None,
+                )
+        else:
+            sequences = output
+        return sequences[:, input_ids.shape[-1]:]
 
     def _generate_qwen(
         self,
@@ -665,6 +1241,7 @@ class CloneResponder:
         top_p: float,
         top_k: int,
         do_sample: bool,
+        scenario_id: Optional[Any] = None,
     ) -> str:
         system_content = system_prompt
         context_snippets: List[RetrievalResult] = []
@@ -685,67 +1262,43 @@ class CloneResponder:
         messages: List[Dict[str, Any]] = [
             {"role": "system", "content": [{"type": "text", "text": system_content}]}
         ]
+        needs_images = False
+        needs_videos = False
         for message in history:
-            converted = convert_message_for_vl(message)
+            converted, has_image, has_video = convert_message_for_vl_with_media(message)
             if converted:
                 messages.append(converted)
+                needs_images = needs_images or has_image
+                needs_videos = needs_videos or has_video
 
         prompt_text = self.processor.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True,
         )
-        needs_images = False
-        needs_videos = False
-        for message in messages:
-            content = message.get("content") or []
-            if isinstance(content, dict):
-                content = [content]
-            for block in content:
-                if not isinstance(block, dict):
-                    continue
-                block_type = block.get("type")
-                if block_type == "image":
-                    needs_images = True
-                elif block_type == "video":
-                    needs_videos = True
-            if needs_images and (needs_videos or not self.supports_videos):
-                break
 
         image_inputs = None
         video_inputs = None
         if needs_images or (self.supports_videos and needs_videos):
+            if needs_images:
+                # process_vision_info принимает готовые PIL-кадры и не открывает файлы повторно.
+                attach_decoded_images(messages)
             image_inputs, video_inputs = process_vision_info(messages)
 
         processor_kwargs: Dict[str, Any] = {
             "text": [prompt_text],
             "padding": True,
             "return_tensors": "pt",
+            **self.padding_kwargs,
         }
         if image_inputs is not None:
             processor_kwargs["images"] = image_inputs
         if self.supports_videos and video_inputs is not None:
             processor_kwargs["videos"] = video_inputs
 
-        processor_outputs = self.processor(**processor_kwargs)
-        inputs = {
-            key: value.to(self.device) if hasattr(value, "to") else value
-            for key, value in processor_outputs.items()
-        }
-        generation_kwargs: Dict[str, Any] = {
-            "max_new_tokens": max_new_tokens,
-            "do_sample": do_sample,
-        }
-        if do_sample:
-            generation_kwargs.update({
-                "temperature": temperature,
-                "top_p": top_p,
-                "top_k": top_k,
-            })
-        with torch.no_grad():
-            output = self.model.generate(**inputs, **generation_kwargs)
-        input_length = inputs["input_ids"].shape[-1]
-        generated = output[:, input_length:]
+        inputs = self._encode_prompt(processor_kwargs, scenario_id, needs_images or needs_videos)
+        generation_kwargs = self._generation_kwargs(max_new_tokens, temperature, top_p, top_k, do_sample)
+        generated = self._run_generate(inputs, generation_kwargs, scenario_id)
         texts = self.processor.batch_decode(
             generated,
             skip_special_tokens=True,
@@ -762,6 +1315,7 @@ class CloneResponder:
         top_p: float,
         top_k: int,
         do_sample: bool,
+        scenario_id: Optional[Any] = None,
     ) -> str:
         messages_sequence: List[Dict[str, Any]] = [
             {"role": "system", "content": [{"type": "text", "text": system_prompt}]}
@@ -775,71 +1329,108 @@ class CloneResponder:
 
         prompt_text: str
         try:
-            prompt_text = self.processor.apply_chat_template(
-                glm_messages,
-                tokenize=False,
-                add_generation_prompt=True,
-            )
+            prompt_text = self._render_glm_prompt(glm_messages, scenario_id)
         except Exception as exc:  # pragma: no cover - defensive fallback
             logging.debug("GLM chat template failed, falling back to manual prompt: %s", exc)
-            prompt_lines: List[str] = []
-            for message in glm_messages:
-                role = message.get("role", "user")
-                content_blocks = message.get("content") or []
-                fragments: List[str] = []
-                for block in content_blocks:
-                    if isinstance(block, dict) and block.get("type") == "text":
-                        text_value = block.get("text")
-                        if isinstance(text_value, str) and text_value.strip():
-                            fragments.append(text_value.strip())
-                if fragments:
-                    prompt_lines.append(f"{role}: {' '.join(fragments)}")
-            prompt_text = "\n".join(prompt_lines).strip()
-        if not prompt_text:
-            prompt_text = " "
+            # prepare_glm_messages уже нормализовал блоки: текст — строка без крайних пробелов,
+            # поэтому достаточно отбросить пустые через filter(None, ...).
+            message_texts = (
+                (
+                    message.get("role", "user"),
+                    " ".join(
+                        filter(
+                            None,
+                            (block.get("text") for block in message.get("content") or () if block.get("type") == "text"),
+                        )
+                    ),
+                )
+                for message in glm_messages
+            )
+            prompt_text = "\n".join(f"{role}: {text}" for role, text in message_texts if text).strip()
+        prompt_text = prompt_text or " "
 
         processor_kwargs: Dict[str, Any] = {
             "text": [prompt_text],
             "padding": True,
             "return_tensors": "pt",
+            **self.padding_kwargs,
         }
         if glm_images:
             processor_kwargs["images"] = [glm_images]
 
-        inputs_raw = self.processor(**processor_kwargs)
-        inputs = {
-            key: value.to(self.device) if hasattr(value, "to") else value
-            for key, value in inputs_raw.items()
-        }
-
-        generation_kwargs: Dict[str, Any] = {
-            "max_new_tokens": max_new_tokens,
-            "do_sample": do_sample,
-        }
-        if do_sample:
-            generation_kwargs.update(
-                {
-                    "temperature": temperature,
-                    "top_p": top_p,
-                    "top_k": top_k,
-                }
-            )
-
-        with torch.no_grad():
-            output = self.model.generate(**inputs, **generation_kwargs)
-        input_length = inputs["input_ids"].shape[-1]
-        generated = output[:, input_length:]
-        decoded = self.processor.decode(
-            generated[0],
+        inputs = self._encode_prompt(processor_kwargs, scenario_id, bool(glm_images))
+        generation_kwargs = self._generation_kwargs(max_new_tokens, temperature, top_p, top_k, do_sample)
+        generated = self._run_generate(inputs, generation_kwargs, scenario_id)
+        texts = self.processor.batch_decode(
+            generated,
             skip_special_tokens=True,
+            clean_up_tokenization_spaces=False,
         )
-        return decoded.strip()
+        return texts[0].strip() if texts else ""
 
     def shutdown(self) -> None:
+        self._dialog_cache.clear()
+        self._rendered_prefix.clear()
         del self.model
         if hasattr(self, "processor"):
             del self.processor
-        empty_cuda_cache()
+
+
+def _training_worker_loop(requests: Any, responses: Any) -> None:
+    # Процесс живёт весь прогон оптимизации: стек обучения импортируется один раз,
+    # а базовая модель остаётся в памяти между итерациями (reuse_base_model=True).
+    while True:
+        cli_args = requests.get()
+        if cli_args is None:
+            break
+        try:
+            result = run_training(parse_train_args(cli_args), reuse_base_model=True)
+        except Exception:  # pragma: no cover - ошибка пробрасывается в родительский процесс
+            responses.put((False, traceback.format_exc()))
+        else:
+            responses.put((True, result))
+
+
+class TrainingWorker:
+    """Persistent training subprocess that keeps the base model loaded across iterations."""
+
+    def __init__(self) -> None:
+        context = torch.multiprocessing.get_context("spawn")
+        self._requests = context.Queue()
+        self._responses = context.Queue()
+        # Не daemon: внутри обучения DataLoader порождает свои процессы.
+        self._process = context.Process(
+            target=_training_worker_loop,
+            args=(self._requests, self._responses),
+            name="train-worker",
+        )
+        self._process.start()
+        logging.info("Запущен постоянный процесс обучения (pid=%s).", self._process.pid)
+
+    def train(self, cli_args: Sequence[str]) -> TrainingRunResult:
+        if not self._process.is_alive():
+            raise RuntimeError("Процесс обучения не запущен или завершился.")
+        self._requests.put(list(cli_args))
+        while True:
+            try:
+                ok, payload = self._responses.get(timeout=5.0)
+                break
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(
+                        f"Процесс обучения аварийно завершился (код {self._process.exitcode})."
+                    ) from None
+        if not ok:
+            raise RuntimeError(f"Обучение в постоянном процессе завершилось ошибкой:\n{payload}")
+        return payload
+
+    def close(self) -> None:
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=60)
+        if self._process.is_alive():  # pragma: no cover - страховка от зависания
+            self._process.terminate()
+            self._process.join()
 
 
 class PromptOptimizationRunner:
@@ -856,8 +1447,13 @@ class PromptOptimizationRunner:
         scenarios_per_iteration: int,
         clone_settings: Dict[str, Any],
         retriever: Optional[KnowledgeRetriever] = None,
+        persistent_trainer: bool = False,
+        max_concurrent_scenarios: Optional[int] = None,
+        batch_judge_evaluations: bool = False,
     ) -> None:
         self.train_config = train_config
+        # Неизменяемая база конфига; на итерацию поверх неё кладутся только меняющиеся ключи.
+        self._train_base: Dict[str, Any] = dict(train_config)
         self.initial_prompt = initial_prompt
         self.expected_style = expected_style
         self.judge = judge_client
@@ -868,6 +1464,18 @@ class PromptOptimizationRunner:
         self.scenarios_per_iteration = max(1, scenarios_per_iteration)
         self.clone_settings = clone_settings
         self.retriever = retriever
+        self.persistent_trainer = persistent_trainer
+        self._training_worker: Optional[TrainingWorker] = None
+        self.batch_judge_evaluations = batch_judge_evaluations
+        self.max_concurrent_scenarios = max(
+            1,
+            min(max_concurrent_scenarios or self.scenarios_per_iteration, self.scenarios_per_iteration),
+        )
+        # Артефакты итераций пишутся в фоне, пока идёт следующее обучение.
+        self._io_pool: Optional[ThreadPoolExecutor] = None
+        self._pending_writes: List[Future] = []
+        # Генерация клона занимает GPU целиком — сериализуем её, а HTTP-вызовы судьи идут параллельно.
+        self._clone_lock = threading.Lock()
 
         self.model_id = str(train_config.get("model_id"))
         if not self.model_id:
@@ -879,6 +1487,30 @@ class PromptOptimizationRunner:
         self.trust_remote_code = bool(train_config.get("trust_remote_code", True))
 
     def run(self) -> PromptOptimizationSummary:
+        try:
+            return self._run_iterations()
+        finally:
+            if self._training_worker is not None:
+                self._training_worker.close()
+                self._training_worker = None
+            self._flush_artifacts()
+
+    def _submit_write(self, path: Path, payload: Any) -> None:
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifacts")
+        self._pending_writes.append(self._io_pool.submit(write_artifact, path, payload))
+
+    def _flush_artifacts(self) -> None:
+        pending, self._pending_writes = self._pending_writes, []
+        try:
+            for future in pending:
+                future.result()
+        finally:
+            if self._io_pool is not None:
+                self._io_pool.shutdown(wait=True)
+                self._io_pool = None
+
+    def _run_iterations(self) -> PromptOptimizationSummary:
         self.experiment_root.mkdir(parents=True, exist_ok=True)
 
         iterations: List[IterationResult] = []
@@ -899,6 +1531,9 @@ class PromptOptimizationRunner:
                 output_dir=training_result.output_dir,
                 train_metrics=training_result.train_metrics,
             )
+            # Сброс аллокатора один раз за итерацию: обучение следующей итерации (в том числе
+            # в отдельном процессе) должно получить память, освобождённую клоном.
+            empty_cuda_cache()
 
             scenario_results = iteration_result.scenarios
             average_score = iteration_result.average_score
@@ -965,17 +1600,24 @@ class PromptOptimizationRunner:
         system_prompt: str,
         iteration_dir: Path,
     ) -> TrainingRunResult:
-        run_config = dict(self.train_config)
-        run_config["persona_description"] = system_prompt
-
         output_dir = iteration_dir / "trainer"
         adapter_dir = iteration_dir / "lora_adapter"
-        run_config["output_dir"] = str(output_dir)
-        run_config["adapter_dir"] = str(adapter_dir)
+        run_config = ChainMap(
+            {
+                "persona_description": system_prompt,
+                "output_dir": str(output_dir),
+                "adapter_dir": str(adapter_dir),
+            },
+            self._train_base,
+        )
 
         cli_args = config_to_cli_args(run_config)
-        parsed_args = parse_train_args(cli_args)
         logging.info("Запускаю обучение (итерация %d).", iteration)
+        if self.persistent_trainer:
+            if self._training_worker is None:
+                self._training_worker = TrainingWorker()
+            return self._training_worker.train(cli_args)
+        parsed_args = parse_train_args(cli_args)
         return run_training(parsed_args)
 
     def _evaluate_with_judge(
@@ -991,21 +1633,35 @@ class PromptOptimizationRunner:
             raise FileNotFoundError(f"LoRA adapter not found for judge evaluation: {adapter_dir}")
 
         empty_cuda_cache()
+        # Веса, адаптер и процессор одинаковы для всех сценариев итерации — грузим клон один раз.
+        clone = self._load_clone(adapter_dir)
         scenario_results: List[ScenarioResult] = []
-        for scenario_index in range(1, self.scenarios_per_iteration + 1):
-            scenario_result = self._simulate_dialog(
-                scenario_index=scenario_index,
-                total_scenarios=self.scenarios_per_iteration,
-                system_prompt=system_prompt,
-                adapter_dir=adapter_dir,
-            )
-            scenario_results.append(scenario_result)
-            logging.info(
-                "Сценарий %d/%d — средний балл: %.2f",
-                scenario_index,
-                self.scenarios_per_iteration,
-                scenario_result.average_score,
-            )
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.max_concurrent_scenarios,
+                thread_name_prefix="scenario",
+            ) as pool:
+                futures = [
+                    pool.submit(
+                        self._simulate_dialog,
+                        scenario_index=scenario_index,
+                        total_scenarios=self.scenarios_per_iteration,
+                        system_prompt=system_prompt,
+                        clone=clone,
+                    )
+                    for scenario_index in range(1, self.scenarios_per_iteration + 1)
+                ]
+                for future in futures:
+                    scenario_result = future.result()
+                    scenario_results.append(scenario_result)
+                    logging.info(
+                        "Сценарий %d/%d — средний балл: %.2f",
+                        scenario_result.scenario_index,
+                        self.scenarios_per_iteration,
+                        scenario_result.average_score,
+                    )
+        finally:
+            clone.shutdown()
 
         average_score = (
             sum(scenario.average_score for scenario in scenario_results) / max(1, len(scenario_results))
@@ -1020,15 +1676,8 @@ class PromptOptimizationRunner:
             train_metrics=train_metrics or {},
         )
 
-    def _simulate_dialog(
-        self,
-        scenario_index: int,
-        total_scenarios: int,
-        system_prompt: str,
-        adapter_dir: Path,
-    ) -> ScenarioResult:
-        logging.info("---- Сценарий %d/%d: старт ----", scenario_index, total_scenarios)
-        clone = CloneResponder(
+    def _load_clone(self, adapter_dir: Path) -> CloneResponder:
+        return CloneResponder(
             model_id=self.model_id,
             adapter_dir=adapter_dir,
             precision=self.clone_settings["precision"],
@@ -1036,27 +1685,55 @@ class PromptOptimizationRunner:
             retriever=self.retriever,
             rag_top_k=self.clone_settings.get("rag_top_k", 4),
             vl_backend=self.vl_backend,
+            quantized_model_id=self.clone_settings.get("quantized_model_id"),
+            compile_model=self.clone_settings.get("compile", False),
+            kv_cache_dtype=self.clone_settings.get("kv_cache_dtype", "fp16"),
+            static_cache=self.clone_settings.get("static_cache", False),
         )
+
+    def _simulate_dialog(
+        self,
+        scenario_index: int,
+        total_scenarios: int,
+        system_prompt: str,
+        clone: CloneResponder,
+    ) -> ScenarioResult:
+        logging.info("---- Сценарий %d/%d: старт ----", scenario_index, total_scenarios)
         history: List[Dict[str, Any]] = []
         turns: List[TurnLog] = []
+        exchanges: List[Tuple[str, str]] = []
+        snapshots: List[List[Dict[str, Any]]] = []
+        evaluations: List[Dict[str, Any]] = []
         for turn_idx in range(1, self.turns_per_dialog + 1):
             judge_question = self.judge.ask_question(history, self.expected_style)
             history.append({"role": "user", "content": judge_question})
             logging.info("Scenario %d Turn %d — судья: %s", scenario_index, turn_idx, judge_question)
 
-            clone_answer = clone.generate(
-                system_prompt=system_prompt,
-                history=history,
-                max_new_tokens=self.clone_settings["max_new_tokens"],
-                temperature=self.clone_settings["temperature"],
-                top_p=self.clone_settings["top_p"],
-                top_k=self.clone_settings["sample_top_k"],
-                do_sample=self.clone_settings["do_sample"],
-            )
+            with self._clone_lock:
+                clone_answer = clone.generate(
+                    system_prompt=system_prompt,
+                    history=history,
+                    max_new_tokens=self.clone_settings["max_new_tokens"],
+                    temperature=self.clone_settings["temperature"],
+                    top_p=self.clone_settings["top_p"],
+                    top_k=self.clone_settings["sample_top_k"],
+                    do_sample=self.clone_settings["do_sample"],
+                    scenario_id=scenario_index,
+                )
             history.append({"role": "assistant", "content": clone_answer})
             logging.info("Scenario %d Turn %d — клон: %s", scenario_index, turn_idx, clone_answer)
 
-            evaluation = self.judge.evaluate_turn(history, self.expected_style)
+            exchanges.append((judge_question, clone_answer))
+            if self.batch_judge_evaluations:
+                # Следующий вопрос судьи зависит только от истории, поэтому оценки копим до конца диалога.
+                snapshots.append(list(history))
+            else:
+                evaluations.append(self.judge.evaluate_turn(history, self.expected_style))
+
+        if self.batch_judge_evaluations:
+            evaluations = self._evaluate_turns_batched(scenario_index, snapshots)
+
+        for turn_idx, ((judge_question, clone_answer), evaluation) in enumerate(zip(exchanges, evaluations), start=1):
             score = float(evaluation.get("score", 0.0))
             feedback = str(evaluation.get("feedback", "")).strip()
             logging.info(
@@ -1077,7 +1754,8 @@ class PromptOptimizationRunner:
             )
             turns.append(turn_log)
 
-        clone.shutdown()
+        with self._clone_lock:
+            clone.reset_dialog_cache(scenario_index)
         average_score = sum(t.score for t in turns) / max(1, len(turns))
         logging.info(
             "---- Сценарий %d/%d завершён. Средний балл: %.2f ----",
@@ -1087,33 +1765,40 @@ class PromptOptimizationRunner:
         )
         return ScenarioResult(scenario_index=scenario_index, turns=turns, average_score=average_score)
 
+    def _evaluate_turns_batched(
+        self,
+        scenario_index: int,
+        snapshots: Sequence[Sequence[Dict[str, Any]]],
+    ) -> List[Dict[str, Any]]:
+        try:
+            return self.judge.evaluate_turns_batch(snapshots, self.expected_style)
+        except Exception as exc:
+            logging.warning(
+                "Scenario %d: пакетная оценка судьёй не удалась (%s) — оцениваю ходы по одному.",
+                scenario_index,
+                exc,
+            )
+            return [self.judge.evaluate_turn(snapshot, self.expected_style) for snapshot in snapshots]
+
     def _write_iteration_artifacts(self, iteration_dir: Path, result: IterationResult) -> None:
-        data = iteration_to_dict(result)
-        (iteration_dir / "iteration_log.json").write_text(
-            json.dumps(data, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
-        (iteration_dir / "system_prompt.txt").write_text(result.system_prompt, encoding="utf-8")
+        # Словари снимаются синхронно (результат итерации ещё будет дополняться),
+        # а сериализация и запись на диск уходят в фоновый поток.
+        self._submit_write(iteration_dir / "iteration_log.json", iteration_to_dict(result))
+        self._submit_write(iteration_dir / "system_prompt.txt", result.system_prompt)
         if result.improved_prompt:
-            (iteration_dir / "next_system_prompt.txt").write_text(result.improved_prompt, encoding="utf-8")
+            self._submit_write(iteration_dir / "next_system_prompt.txt", result.improved_prompt)
 
         for scenario in result.scenarios:
             scenario_dir = iteration_dir / f"scenario_{scenario.scenario_index:02d}"
             scenario_dir.mkdir(parents=True, exist_ok=True)
-            (scenario_dir / "scenario_log.json").write_text(
-                json.dumps(scenario_to_dict(scenario), ensure_ascii=False, indent=2),
-                encoding="utf-8",
-            )
+            self._submit_write(scenario_dir / "scenario_log.json", scenario_to_dict(scenario))
             transcript_lines: List[str] = []
             for turn in scenario.turns:
                 transcript_lines.append(f"Judge: {turn.judge_question}")
                 transcript_lines.append(f"Clone: {turn.clone_answer}")
                 transcript_lines.append(f"Score: {turn.score:.1f} | {turn.feedback}")
                 transcript_lines.append("")
-            (scenario_dir / "transcript.txt").write_text(
-                "\n".join(transcript_lines).strip(),
-                encoding="utf-8",
-            )
+            self._submit_write(scenario_dir / "transcript.txt", "\n".join(transcript_lines).strip())
 
     def run_judge_only(self, adapter_dir: Path, system_prompt: Optional[str] = None) -> PromptOptimizationSummary:
         self.experiment_root.mkdir(parents=True, exist_ok=True)
@@ -1130,6 +1815,7 @@ class PromptOptimizationRunner:
             train_metrics={},
         )
         self._write_iteration_artifacts(evaluation_root, iteration_result)
+        self._flush_artifacts()
         logging.info(
             "Средний балл проверки: %.2f (цель %.2f)",
             iteration_result.average_score,
@@ -1147,6 +1833,20 @@ class PromptOptimizationRunner:
         return summary
 
 
+def dump_json_bytes(payload: Any) -> bytes:
+    if orjson is not None:
+        # orjson пишет UTF-8 без экранирования — то же, что ensure_ascii=False.
+        return orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def write_artifact(path: Path, payload: Any) -> None:
+    if isinstance(payload, str):
+        path.write_text(payload, encoding="utf-8")
+        return
+    path.write_bytes(dump_json_bytes(payload))
+
+
 def turn_to_dict(turn: TurnLog) -> Dict[str, Any]:
     return {
         "turn_index": turn.turn_index,
@@ -1213,6 +1913,23 @@ def parse_args() -> argparse.Namespace:
         default=1,
         help="Сколько независимых диалогов судья ведёт за одну итерацию обучения.",
     )
+    parser.add_argument(
+        "--max-concurrent-scenarios",
+        type=int,
+        default=None,
+        help=(
+            "Сколько сценариев вести параллельно (запросы к судье перекрываются, генерация клона "
+            "остаётся последовательной). По умолчанию — все сценарии итерации."
+        ),
+    )
+    parser.add_argument(
+        "--persistent-trainer",
+        action="store_true",
+        help=(
+            "Обучать в постоянном фоновом процессе: базовая модель загружается один раз на весь прогон. "
+            "Процесс держит модель в видеопамяти и во время оценки клона."
+        ),
+    )
     parser.add_argument(
         "--judge-only",
         action="store_true",
@@ -1229,6 +1946,28 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--judge-model", required=True, help="ID модели судьи, например Qwen/Qwen3-235B-A22B-Instruct-2507-FP8.")
     parser.add_argument("--judge-api-key", default="not-needed", help="Ключ API для судьи, если требуется.")
     parser.add_argument("--judge-temperature", type=float, default=0.7, help="Температура генерации вопросов судьёй.")
+    parser.add_argument(
+        "--judge-no-stream",
+        action="store_true",
+        help="Отключить потоковые ответы судьи (для прокси без поддержки stream=True).",
+    )
+    parser.add_argument(
+        "--judge-max-concurrency",
+        type=int,
+        default=5,
+        help="Максимум одновременных запросов к API судьи (на один base_url).",
+    )
+    parser.add_argument(
+        "--judge-batch-evaluations",
+        action="store_true",
+        help="Оценивать все ходы сценария одним запросом к судье (при ошибке — по одному ходу).",
+    )
+    parser.add_argument(
+        "--judge-rps",
+        type=float,
+        default=None,
+        help="Ограничение запросов к судье в секунду. По умолчанию без ограничения.",
+    )
 
     parser.add_argument("--clone-max-new-tokens", type=int, default=512, help="Максимум новых токенов для клона.")
     parser.add_argument("--clone-temperature", type=float, default=0.8, help="Температура сэмплинга клона.")
@@ -1237,9 +1976,33 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--clone-greedy", action="store_true", help="Отключить сэмплирование (детерминированный ответ).")
     parser.add_argument(
         "--clone-precision",
-        choices=["4bit", "fp16", "fp32"],
+        choices=["4bit", "fp16", "fp32", "awq", "gptq"],
         default="4bit",
-        help="Режим загрузки модели клона для оценки.",
+        help="Режим загрузки модели клона для оценки (awq/gptq — готовый int4-чекпойнт).",
+    )
+    parser.add_argument(
+        "--clone-quantized-model-id",
+        default=None,
+        help="ID или путь AWQ/GPTQ-чекпойнта базовой модели для --clone-precision awq|gptq.",
+    )
+    parser.add_argument(
+        "--clone-compile",
+        action="store_true",
+        help="Скомпилировать forward клона через torch.compile (reduce-overhead) для ускорения декода.",
+    )
+    parser.add_argument(
+        "--clone-kv-cache-dtype",
+        choices=sorted(KV_CACHE_CONFIGS),
+        default="fp16",
+        help="Точность KV-кэша клона: fp16 (как у модели), int8 (HQQ) или int4 (quanto).",
+    )
+    parser.add_argument(
+        "--clone-static-cache",
+        action="store_true",
+        help=(
+            "Статический KV-кэш и выравнивание промта до кратного 128: вместе с --clone-compile "
+            "декод идёт через CUDA-графы без перекомпиляций."
+        ),
     )
     parser.add_argument(
         "--rag-index-dir",
@@ -1297,10 +2060,17 @@ def main() -> None:
         temperature=args.judge_temperature,
         retriever=rag_retriever,
         rag_top_k=args.rag_top_k,
+        stream=not args.judge_no_stream,
+        max_concurrency=args.judge_max_concurrency,
+        requests_per_second=args.judge_rps,
     )
 
     clone_settings = {
         "precision": args.clone_precision,
+        "quantized_model_id": args.clone_quantized_model_id,
+        "compile": args.clone_compile,
+        "kv_cache_dtype": args.clone_kv_cache_dtype,
+        "static_cache": args.clone_static_cache,
         "max_new_tokens": args.clone_max_new_tokens,
         "temperature": args.clone_temperature,
         "top_p": args.clone_top_p,
@@ -1321,6 +2091,9 @@ def main() -> None:
         scenarios_per_iteration=args.scenarios_per_iteration,
         clone_settings=clone_settings,
         retriever=rag_retriever,
+        persistent_trainer=args.persistent_trainer,
+        max_concurrent_scenarios=args.max_concurrent_scenarios,
+        batch_judge_evaluations=args.judge_batch_evaluations,
     )
 
     if args.judge_only:
@@ -1337,10 +2110,7 @@ def main() -> None:
 
     report_path = args.experiment_root / "prompt_optimization_report.json"
     report_path.parent.mkdir(parents=True, exist_ok=True)
-    report_path.write_text(
-        json.dumps(summary_to_dict(summary), ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
+    write_artifact(report_path, summary_to_dict(summary))
 
     if summary.success:
         logging.info(
@@ -1,18 +1,37 @@
 from __future__ import annotations
 
+import contextlib
 import logging
+import os
+import threading
+from collections import OrderedDict
 from functools import lru_cache
-from typing import Iterable, List
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
 
 import numpy as np
 
+try:  # pragma: no cover - torch comes with sentence-transformers
+    import torch
+except ImportError:  # pragma: no cover
+    torch = None
+
 logger = logging.getLogger(__name__)
 
+INT8_EMBEDDINGS_FILE = "embeddings_int8.npy"
+INT8_SCALE_FILE = "embeddings_scale.npy"
+
 
 class EmbeddingBackend:
     """Thin wrapper around a sentence-transformers style model."""
 
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> None:
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        half_precision: Optional[bool] = None,
+        compile_model: Optional[bool] = None,
+        quantize_cpu: bool = False,
+    ) -> None:
         try:
             from sentence_transformers import SentenceTransformer  # type: ignore
         except ImportError as exc:  # pragma: no cover - optional dependency
@@ -24,24 +43,156 @@ class EmbeddingBackend:
         self.model_name = model_name
         logger.info("Loading embedding model %s", model_name)
         self.model = SentenceTransformer(model_name)
+        if half_precision is None:
+            half_precision = torch is not None and torch.cuda.is_available()
+        self.half_precision = bool(half_precision) and str(self.model.device).startswith("cuda")
+        if self.half_precision:
+            # fp16 halves weight/activation traffic on GPU; results are upcast on the way out.
+            self.model = self.model.half()
+        self.quantized = False
+        if quantize_cpu and not self.half_precision:
+            self._quantize_cpu()
         self.embedding_dim = int(getattr(self.model, "get_sentence_embedding_dimension", lambda: 0)())
+        # Fast tokenizers raise "Already borrowed" when one instance is used from several threads.
+        self._lock = threading.Lock()
+        # Judge questions and retrieval probes repeat across turns; the model is frozen, so rows are reusable.
+        self._cache: "OrderedDict[Tuple[str, bool], np.ndarray]" = OrderedDict()
+        self._cache_cap = 4096
+        if compile_model is None:
+            compile_model = os.getenv("AIVERA_COMPILE_EMBED", "0").strip().lower() in {"1", "true", "yes", "on"}
+        if compile_model:
+            self._compile()
 
-    def encode(self, texts: Iterable[str], normalize: bool = True) -> np.ndarray:
+    def _quantize_cpu(self) -> None:
+        if torch is None or str(self.model.device) != "cpu":
+            logger.info("Skipping int8 quantization for the embedder: model is not on CPU.")
+            return
+        try:
+            # Dynamic int8 Linear layers run on fbgemm (AVX2/AVX-512 VNNI); activations stay float.
+            torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            self.quantized = True
+            logger.info("Embedding model quantized to int8 for CPU inference.")
+        except Exception as exc:  # pragma: no cover - depends on torch build
+            logger.warning("int8 quantization for the embedder failed, staying float32: %s", exc)
+
+    def _compile(self) -> None:
+        if torch is None or not str(self.model.device).startswith("cuda"):
+            logger.info("Skipping torch.compile for the embedder: no CUDA device.")
+            return
+        eager_forward = self.model.forward
+        try:
+            # Batch size and sequence length vary per call, so compile with dynamic shapes.
+            self.model.forward = torch.compile(eager_forward, mode="max-autotune", dynamic=True)
+            # Pay the compilation cost here rather than on the first real query.
+            self.encode(["warmup"] * 2, use_cache=False)
+            logger.info("Embedding model forward compiled with torch.compile (max-autotune).")
+        except Exception as exc:  # pragma: no cover - depends on torch build and GPU
+            self.model.forward = eager_forward
+            logger.warning("torch.compile for the embedder failed, staying eager: %s", exc)
+
+    def encode(
+        self,
+        texts: Iterable[str],
+        normalize: bool = True,
+        batch_size: int = 128,
+        show_progress: bool = False,
+        use_cache: bool = True,
+    ) -> np.ndarray:
         texts_list: List[str] = [text if isinstance(text, str) else str(text) for text in texts]
         if not texts_list:
             dim = self.embedding_dim or 0
             return np.empty((0, dim), dtype=np.float32)
-        embeddings = self.model.encode(
-            texts_list,
-            convert_to_numpy=True,
-            normalize_embeddings=normalize,
-            show_progress_bar=True,
-        )
-        if not normalize:
-            return embeddings.astype(np.float32)
-        return embeddings
+        with self._lock:
+            if not use_cache:
+                return self._encode_locked(texts_list, normalize, batch_size, show_progress)
+            rows: List[Optional[np.ndarray]] = []
+            misses: "OrderedDict[str, None]" = OrderedDict()
+            for text in texts_list:
+                row = self._cache.get((text, normalize))
+                if row is not None:
+                    self._cache.move_to_end((text, normalize))
+                else:
+                    misses[text] = None
+                rows.append(row)
+            if misses:
+                encoded = self._encode_locked(list(misses), normalize, batch_size, show_progress)
+                fresh = dict(zip(misses, encoded))
+                for text, row in fresh.items():
+                    self._cache[(text, normalize)] = row
+                while len(self._cache) > self._cache_cap:
+                    self._cache.popitem(last=False)
+                rows = [fresh[text] if row is None else row for text, row in zip(texts_list, rows)]
+            return np.stack(rows)
+
+    def _encode_locked(
+        self,
+        texts_list: List[str],
+        normalize: bool,
+        batch_size: int,
+        show_progress: bool,
+    ) -> np.ndarray:
+        context = torch.inference_mode() if torch is not None else contextlib.nullcontext()
+        with context:
+            embeddings = self.model.encode(
+                texts_list,
+                batch_size=batch_size,
+                convert_to_tensor=True,
+                normalize_embeddings=normalize,
+                show_progress_bar=show_progress,
+            )
+            # Normalization already ran on the model device; cast before the single host copy.
+            embeddings = embeddings.to(torch.float32).cpu().numpy()
+        # Contiguous float32 lets the retriever matmul hit BLAS without another copy;
+        # numpy has no BLAS path for float16, so half precision stays on the GPU side.
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def quantize_int8(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization; returns (codes, scales) with one float32 scale per row."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scale = np.abs(embeddings).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(embeddings / scale[:, None]), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(codes, dtype=np.float32) * np.asarray(scale, dtype=np.float32)[:, None]
+
+
+def save_int8_embeddings(output_dir: Path, embeddings: np.ndarray) -> Tuple[Path, Path]:
+    codes, scale = quantize_int8(embeddings)
+    codes_path = output_dir / INT8_EMBEDDINGS_FILE
+    scale_path = output_dir / INT8_SCALE_FILE
+    np.save(codes_path, codes)
+    np.save(scale_path, scale)
+    return codes_path, scale_path
+
+
+def load_int8_codes(index_dir: Path) -> Tuple[np.ndarray, np.ndarray]:
+    # mmap keeps the cold load at a quarter of the float32 page-cache footprint.
+    codes = np.load(index_dir / INT8_EMBEDDINGS_FILE, mmap_mode="r")
+    scale = np.load(index_dir / INT8_SCALE_FILE)
+    if codes.ndim != 2 or scale.shape != (codes.shape[0],):
+        raise ValueError("Int8 embeddings must be [num_docs, dim] with one scale per row.")
+    return codes, scale
+
+
+def load_int8_embeddings(index_dir: Path) -> np.ndarray:
+    # numpy has no int8 GEMM, so the corpus is dequantized once for the float32 matmul.
+    return dequantize_int8(*load_int8_codes(index_dir))
 
 
 @lru_cache(maxsize=2)
-def get_embedding_backend(model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> EmbeddingBackend:
-    return EmbeddingBackend(model_name=model_name)
+def get_embedding_backend(
+    model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+    half_precision: Optional[bool] = None,
+    compile_model: Optional[bool] = None,
+    quantize_cpu: bool = False,
+) -> EmbeddingBackend:
+    return EmbeddingBackend(
+        model_name=model_name,
+        half_precision=half_precision,
+        compile_model=compile_model,
+        quantize_cpu=quantize_cpu,
+    )
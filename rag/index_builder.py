@@ -11,7 +11,7 @@ import numpy as np
 from datasets import load_dataset  # type: ignore
 
 from dataset_pipeline.core.utils import ensure_directory
-from .embeddings import get_embedding_backend
+from .embeddings import get_embedding_backend, save_int8_embeddings
 
 logger = logging.getLogger(__name__)
 
@@ -51,17 +51,28 @@ def load_records(path: Path) -> List[KnowledgeRecord]:
 def encode_records(records: Sequence[KnowledgeRecord], model_name: str) -> np.ndarray:
     backend = get_embedding_backend(model_name)
     texts = [record.content for record in records]
-    embeddings = backend.encode(texts, normalize=True)
+    embeddings = backend.encode(texts, normalize=True, show_progress=True, use_cache=False)
     logger.info("Embeddings shape: %s", embeddings.shape)
-    return embeddings.astype(np.float32)
+    # encode() already yields contiguous float32; asarray keeps that buffer instead of copying it.
+    return np.asarray(embeddings, dtype=np.float32)
 
 
-def save_index(output_dir: Path, embeddings: np.ndarray, records: Sequence[KnowledgeRecord]) -> None:
+def save_index(
+    output_dir: Path,
+    embeddings: np.ndarray,
+    records: Sequence[KnowledgeRecord],
+    int8: bool = False,
+) -> None:
     ensure_directory(output_dir)
     embeddings_path = output_dir / "embeddings.npy"
     metadata_path = output_dir / "records.jsonl"
 
-    np.save(embeddings_path, embeddings)
+    if int8:
+        save_int8_embeddings(output_dir, embeddings)
+        # The retriever prefers float32 when both exist, so drop a stale one.
+        embeddings_path.unlink(missing_ok=True)
+    else:
+        np.save(embeddings_path, embeddings)
     with metadata_path.open("w", encoding="utf-8") as handle:
         for record in records:
             payload = {
@@ -77,12 +88,13 @@ def build_index(
     knowledge_file: Path,
     output_dir: Path,
     model_name: str,
+    int8: bool = False,
 ) -> None:
     records = load_records(knowledge_file)
     if not records:
         raise ValueError(f"No knowledge records found in {knowledge_file}")
     embeddings = encode_records(records, model_name=model_name)
-    save_index(output_dir=output_dir, embeddings=embeddings, records=records)
+    save_index(output_dir=output_dir, embeddings=embeddings, records=records, int8=int8)
 
 
 def parse_args() -> argparse.Namespace:
@@ -104,6 +116,11 @@ def parse_args() -> argparse.Namespace:
         default="sentence-transformers/all-MiniLM-L6-v2",
         help="Sentence-transformers model id for embeddings.",
     )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Store embeddings as int8 with per-row scales (4x smaller on disk).",
+    )
     parser.add_argument(
         "--log-level",
         default="INFO",
@@ -127,6 +144,7 @@ def main() -> None:
         knowledge_file=args.knowledge_file,
         output_dir=args.output_dir,
         model_name=args.embedding_model,
+        int8=args.int8,
     )
 
 
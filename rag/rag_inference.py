@@ -3,51 +3,203 @@ from __future__ import annotations
 
 import argparse
 import logging
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BatchEncoding,
+    BitsAndBytesConfig,
+    TextIteratorStreamer,
+)
 
 from .retriever import KnowledgeRetriever, RetrievalResult
 
 logger = logging.getLogger(__name__)
 
+# With a static KV cache prompts are left-padded to power-of-two buckets starting here,
+# so the compiled decode graph is replayed instead of re-captured for every prompt length.
+STATIC_CACHE_MIN_BUCKET = 64
+# Rendered prompts are keyed by the full (role, content) sequence; the bot renders one per user turn,
+# so the cache has to cover many concurrent conversations, not just the CLI's single chat.
+PROMPT_RENDER_CACHE_SIZE = 2048
+
 
 def load_model(
     model_id: str,
     adapter_path: Path | None,
     load_in_4bit: bool = True,
     trust_remote_code: bool = True,
+    compile_model: bool = False,
+    merge_adapter: bool = False,
+    force_nf4: bool = False,
 ) -> tuple[AutoModelForCausalLM, AutoTokenizer]:
+    if torch.cuda.is_available():
+        # Remaining fp32 matmuls (LM head upcasts, norms) may use TF32 tensor cores.
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
     quant_config = None
+    # FA2/SDPA kernels run in half precision; bf16 also covers the non-quantized modules of bnb models.
+    dtype_kwargs: dict = {"attn_implementation": select_attn_implementation()}
+    if torch.cuda.is_available():
+        dtype_kwargs["torch_dtype"] = torch.bfloat16
     if load_in_4bit:
-        quant_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
+        mode = "nf4" if force_nf4 else select_quantization(model_id, trust_remote_code)
+        logger.info("Weight format for %s: %s", model_id, mode)
+        if mode == "nf4":
+            quant_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        elif mode == "int8":
+            quant_config = BitsAndBytesConfig(load_in_8bit=True)
+
+    if adapter_path and merge_adapter and quant_config is not None:
+        # LoRA cannot be folded into quantized weights directly: merge in bf16 once, cache the
+        # merged checkpoint next to the adapter and quantize that instead of the base.
+        merged_dir = merge_adapter_checkpoint(model_id, adapter_path, trust_remote_code)
+        logger.info("Loading merged model %s", merged_dir)
+        model = AutoModelForCausalLM.from_pretrained(
+            merged_dir,
+            device_map="auto",
+            quantization_config=quant_config,
+            trust_remote_code=trust_remote_code,
+            **dtype_kwargs,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(adapter_path, trust_remote_code=trust_remote_code)
+    else:
+        logger.info("Loading base model %s", model_id)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            device_map="auto",
+            quantization_config=quant_config,
+            trust_remote_code=trust_remote_code,
+            **dtype_kwargs,
         )
+        tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=trust_remote_code)
+
+        if adapter_path:
+            logger.info("Merging LoRA adapter from %s", adapter_path)
+            model = PeftModel.from_pretrained(model, adapter_path)
+            tokenizer = AutoTokenizer.from_pretrained(adapter_path, trust_remote_code=trust_remote_code)
+            if merge_adapter:
+                # Folding the adapter into the weights removes the LoRA side branch from every decode step.
+                model = model.merge_and_unload()
+
+    model = model.eval()
+    if hasattr(model.config, "use_cache"):
+        model.config.use_cache = True
+    if compile_model:
+        enable_static_compile(model, tokenizer)
+    return model, tokenizer
+
+
+def select_attn_implementation() -> str:
+    """FlashAttention-2 on Ampere+ when flash-attn is installed, PyTorch SDPA otherwise."""
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        try:
+            import flash_attn  # noqa: F401
+
+            return "flash_attention_2"
+        except ImportError:
+            logger.info("flash-attn is not installed, using SDPA attention.")
+    return "sdpa"
+
+
+def estimate_parameter_count(model_id: str, trust_remote_code: bool = True) -> int | None:
+    """Counts parameters on the meta device, without downloading or allocating weights."""
+    try:
+        from accelerate import init_empty_weights
+
+        config = AutoConfig.from_pretrained(model_id, trust_remote_code=trust_remote_code)
+        with init_empty_weights():
+            skeleton = AutoModelForCausalLM.from_config(config, trust_remote_code=trust_remote_code)
+        return sum(param.numel() for param in skeleton.parameters())
+    except Exception as exc:  # pragma: no cover - depends on model code
+        logger.debug("Could not estimate parameter count for %s: %s", model_id, exc)
+        return None
+
+
+def select_quantization(model_id: str, trust_remote_code: bool = True) -> str:
+    """Picks "bf16", "int8" or "nf4" for a memory-constrained load.
+
+    bnb NF4 has no hardware path and dequantizes to fp16 on every matmul, so it is only
+    chosen when nothing faster fits. 20% of VRAM stays reserved for the KV cache.
+    """
+    if not torch.cuda.is_available():
+        return "nf4"
+    num_params = estimate_parameter_count(model_id, trust_remote_code)
+    if num_params is None:
+        return "nf4"
+    budget = torch.cuda.get_device_properties(0).total_memory * 0.8
+    if num_params * 2 <= budget:
+        return "bf16"
+    if torch.cuda.get_device_capability() >= (8, 9) and num_params <= budget:
+        return "int8"
+    return "nf4"
+
 
-    logger.info("Loading base model %s", model_id)
-    model = AutoModelForCausalLM.from_pretrained(
+def merge_adapter_checkpoint(model_id: str, adapter_path: Path, trust_remote_code: bool = True) -> Path:
+    """Merges the adapter into a bf16 copy of the base model and caches it beside the adapter."""
+    merged_dir = adapter_path.parent / f"{adapter_path.name}_merged"
+    adapter_mtime = max((item.stat().st_mtime for item in adapter_path.iterdir()), default=0.0)
+    marker = merged_dir / "config.json"
+    if marker.exists() and marker.stat().st_mtime >= adapter_mtime:
+        return merged_dir
+
+    logger.info("Merging LoRA adapter %s into a bf16 copy of %s", adapter_path, model_id)
+    base = AutoModelForCausalLM.from_pretrained(
         model_id,
+        torch_dtype=torch.bfloat16,
         device_map="auto",
-        quantization_config=quant_config,
         trust_remote_code=trust_remote_code,
     )
-    tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=trust_remote_code)
+    merged = PeftModel.from_pretrained(base, adapter_path).merge_and_unload()
+    merged.save_pretrained(merged_dir, safe_serialization=True)
+    del merged, base
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return merged_dir
 
-    if adapter_path:
-        logger.info("Merging LoRA adapter from %s", adapter_path)
-        model = PeftModel.from_pretrained(model, adapter_path)
-        tokenizer = AutoTokenizer.from_pretrained(adapter_path, trust_remote_code=trust_remote_code)
 
-    model = model.eval()
-    if hasattr(model.config, "use_cache"):
-        model.config.use_cache = True
-    return model, tokenizer
+def prompt_bucket_length(length: int) -> int:
+    bucket = STATIC_CACHE_MIN_BUCKET
+    while bucket < length:
+        bucket *= 2
+    return bucket
+
+
+def enable_static_compile(model: AutoModelForCausalLM, tokenizer: AutoTokenizer) -> bool:
+    """Switches generation to a static KV cache with a compiled forward; falls back to eager on failure."""
+    if not torch.cuda.is_available():
+        logger.warning("Skipping torch.compile: static-cache decoding needs a CUDA device.")
+        return False
+    target = model.get_base_model() if isinstance(model, PeftModel) else model
+    if tokenizer.pad_token_id is None and tokenizer.eos_token_id is not None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = "left"
+    eager_forward = target.forward
+    try:
+        target.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=True)
+        target.generation_config.cache_implementation = "static"
+        # Graph capture happens on the first call; pay it here instead of on the first question.
+        generate_answer(model, tokenizer, [{"role": "user", "content": "warmup"}], max_new_tokens=8, do_sample=False)
+    except Exception as exc:  # pragma: no cover - depends on torch build and model code
+        target.forward = eager_forward
+        target.generation_config.cache_implementation = None
+        logger.warning("torch.compile with static cache failed, using eager decoding: %s", exc)
+        return False
+    logger.info("Static KV cache and compiled forward enabled.")
+    return True
 
 
 def format_context_snippets(snippets: List[RetrievalResult]) -> str:
@@ -81,6 +233,99 @@ def build_messages(
     ]
 
 
+def render_prompt(tokenizer: AutoTokenizer, messages: List[dict]) -> str:
+    """Applies the chat template, reusing the rendering for repeated (role, content) sequences."""
+    key = tuple((message["role"], message["content"]) for message in messages)
+    try:
+        return _render_prompt_cached(tokenizer, key)
+    except TypeError:
+        # Non-hashable (multimodal) content: render without the cache.
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+@lru_cache(maxsize=PROMPT_RENDER_CACHE_SIZE)
+def _render_prompt_cached(tokenizer: AutoTokenizer, messages: Tuple[Tuple[str, str], ...]) -> str:
+    return tokenizer.apply_chat_template(
+        [{"role": role, "content": content} for role, content in messages],
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+
+@lru_cache(maxsize=128)
+def _system_prefix_ids(tokenizer: AutoTokenizer, system_text: str) -> Optional[Tuple[str, Tuple[int, ...]]]:
+    """Renders and tokenizes a system block once; None when the template cannot be split there."""
+    try:
+        prefix_text = tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_text}],
+            tokenize=False,
+            add_generation_prompt=False,
+        )
+        probe_text = _render_prompt_cached(tokenizer, (("system", system_text), ("user", "?")))
+    except Exception:  # pragma: no cover - templates that reject a lone system turn
+        return None
+    if not probe_text.startswith(prefix_text):
+        return None
+    prefix_ids = tokenizer(prefix_text)["input_ids"]
+    suffix_ids = tokenizer(probe_text[len(prefix_text):], add_special_tokens=False)["input_ids"]
+    # Tokens may merge across the boundary; only split where it reproduces the joint tokenization.
+    if prefix_ids + suffix_ids != tokenizer(probe_text)["input_ids"]:
+        return None
+    return prefix_text, tuple(prefix_ids)
+
+
+def prompt_token_ids(tokenizer: AutoTokenizer, messages: List[dict]) -> List[int]:
+    """Token ids of a chat prompt, reusing cached ids of a repeated system block (RAG context)."""
+    prompt_text = render_prompt(tokenizer, messages)
+    system = messages[0] if messages else None
+    split = None
+    if system is not None and system["role"] == "system" and isinstance(system["content"], str):
+        split = _system_prefix_ids(tokenizer, system["content"])
+    if split is None or not prompt_text.startswith(split[0]):
+        return tokenizer(prompt_text)["input_ids"]
+    prefix_text, prefix_ids = split
+    return list(prefix_ids) + tokenizer(prompt_text[len(prefix_text):], add_special_tokens=False)["input_ids"]
+
+
+def tokenize_prompt(tokenizer: AutoTokenizer, messages: List[dict]) -> BatchEncoding:
+    input_ids = torch.tensor([prompt_token_ids(tokenizer, messages)], dtype=torch.long)
+    return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+
+def prepare_inputs(model: AutoModelForCausalLM, tokenizer: AutoTokenizer, messages: List[dict]) -> Any:
+    inputs = tokenize_prompt(tokenizer, messages)
+    generation_config = getattr(model, "generation_config", None)
+    if getattr(generation_config, "cache_implementation", None) == "static":
+        length = inputs["input_ids"].shape[-1]
+        pad = prompt_bucket_length(length) - length
+        if pad:
+            inputs["input_ids"] = F.pad(inputs["input_ids"], (pad, 0), value=tokenizer.pad_token_id)
+            inputs["attention_mask"] = F.pad(inputs["attention_mask"], (pad, 0), value=0)
+    device = torch.device(model.device)
+    if device.type != "cuda":
+        return inputs.to(device)
+    # Pinned host buffers let the H2D copy run asynchronously instead of syncing before prefill.
+    return BatchEncoding({key: value.pin_memory().to(device, non_blocking=True) for key, value in inputs.items()})
+
+
+def sampling_kwargs(
+    tokenizer: AutoTokenizer,
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    do_sample: bool,
+) -> Dict[str, Any]:
+    return {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": do_sample,
+        "temperature": temperature if do_sample else None,
+        "top_p": top_p if do_sample else None,
+        "top_k": top_k if do_sample else None,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+
+
 def generate_answer(
     model: AutoModelForCausalLM,
     tokenizer: AutoTokenizer,
@@ -91,25 +336,51 @@ def generate_answer(
     top_k: int = 40,
     do_sample: bool = True,
 ) -> str:
-    prompt_text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True,
-    )
-    inputs = tokenizer(prompt_text, return_tensors="pt").to(model.device)
+    inputs = prepare_inputs(model, tokenizer, messages)
     with torch.no_grad():
         output = model.generate(
             **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=do_sample,
-            temperature=temperature if do_sample else None,
-            top_p=top_p if do_sample else None,
-            top_k=top_k if do_sample else None,
+            **sampling_kwargs(tokenizer, max_new_tokens, temperature, top_p, top_k, do_sample),
         )
     generated = output[0][inputs["input_ids"].shape[-1]:]
     return tokenizer.decode(generated, skip_special_tokens=True).strip()
 
 
+def stream_answer(
+    model: AutoModelForCausalLM,
+    tokenizer: AutoTokenizer,
+    messages: List[dict],
+    max_new_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    top_k: int = 40,
+    do_sample: bool = True,
+) -> Iterator[str]:
+    """Yields decoded text chunks while generation runs on a background thread."""
+    inputs = prepare_inputs(model, tokenizer, messages)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    kwargs = sampling_kwargs(tokenizer, max_new_tokens, temperature, top_p, top_k, do_sample)
+    errors: List[BaseException] = []
+
+    def _run() -> None:
+        # no_grad is thread-local, so it has to be entered inside the worker thread.
+        try:
+            with torch.no_grad():
+                model.generate(**inputs, **kwargs, streamer=streamer)
+        except BaseException as exc:  # pragma: no cover - surfaced to the caller below
+            errors.append(exc)
+            streamer.end()
+
+    thread = threading.Thread(target=_run, name="rag-generate", daemon=True)
+    thread.start()
+    try:
+        yield from streamer
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Answer questions with retrieval-augmented generation.")
     parser.add_argument("question", nargs="?", help="Вопрос пользователя. Если не указан, будет интерактивный режим.")
@@ -132,7 +403,22 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--load-in-4bit",
         action="store_true",
-        help="Загрузить базовую модель в 4-битном режиме (рекомендуется при ограниченной памяти GPU).",
+        help="Экономить память GPU: bf16 или int8, если модель помещается, иначе 4-битный NF4 (см. --force-nf4).",
+    )
+    parser.add_argument(
+        "--force-nf4",
+        action="store_true",
+        help="С --load-in-4bit всегда использовать NF4 (по умолчанию выбирается bf16/int8, если помещается в GPU).",
+    )
+    parser.add_argument(
+        "--merge-adapter",
+        action="store_true",
+        help="Влить LoRA в веса при загрузке (быстрее декод; с --load-in-4bit слияние в bf16 кешируется рядом с адаптером).",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Статический KV-кэш + torch.compile для декода (первый запуск дольше из-за компиляции).",
     )
     parser.add_argument(
         "--index-dir",
@@ -145,6 +431,17 @@ def parse_args() -> argparse.Namespace:
         default="sentence-transformers/all-MiniLM-L6-v2",
         help="Модель для позиционирования запросов в векторном пространстве.",
     )
+    parser.add_argument(
+        "--embedding-dtype",
+        choices=["float32", "float16", "int8"],
+        default="float32",
+        help="Формат хранения эмбеддингов индекса в памяти (float16/int8 — в 2/4 раза меньше).",
+    )
+    parser.add_argument(
+        "--hnsw",
+        action="store_true",
+        help="Приближённый поиск через FAISS HNSW (нужен faiss-cpu; индекс кешируется рядом с embeddings).",
+    )
     parser.add_argument(
         "--top-k",
         type=int,
@@ -214,7 +511,8 @@ def interactive_loop(
             return
         snippets = retriever.search(question, k=top_k)
         messages = build_messages(system_prompt, question, snippets)
-        answer = generate_answer(
+        # Ответ печатается по мере генерации, а не после полного декода.
+        for chunk in stream_answer(
             model,
             tokenizer,
             messages,
@@ -223,8 +521,9 @@ def interactive_loop(
             top_p=sample_top_p,
             top_k=sample_top_k,
             do_sample=not greedy,
-        )
-        print(answer)
+        ):
+            print(chunk, end="", flush=True)
+        print()
         if snippets:
             print("---")
             for item in snippets:
@@ -241,12 +540,17 @@ def main() -> None:
     retriever = KnowledgeRetriever(
         index_dir=args.index_dir,
         embedding_model=args.embedding_model,
+        embedding_dtype=args.embedding_dtype,
+        use_hnsw=args.hnsw,
     )
     adapter_path = args.adapter_path if args.adapter_path.exists() else None
     model, tokenizer = load_model(
         model_id=args.model_id,
         adapter_path=adapter_path,
         load_in_4bit=args.load_in_4bit,
+        compile_model=args.compile,
+        merge_adapter=args.merge_adapter,
+        force_nf4=args.force_nf4,
     )
     if args.question:
         snippets = retriever.search(args.question, k=args.top_k)
@@ -4,14 +4,38 @@ import json
 import logging
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, List, Sequence, Tuple
+from typing import Iterable, List, Optional, Sequence, Tuple
 
 import numpy as np
 
-from .embeddings import get_embedding_backend
+try:  # pragma: no cover - optional ANN backend
+    import faiss  # type: ignore
+except ImportError:  # pragma: no cover
+    faiss = None
+
+from .embeddings import (
+    INT8_EMBEDDINGS_FILE,
+    INT8_SCALE_FILE,
+    dequantize_int8,
+    get_embedding_backend,
+    load_int8_codes,
+    load_int8_embeddings,
+    quantize_int8,
+)
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+# Compact corpora are scored in row blocks: each block is widened to float32 for the BLAS
+# GEMM (numpy has no fp16/int8 BLAS path) while the resident matrix stays 2-4x smaller.
+SCORE_BLOCK_ROWS = 4096
+HNSW_INDEX_FILE = "hnsw.faiss"
+HNSW_NEIGHBORS = 32
+HNSW_EF_SEARCH = 64
+# Queries are short; small encode groups keep padding per forward pass low.
+QUERY_BATCH_SIZE = 32
+NORMED_FP16_FILE = "embeddings_normed_fp16.npy"
+
 
 @dataclass
 class RetrievalResult:
@@ -33,6 +57,54 @@ def load_metadata(path: Path) -> List[dict]:
     return records
 
 
+def select_topk(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns [B, k] indices of the highest scores per row, best first."""
+    num_docs = scores.shape[1]
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.intp)
+    # Select from the top end instead of negating: no extra [B, N] copy per query batch.
+    if k >= num_docs:
+        return np.argsort(scores, axis=1)[:, ::-1]
+    top = np.argpartition(scores, kth=num_docs - k, axis=1)[:, num_docs - k:]
+    order = np.argsort(np.take_along_axis(scores, top, axis=1), axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
+def topk_similarity(query_mat: np.ndarray, corpus_mat: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Scores all queries against the corpus with one GEMM; returns ([B, k] top indices, [B, N] scores)."""
+    scores = query_mat @ corpus_mat.T
+    return select_topk(scores, k), scores
+
+
+def rows_normalized(embeddings: np.ndarray, atol: float = 1e-3) -> bool:
+    # einsum avoids the [N, dim] temporary that np.linalg.norm allocates.
+    squared = np.einsum("ij,ij->i", embeddings, embeddings, dtype=np.float32)
+    return bool(np.all(np.abs(squared - 1.0) <= atol))
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(embeddings / norms, dtype=np.float32)
+
+
+def load_normed_fp16(embeddings_path: Path) -> np.ndarray:
+    """Memory-maps a normalized fp16 copy of the corpus, writing it once next to the float32 file."""
+    normed_path = embeddings_path.with_name(NORMED_FP16_FILE)
+    if not normed_path.exists() or normed_path.stat().st_mtime < embeddings_path.stat().st_mtime:
+        source = np.load(embeddings_path, mmap_mode="r")
+        if source.ndim != 2:
+            raise ValueError("Embeddings file must be 2D array [num_docs, dim].")
+        logger.info("Writing normalized fp16 embeddings to %s", normed_path)
+        target = np.lib.format.open_memmap(normed_path, mode="w+", dtype=np.float16, shape=source.shape)
+        for start in range(0, source.shape[0], SCORE_BLOCK_ROWS):
+            stop = min(start + SCORE_BLOCK_ROWS, source.shape[0])
+            target[start:stop] = normalize_rows(source[start:stop])
+        target.flush()
+        del target
+    return np.load(normed_path, mmap_mode="r")
+
+
 class KnowledgeRetriever:
     """Lightweight in-memory retriever based on cosine similarity."""
 
@@ -40,50 +112,130 @@ class KnowledgeRetriever:
         self,
         index_dir: Path = Path("data/rag_index"),
         embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+        embedding_dtype: str = "float32",
+        use_hnsw: bool = False,
+        half_precision: Optional[bool] = None,
+        compile_embedder: Optional[bool] = None,
+        quantize_embedder: bool = False,
     ) -> None:
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype {embedding_dtype!r}; expected one of {EMBEDDING_DTYPES}.")
         embeddings_path = index_dir / "embeddings.npy"
         metadata_path = index_dir / "records.jsonl"
-        if not embeddings_path.exists() or not metadata_path.exists():
+        has_int8 = (index_dir / INT8_EMBEDDINGS_FILE).exists() and (index_dir / INT8_SCALE_FILE).exists()
+        if not (embeddings_path.exists() or has_int8) or not metadata_path.exists():
             raise FileNotFoundError(
                 f"Index not found in {index_dir}. Run build_index.py to generate embeddings first."
             )
 
         logger.info("Loading RAG index from %s", index_dir)
-        self.embeddings = np.load(embeddings_path)
-        if self.embeddings.ndim != 2:
-            raise ValueError("Embeddings file must be 2D array [num_docs, dim].")
+        self.embedding_dtype = embedding_dtype
+        self.scales: np.ndarray | None = None
+        if embedding_dtype == "int8" and not embeddings_path.exists():
+            # Rows were normalized before quantization: keep the on-disk codes as they are.
+            self.embeddings, self.scales = load_int8_codes(index_dir)
+        elif embedding_dtype == "float16" and embeddings_path.exists():
+            self.embeddings = load_normed_fp16(embeddings_path)
+        else:
+            if embeddings_path.exists():
+                # mmap: startup does not wait for the whole matrix and the pages are shared across processes.
+                self.embeddings = np.load(embeddings_path, mmap_mode="r")
+            else:
+                logger.info("Using int8-quantized embeddings.")
+                self.embeddings = load_int8_embeddings(index_dir)
+            if self.embeddings.ndim != 2:
+                raise ValueError("Embeddings file must be 2D array [num_docs, dim].")
+            # build_index already stores unit rows; only copy when the file is not normalized.
+            if not rows_normalized(self.embeddings):
+                self.embeddings = normalize_rows(self.embeddings)
+            if embedding_dtype == "float16":
+                self.embeddings = self.embeddings.astype(np.float16)
+            elif embedding_dtype == "int8":
+                self.embeddings, self.scales = quantize_int8(self.embeddings)
         self.metadata = load_metadata(metadata_path)
         if len(self.metadata) != self.embeddings.shape[0]:
             raise ValueError("Embeddings count does not match metadata entries.")
-
-        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
-        norms[norms == 0] = 1.0
-        self.embeddings = self.embeddings / norms
-        self.backend = get_embedding_backend(embedding_model)
+        # Column views of the metadata keep dict lookups out of the per-query result loop.
+        self._contents = [meta.get("content", "") for meta in self.metadata]
+        self._sources = [meta.get("source") for meta in self.metadata]
+        self._metas = [meta.get("metadata") for meta in self.metadata]
+        self.hnsw = self._load_hnsw(index_dir) if use_hnsw else None
+        # None lets the backend pick fp16 whenever the embedder lives on a CUDA device.
+        self.backend = get_embedding_backend(
+            embedding_model,
+            half_precision=half_precision,
+            compile_model=compile_embedder,
+            quantize_cpu=quantize_embedder,
+        )
+
+    def _load_hnsw(self, index_dir: Path):
+        if faiss is None:
+            raise RuntimeError("faiss is required for HNSW search. Install via `pip install faiss-cpu`.")
+        index_path = index_dir / HNSW_INDEX_FILE
+        sources = [path for path in (index_dir / "embeddings.npy", index_dir / INT8_EMBEDDINGS_FILE) if path.exists()]
+        source_mtime = max(path.stat().st_mtime for path in sources)
+        if index_path.exists() and index_path.stat().st_mtime >= source_mtime:
+            index = faiss.read_index(str(index_path))
+            if index.ntotal == self.embeddings.shape[0]:
+                index.hnsw.efSearch = HNSW_EF_SEARCH
+                logger.info("Loaded HNSW index from %s", index_path)
+                return index
+        if self.scales is not None:
+            dense = dequantize_int8(self.embeddings, self.scales)
+        else:
+            dense = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        logger.info("Building HNSW index over %d documents", dense.shape[0])
+        index = faiss.IndexHNSWFlat(dense.shape[1], HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+        index.add(dense)
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        faiss.write_index(index, str(index_path))
+        return index
 
     def search(self, query: str, k: int = 4) -> List[RetrievalResult]:
-        if not query.strip():
-            return []
-        query_vec = self.backend.encode([query], normalize=True)[0]
-        scores = self.embeddings @ query_vec
-        if k >= len(scores):
-            top_indices = np.argsort(-scores)
+        return self.batch_search([query], k=k)[0]
+
+    def batch_search(self, queries: Sequence[str], k: int = 4) -> List[List[RetrievalResult]]:
+        """Searches several queries with one embedding forward pass and one similarity GEMM."""
+        results: List[List[RetrievalResult]] = [[] for _ in queries]
+        positions = [idx for idx, query in enumerate(queries) if query.strip()]
+        if not positions or k <= 0:
+            return results
+        # Stripped text is the embedding-cache key, so whitespace variants of a question hit it too.
+        # sentence-transformers length-sorts every encode call and restores the order itself,
+        # so the groups below are already packed with minimal padding.
+        query_mat = self.backend.encode(
+            [queries[idx].strip() for idx in positions],
+            normalize=True,
+            batch_size=QUERY_BATCH_SIZE,
+        )
+        if self.hnsw is not None:
+            top_scores, top = self.hnsw.search(query_mat, k)
         else:
-            top_indices = np.argpartition(-scores, kth=k - 1)[:k]
-            top_indices = top_indices[np.argsort(-scores[top_indices])]
-
-        results: List[RetrievalResult] = []
-        for idx in top_indices:
-            meta = self.metadata[idx] if idx < len(self.metadata) else {}
-            results.append(
-                RetrievalResult(
-                    content=meta.get("content", ""),
-                    source=meta.get("source"),
-                    metadata=meta.get("metadata"),
-                    score=float(scores[idx]),
-                )
-            )
+            if self.embedding_dtype == "float32":
+                top, scores = topk_similarity(query_mat, self.embeddings, k)
+            else:
+                scores = self._score_blocked(query_mat)
+                top = select_topk(scores, k)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+        for row, idx in enumerate(positions):
+            results[idx] = self._build_results(top[row], top_scores[row])
         return results
 
-    def batch_search(self, queries: Sequence[str], k: int = 4) -> List[List[RetrievalResult]]:
-        return [self.search(query, k=k) for query in queries]
+    def _score_blocked(self, query_mat: np.ndarray) -> np.ndarray:
+        num_docs = self.embeddings.shape[0]
+        scores = np.empty((query_mat.shape[0], num_docs), dtype=np.float32)
+        for start in range(0, num_docs, SCORE_BLOCK_ROWS):
+            stop = min(start + SCORE_BLOCK_ROWS, num_docs)
+            block = self.embeddings[start:stop].astype(np.float32)
+            np.matmul(query_mat, block.T, out=scores[:, start:stop])
+            if self.scales is not None:
+                scores[:, start:stop] *= self.scales[start:stop]
+        return scores
+
+    def _build_results(self, top_indices: np.ndarray, top_scores: np.ndarray) -> List[RetrievalResult]:
+        # FAISS pads missing neighbours with -1; tolist() converts every score in one call.
+        hits = [(idx, score) for idx, score in zip(top_indices.tolist(), top_scores.tolist()) if idx >= 0]
+        return [
+            RetrievalResult(content=self._contents[idx], source=self._sources[idx], metadata=self._metas[idx], score=score)
+            for idx, score in hits
+        ]
@@ -110,6 +110,7 @@ class Config:
     sleep_between_requests: float
     max_retries: int
     request_timeout: int
+    concurrency: int = 4
 
     @classmethod
     def from_env(cls) -> "Config":
@@ -133,6 +134,7 @@ class Config:
             sleep_between_requests=float(os.getenv("SLEEP_BETWEEN_REQUESTS", "2.0")),
             max_retries=int(os.getenv("MAX_RETRIES", "3")),
             request_timeout=int(os.getenv("REQUEST_TIMEOUT", "120")),
+            concurrency=int(os.getenv("CONCURRENCY", "4")),
         )
 
     def with_overrides(self, **overrides) -> "Config":
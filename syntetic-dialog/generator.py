@@ -1,19 +1,32 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import json
 import logging
+import os
 import random
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict, dataclass
 from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 from bs4 import BeautifulSoup  # type: ignore
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+try:  # pragma: no cover - быстрый JSON на C, необязателен
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # pragma: no cover - ускоритель разбора HTML, необязателен
+    from selectolax.lexbor import LexborHTMLParser  # type: ignore
+except ImportError:  # pragma: no cover
+    LexborHTMLParser = None
 
 # Позволяем импортировать config.py, даже если есть одноимённый модуль в корне репо.
 CURRENT_DIR = Path(__file__).resolve().parent
@@ -26,6 +39,11 @@ logger = logging.getLogger("syntetic-dialog")
 
 INTERMEDIATE_SAVE_EVERY = 10
 
+FENCED_JSON_PATTERN = re.compile(r"```(?:json)?\s*(.+?)\s*```", re.DOTALL | re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# Разрыв строки вместе с пробелами вокруг; набор символов совпадает с str.splitlines().
+LINE_BREAK_PATTERN = re.compile(r"\s*[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]\s*")
+
 # ---------- Data structures -------------------------------------------------
 
 
@@ -58,23 +76,38 @@ class DataLoader:
             logger.warning("Папка с примерами %s не найдена", self.raw_path)
             return examples
 
-        for file_path in sorted(self.raw_path.rglob("*")):
-            if len(examples) >= limit:
-                break
-            if not file_path.is_file() or file_path.suffix.lower() not in self.SUPPORTED_EXTENSIONS:
-                continue
-
-            try:
-                example = self._parse_file(file_path)
-            except Exception as exc:  # pragma: no cover - лог для отладки
-                logger.debug("Не удалось распарсить %s: %s", file_path, exc)
-                continue
+        # Сначала дешёвый фильтр по расширению, stat — только для подходящих путей.
+        candidates = [
+            file_path
+            for file_path in sorted(self.raw_path.rglob("*"))
+            if file_path.suffix.lower() in self.SUPPORTED_EXTENSIONS and file_path.is_file()
+        ]
+        if limit <= 0 or not candidates:
+            return examples
 
-            if example:
-                examples.append(example)
+        # Чтение и разбор файлов упираются в I/O — параллелим пачками. map сохраняет порядок,
+        # поэтому берутся те же первые `limit` примеров, что и при последовательном обходе.
+        workers = min(32, (os.cpu_count() or 1) + 4)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            start = 0
+            while start < len(candidates) and len(examples) < limit:
+                batch = candidates[start : start + max(workers, limit - len(examples))]
+                start += len(batch)
+                for example in pool.map(self._safe_parse_file, batch):
+                    if example:
+                        examples.append(example)
+                        if len(examples) >= limit:
+                            break
 
         return examples
 
+    def _safe_parse_file(self, file_path: Path) -> Optional[DialogueExample]:
+        try:
+            return self._parse_file(file_path)
+        except Exception as exc:  # pragma: no cover - лог для отладки
+            logger.debug("Не удалось распарсить %s: %s", file_path, exc)
+            return None
+
     def _parse_file(self, file_path: Path) -> Optional[DialogueExample]:
         suffix = file_path.suffix.lower()
         if suffix in {".html", ".htm"}:
@@ -85,6 +118,40 @@ class DataLoader:
 
     def _parse_html_dialogue(self, file_path: Path) -> Optional[DialogueExample]:
         text = file_path.read_text(encoding="utf-8", errors="ignore")
+        if LexborHTMLParser is not None:
+            segments = self._html_segments_lexbor(text)
+        else:
+            segments = self._html_segments_bs4(text)
+
+        dialogue = "\n".join(segments).strip()
+        if not dialogue:
+            return None
+        return DialogueExample(source=file_path.name, content=dialogue)
+
+    @staticmethod
+    def _html_segments_lexbor(text: str) -> List[str]:
+        # lexbor разбирает HTML на C в разы быстрее html.parser; селекторы те же.
+        tree = LexborHTMLParser(text)
+        segments: List[str] = []
+        for message in tree.css("div.message"):
+            if "service" in (message.attributes.get("class") or "").split():
+                continue
+            payload = message.css_first("div.text")
+            if payload is None:
+                continue
+            speaker_node = message.css_first("div.from_name")
+            speaker = speaker_node.text(separator=" ", strip=True) if speaker_node else ""
+            # Как get_text("\n", strip=True): пустые текстовые узлы не дают лишних строк.
+            content = "\n".join(line for line in payload.text(separator="\n", strip=True).split("\n") if line)
+            if not content:
+                continue
+            if not speaker:
+                speaker = "user" if len(segments) % 2 == 0 else "assistant"
+            segments.append(f"{speaker}: {content}")
+        return segments
+
+    @staticmethod
+    def _html_segments_bs4(text: str) -> List[str]:
         soup = BeautifulSoup(text, "html.parser")
         segments: List[str] = []
 
@@ -102,11 +169,7 @@ class DataLoader:
             if not speaker:
                 speaker = "user" if len(segments) % 2 == 0 else "assistant"
             segments.append(f"{speaker}: {content}")
-
-        dialogue = "\n".join(segments).strip()
-        if not dialogue:
-            return None
-        return DialogueExample(source=file_path.name, content=dialogue)
+        return segments
 
     def _parse_textual_dialogue(self, file_path: Path) -> Optional[DialogueExample]:
         content = file_path.read_text(encoding="utf-8", errors="ignore").strip()
@@ -146,14 +209,33 @@ class PromptBuilder:
 # ---------- Dialogue generator ---------------------------------------------
 
 
+class RequestSpacer:
+    """Общий для всех задач лимитер: старты запросов разнесены минимум на `interval` секунд."""
+
+    def __init__(self, interval: float):
+        self.interval = max(0.0, interval)
+        self._lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def wait(self) -> None:
+        if self.interval <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
 class DialogueGenerator:
     def __init__(self, config: Config):
         self.config = config
-        self.client = OpenAI(base_url=config.base_url, api_key=config.api_key)
+        self.client = AsyncOpenAI(base_url=config.base_url, api_key=config.api_key)
 
-    def generate(self, system_prompt: str) -> Optional[Dict[str, Any]]:
+    async def generate(self, system_prompt: str) -> Optional[Dict[str, Any]]:
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.config.model,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -174,14 +256,14 @@ class DialogueGenerator:
         content = response.choices[0].message.content.strip()
         payload = self._extract_json_block(content)
         try:
-            return json.loads(payload)
-        except json.JSONDecodeError as exc:
+            return orjson.loads(payload) if orjson is not None else json.loads(payload)
+        except json.JSONDecodeError as exc:  # orjson.JSONDecodeError — его подкласс
             logger.warning("Не удалось распарсить JSON: %s\n%s", exc, payload[:500])
             return None
 
     @staticmethod
     def _extract_json_block(text: str) -> str:
-        fenced = re.search(r"```(?:json)?\s*(.+?)\s*```", text, flags=re.DOTALL | re.IGNORECASE)
+        fenced = FENCED_JSON_PATTERN.search(text)
         if fenced:
             return fenced.group(1).strip()
         start = text.find("{")
@@ -249,12 +331,12 @@ class DataNormalizer:
 
     @staticmethod
     def _clean_multiline(text: str) -> str:
-        lines = [line.strip() for line in (text or "").splitlines()]
-        return "\n".join(line for line in lines if line)
+        # Один проход regex: обрезает строки и выкидывает пустые без промежуточного списка.
+        return LINE_BREAK_PATTERN.sub("\n", text or "").strip()
 
     @staticmethod
     def _clean_single_line(text: str) -> str:
-        return " ".join((text or "").split()).strip()
+        return WHITESPACE_PATTERN.sub(" ", text or "").strip()
 
     def _normalize_messages(self, messages: Any) -> List[Dict[str, Any]]:
         normalized: List[Dict[str, Any]] = []
@@ -296,7 +378,8 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--model", help="Имя модели (по умолчанию gpt-4o-mini).")
     parser.add_argument("--temperature", type=float, help="Температура выборки.")
     parser.add_argument("--max-tokens", type=int, help="Максимум токенов ответа.")
-    parser.add_argument("--sleep", type=float, help="Пауза между запросами (сек).")
+    parser.add_argument("--sleep", type=float, help="Минимальный интервал между стартами запросов (сек).")
+    parser.add_argument("--concurrency", type=int, help="Сколько запросов к API выполнять одновременно.")
     parser.add_argument("--max-retries", type=int, help="Сколько раз повторять генерацию при неудаче.")
     parser.add_argument("--log-level", default="INFO", help="Уровень логирования (DEBUG, INFO, ...).")
     return parser.parse_args()
@@ -310,6 +393,10 @@ def configure_logging(level: str) -> None:
 
 
 def save_jsonl(path: Path, items: List[Dict[str, Any]]) -> None:
+    if orjson is not None:
+        # orjson пишет UTF-8 без экранирования кириллицы, как ensure_ascii=False.
+        path.write_bytes(b"".join(orjson.dumps(item) + b"\n" for item in items))
+        return
     with path.open("w", encoding="utf-8") as file:
         for item in items:
             file.write(json.dumps(item, ensure_ascii=False) + "\n")
@@ -322,7 +409,11 @@ def save_report(path: Path, stats: Dict[str, Any], config: Config, examples: Lis
         "examples_used": [example.source for example in examples],
         "generated_at": datetime.utcnow().isoformat(),
     }
-    path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    # default=str — для Path в конфиге.
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(report, default=str, option=orjson.OPT_INDENT_2))
+        return
+    path.write_text(json.dumps(report, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
 
 
 def main() -> None:
@@ -343,6 +434,7 @@ def main() -> None:
         max_tokens=args.max_tokens,
         sleep_between_requests=args.sleep,
         max_retries=args.max_retries,
+        concurrency=args.concurrency,
     )
 
     if not config.api_key:
@@ -350,7 +442,10 @@ def main() -> None:
         raise SystemExit(1)
 
     config.output_path.mkdir(parents=True, exist_ok=True)
+    asyncio.run(run_generation(config, args.role_instruction))
 
+
+async def run_generation(config: Config, role_instruction: Optional[str]) -> None:
     loader = DataLoader(config.raw_data_path)
     examples = loader.load_examples(config.example_limit)
     prompt_builder = PromptBuilder(config.min_messages)
@@ -372,40 +467,49 @@ def main() -> None:
     timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
     output_file = config.output_path / f"synthetic_{config.role}_{timestamp}.jsonl"
 
-    for idx in range(config.num_conversations):
-        example = random.choice(examples) if examples else None
-        system_prompt = prompt_builder.build(config.role, args.role_instruction, example)
-
-        logger.info("Генерация диалога %s/%s...", idx + 1, config.num_conversations)
-        success = False
-        for attempt in range(1, config.max_retries + 1):
-            logger.debug("Попытка %s для диалога %s", attempt, idx + 1)
-            dialogue = generator.generate(system_prompt)
-            if dialogue is None:
-                stats["failed_calls"] += 1
-                time.sleep(config.sleep_between_requests)
-                continue
-
-            errors = validator.validate(dialogue)
-            if errors:
-                stats["invalid"] += 1
-                logger.warning("Валидация провалена: %s", "; ".join(errors))
-                time.sleep(config.sleep_between_requests)
-                continue
-
-            normalized = normalizer.normalize(dialogue)
-            dialogues.append(normalized)
-            stats["generated"] += 1
-            if len(dialogues) % INTERMEDIATE_SAVE_EVERY == 0:
-                save_jsonl(output_file, dialogues)
-                logger.info("Промежуточное сохранение %s диалогов в %s", len(dialogues), output_file)
-            success = True
-            break
+    # Запросы идут параллельно (не больше config.concurrency одновременно), а пауза между
+    # ними — общий интервал между стартами, а не sleep после каждого ответа.
+    semaphore = asyncio.Semaphore(max(1, config.concurrency))
+    spacer = RequestSpacer(config.sleep_between_requests)
+    save_lock = asyncio.Lock()
+
+    async def produce(idx: int, system_prompt: str) -> None:
+        async with semaphore:
+            logger.info("Генерация диалога %s/%s...", idx + 1, config.num_conversations)
+            for attempt in range(1, config.max_retries + 1):
+                logger.debug("Попытка %s для диалога %s", attempt, idx + 1)
+                await spacer.wait()
+                dialogue = await generator.generate(system_prompt)
+                if dialogue is None:
+                    stats["failed_calls"] += 1
+                    continue
+
+                errors = validator.validate(dialogue)
+                if errors:
+                    stats["invalid"] += 1
+                    logger.warning("Валидация провалена: %s", "; ".join(errors))
+                    continue
+
+                normalized = normalizer.normalize(dialogue)
+                async with save_lock:
+                    dialogues.append(normalized)
+                    stats["generated"] += 1
+                    if len(dialogues) % INTERMEDIATE_SAVE_EVERY == 0:
+                        save_jsonl(output_file, dialogues)
+                        logger.info("Промежуточное сохранение %s диалогов в %s", len(dialogues), output_file)
+                return
 
-        if not success:
             logger.error("Не удалось получить валидный диалог #%s", idx + 1)
 
-        time.sleep(config.sleep_between_requests)
+    # Промпты собираются заранее в порядке диалогов, чтобы выбор примеров не зависел от гонок.
+    prompts = [
+        prompt_builder.build(config.role, role_instruction, random.choice(examples) if examples else None)
+        for _ in range(config.num_conversations)
+    ]
+    try:
+        await asyncio.gather(*(produce(idx, prompt) for idx, prompt in enumerate(prompts)))
+    finally:
+        await generator.client.close()
 
     stats["finished_at"] = datetime.utcnow().isoformat()
     stats["success_rate"] = round(
@@ -3,23 +3,28 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
+import threading
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence
-from urllib.parse import urlparse
+from typing import Any, AsyncIterator, Callable, Dict, List, Literal, Optional, Sequence, Tuple, get_args
+from uuid import uuid4
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import CommandStart
 from aiogram.types import Message
 from aiogram.client.bot import DefaultBotProperties
 
-import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+from transformers.generation.streamers import BaseStreamer
 
 try:  # Загрузка переменных окружения из .env, если пакет доступен.
     from dotenv import load_dotenv
@@ -28,7 +33,7 @@ try:  # Загрузка переменных окружения из .env, ес
 except ImportError:  # pragma: no cover - пакет опционален
     pass
 
-from rag.rag_inference import load_model
+from rag.rag_inference import load_model, prompt_bucket_length, prompt_token_ids, render_prompt
 from rag.retriever import KnowledgeRetriever, RetrievalResult
 
 try:
@@ -41,8 +46,31 @@ try:
 except ImportError:  # pragma: no cover - fakeredis не обязателен
     FakeAsyncRedis = None
 
+try:  # pragma: no cover - быстрый JSON на C, необязателен
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # pragma: no cover - ускоренный event loop на libuv, необязателен
+    import uvloop  # type: ignore
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+try:
+    from transformers import AutoTokenizer
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+    from vllm.lora.request import LoRARequest
+except ImportError:  # pragma: no cover - vLLM нужен только для INFERENCE_BACKEND=vllm
+    AsyncLLMEngine = None
+
 logger = logging.getLogger(__name__)
 
+# auto — bf16/int8/NF4 по объёму VRAM (rag.rag_inference.select_quantization);
+# awq/gptq — готовый квантованный чекпоинт в MODEL_ID (например, Qwen/Qwen2.5-7B-Instruct-AWQ);
+# fp8 — только vLLM; bnb4 — bitsandbytes NF4; none — веса без квантизации.
+Quantization = Literal["auto", "awq", "gptq", "fp8", "bnb4", "none"]
+QUANTIZATION_MODES = get_args(Quantization)
+
 
 @dataclass(slots=True)
 class BotConfig:
@@ -59,17 +87,43 @@ class BotConfig:
     )
     redis_url: str = "redis://localhost:6379/0"
     redis_namespace: str = "billy-clone"
-    redis_ttl_seconds: int = 24 * 60 * 60
+    # Живые диалоги затухают за несколько часов; дольше хранить историю незачем.
+    redis_ttl_seconds: int = 6 * 60 * 60
+    # Потолок памяти Redis с вытеснением allkeys-lru (например "256mb"); пусто — не трогаем настройки сервера.
+    redis_maxmemory: str = ""
+    # Одно вставленное длинное сообщение не должно занимать всю историю.
+    max_message_chars: int = 2000
     max_history_messages: int = 10  # Храним последние 10 сообщений (5 пар)
+    # Кэш готовых ответов на повторные вопросы; 0 — выключен.
+    cache_ttl_seconds: int = 60 * 60
+    cache_history_turns: int = 2
 
     model_id: str = "Qwen/Qwen2.5-7B-Instruct"
     adapter_path: Path = Path("outputs/dpo_adapter")
-    load_in_4bit: bool = True
+    quantization: Quantization = "auto"
     trust_remote_code: bool = True
+    # "hf" — transformers.generate, "vllm" — AsyncLLMEngine с continuous batching.
+    inference_backend: str = "hf"
+    max_model_len: int = 8192
+    gpu_memory_utilization: float = 0.9
+    max_lora_rank: int = 64
+    # vLLM переиспользует KV-блоки общего префикса (системный промпт + история) между запросами.
+    enable_prefix_caching: bool = True
+    # HF-бэкенд: статический KV-кэш + torch.compile(reduce-overhead), декод идёт повторами CUDA-графа.
+    enable_cuda_graphs: bool = False
+    # Микробатчинг HF-бэкенда: ждём соседние запросы не дольше batch_max_wait_ms.
+    batch_max_size: int = 8
+    batch_max_wait_ms: float = 20.0
+    # Стриминг ответа правками одного сообщения не чаще раза в stream_edit_interval секунд:
+    # Telegram режет частые правки одного сообщения (flood control), поэтому по умолчанию раз в секунду.
+    stream_replies: bool = True
+    stream_edit_interval: float = 1.0
 
     index_dir: Path = Path("data/rag_index")
     embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
     rag_top_k: int = 4
+    # torch.compile для эмбеддера запросов (CUDA); None — по AIVERA_COMPILE_EMBED.
+    compile_embedder: Optional[bool] = None
 
     max_new_tokens: int = 512
     temperature: float = 0.83
@@ -100,14 +154,31 @@ class BotConfig:
             redis_url=os.getenv("REDIS_URL", _get_default("redis_url")),
             redis_namespace=os.getenv("REDIS_NAMESPACE", _get_default("redis_namespace")),
             redis_ttl_seconds=int(os.getenv("REDIS_TTL_SECONDS", _get_default("redis_ttl_seconds"))),
+            redis_maxmemory=os.getenv("REDIS_MAXMEMORY", _get_default("redis_maxmemory")).strip(),
+            max_message_chars=int(os.getenv("MAX_MESSAGE_CHARS", _get_default("max_message_chars"))),
             max_history_messages=int(os.getenv("MAX_HISTORY_MESSAGES", _get_default("max_history_messages"))),
+            cache_ttl_seconds=int(os.getenv("CACHE_TTL_SECONDS", _get_default("cache_ttl_seconds"))),
+            cache_history_turns=int(os.getenv("CACHE_HISTORY_TURNS", _get_default("cache_history_turns"))),
             model_id=os.getenv("MODEL_ID", _get_default("model_id")),
             adapter_path=adapter_path,
-            load_in_4bit=_as_bool(os.getenv("LOAD_IN_4BIT"), _get_default("load_in_4bit")),
+            quantization=_quantization_from_env(_get_default("quantization")),
             trust_remote_code=_as_bool(os.getenv("TRUST_REMOTE_CODE"), _get_default("trust_remote_code")),
+            inference_backend=os.getenv("INFERENCE_BACKEND", _get_default("inference_backend")).strip().lower(),
+            max_model_len=int(os.getenv("MAX_MODEL_LEN", _get_default("max_model_len"))),
+            gpu_memory_utilization=float(os.getenv("GPU_MEMORY_UTILIZATION", _get_default("gpu_memory_utilization"))),
+            max_lora_rank=int(os.getenv("MAX_LORA_RANK", _get_default("max_lora_rank"))),
+            enable_prefix_caching=_as_bool(os.getenv("ENABLE_PREFIX_CACHING"), _get_default("enable_prefix_caching")),
+            enable_cuda_graphs=_as_bool(os.getenv("ENABLE_CUDA_GRAPHS"), _get_default("enable_cuda_graphs")),
+            batch_max_size=int(os.getenv("BATCH_MAX_SIZE", _get_default("batch_max_size"))),
+            batch_max_wait_ms=float(os.getenv("BATCH_MAX_WAIT_MS", _get_default("batch_max_wait_ms"))),
+            stream_replies=_as_bool(os.getenv("STREAM_REPLIES"), _get_default("stream_replies")),
+            stream_edit_interval=float(os.getenv("STREAM_EDIT_INTERVAL", _get_default("stream_edit_interval"))),
             index_dir=index_dir,
             embedding_model=os.getenv("EMBEDDING_MODEL", _get_default("embedding_model")),
             rag_top_k=int(os.getenv("RAG_TOP_K", _get_default("rag_top_k"))),
+            compile_embedder=(
+                _as_bool(os.getenv("COMPILE_EMBEDDER"), False) if os.getenv("COMPILE_EMBEDDER") is not None else None
+            ),
             max_new_tokens=int(os.getenv("MAX_NEW_TOKENS", _get_default("max_new_tokens"))),
             temperature=float(os.getenv("TEMPERATURE", _get_default("temperature"))),
             sample_top_p=float(os.getenv("SAMPLE_TOP_P", _get_default("sample_top_p"))),
@@ -116,41 +187,63 @@ class BotConfig:
         )
 
 
-def create_redis_client(redis_url: str) -> tuple[Any, bool]:
-    """Возвращает подключение к Redis или его in-memory замену.
+def dump_json(payload: Any) -> bytes | str:
+    """UTF-8 JSON без \\u-экранирования кириллицы; orjson, если установлен."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False)
 
-    Возвращает кортеж (client, is_real_redis).
-    """
 
-    def _check_socket(host: str, port: int) -> bool:
-        try:
-            with socket.create_connection((host, port), timeout=1.0):
-                return True
-        except OSError:
-            return False
-
-    if AsyncRedis is not None:
-        parsed = urlparse(redis_url)
-        host = parsed.hostname or "localhost"
-        port = parsed.port or 6379
-
-        if _check_socket(host, port):
-            logger.info("✅ Используется настоящий Redis (%s:%s)", host, port)
-            return AsyncRedis.from_url(redis_url, decode_responses=True), True
-        logger.warning(
-            "Redis недоступен по адресу %s:%s — переключаемся на FakeRedis, если доступен.",
-            host,
-            port,
+def load_json(raw: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _quantization_from_env(default: str) -> str:
+    value = os.getenv("QUANTIZATION")
+    if value is None:
+        # Совместимость со старым флагом LOAD_IN_4BIT.
+        legacy = os.getenv("LOAD_IN_4BIT")
+        if legacy is None:
+            return default
+        return "auto" if legacy.lower() in {"1", "true", "yes", "y", "on"} else "none"
+    value = value.strip().lower()
+    if value not in QUANTIZATION_MODES:
+        raise ValueError(f"Неизвестный QUANTIZATION={value!r}; ожидается одно из {QUANTIZATION_MODES}.")
+    return value
+
+
+def create_fake_redis() -> Any:
+    if FakeAsyncRedis is None:
+        raise RuntimeError(
+            "Redis недоступен, а пакет fakeredis не установлен. "
+            "Установите redis-server или добавьте зависимость fakeredis: `pip install fakeredis`."
         )
+    logger.info("⚠️  Используется FakeRedis (in-memory). Данные не сохраняются между перезапусками.")
+    return FakeAsyncRedis(decode_responses=False)
+
 
-    if FakeAsyncRedis is not None:
-        logger.info("⚠️  Используется FakeRedis (in-memory). Данные не сохраняются между перезапусками.")
-        return FakeAsyncRedis(decode_responses=True), False
+def create_redis_client(redis_url: str) -> tuple[Any, bool]:
+    """Возвращает подключение к Redis или его in-memory замену.
 
-    raise RuntimeError(
-        "Redis недоступен, а пакет fakeredis не установлен. "
-        "Установите redis-server или добавьте зависимость fakeredis: `pip install fakeredis`."
+    Возвращает кортеж (client, is_real_redis). Доступность настоящего Redis
+    проверяется первым ping в on_startup — отдельный TCP-пробой не нужен.
+    """
+    if AsyncRedis is None:
+        return create_fake_redis(), False
+    # Значения остаются bytes: JSON-парсер принимает UTF-8 напрямую, без лишнего decode в str.
+    # Пул соединений с keepalive и health-check живёт весь срок работы бота.
+    client = AsyncRedis.from_url(
+        redis_url,
+        decode_responses=False,
+        health_check_interval=30,
+        socket_keepalive=True,
+        socket_connect_timeout=1.0,
+        retry_on_timeout=True,
+        max_connections=32,
     )
+    return client, True
 
 
 class ConversationMemory:
@@ -162,62 +255,357 @@ class ConversationMemory:
         namespace: str,
         max_messages: int,
         ttl_seconds: int,
+        max_message_chars: int = 0,
     ) -> None:
         self.redis = redis
         self.namespace = namespace
         self.max_messages = max_messages
         self.ttl_seconds = ttl_seconds
+        self.max_message_chars = max_message_chars
+
+    def _truncate(self, content: str) -> str:
+        if self.max_message_chars > 0 and len(content) > self.max_message_chars:
+            return content[: self.max_message_chars]
+        return content
 
     def _key(self, user_id: int) -> str:
+        # Отдельное имя ключа: старые JSON-строки под ":conversation:" не дают WRONGTYPE на списковых командах.
+        return f"{self.namespace}:history:{user_id}"
+
+    def _legacy_key(self, user_id: int) -> str:
         return f"{self.namespace}:conversation:{user_id}"
 
     async def get_history(self, user_id: int) -> List[Dict[str, str]]:
         """Возвращает историю переписки пользователя."""
-        raw = await self.redis.get(self._key(user_id))
-        if not raw:
-            return []
-        try:
-            payload = json.loads(raw)
-            if isinstance(payload, list):
-                return [
-                    {"role": str(item.get("role", "")), "content": str(item.get("content", ""))}
-                    for item in payload
-                    if isinstance(item, dict)
-                ]
-        except json.JSONDecodeError:
-            logger.warning("Не удалось декодировать историю чата пользователя %s", user_id)
-        return []
+        raw_items = await self.redis.lrange(self._key(user_id), 0, -1)
+        history: List[Dict[str, str]] = []
+        for raw in raw_items:
+            try:
+                # orjson.JSONDecodeError наследует json.JSONDecodeError.
+                item = load_json(raw)
+            except json.JSONDecodeError:
+                logger.warning("Не удалось декодировать сообщение из истории пользователя %s", user_id)
+                continue
+            if isinstance(item, dict):
+                history.append({"role": str(item.get("role", "")), "content": str(item.get("content", ""))})
+        return history
 
     async def append_turn(self, user_id: int, user_content: str, assistant_content: str) -> None:
-        """Добавляет пару сообщений user/assistant и обрезает историю."""
-        history = await self.get_history(user_id)
-        history.append({"role": "user", "content": user_content})
-        history.append({"role": "assistant", "content": assistant_content})
-        if len(history) > self.max_messages:
-            history = history[-self.max_messages :]
-        await self.redis.set(
-            self._key(user_id),
-            json.dumps(history, ensure_ascii=False),
-            ex=self.ttl_seconds,
-        )
+        """Добавляет пару сообщений user/assistant и обрезает историю.
+
+        RPUSH + LTRIM + EXPIRE уходят одним пайплайном: без чтения всей истории
+        и без гонки read-modify-write.
+        """
+        key = self._key(user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(
+                key,
+                dump_json({"role": "user", "content": self._truncate(user_content)}),
+                dump_json({"role": "assistant", "content": self._truncate(assistant_content)}),
+            )
+            pipe.ltrim(key, -self.max_messages, -1)
+            pipe.expire(key, self.ttl_seconds)
+            # Счётчик обработанных сообщений едет в том же пайплайне — без отдельного RTT.
+            pipe.incr(f"{self.namespace}:stats:messages")
+            await pipe.execute()
 
     async def clear(self, user_id: int) -> None:
         """Удаляет историю диалога."""
-        await self.redis.delete(self._key(user_id))
+        await self.redis.delete(self._key(user_id), self._legacy_key(user_id))
+
+
+class ResponseCache:
+    """Кэш ответов LLM в Redis по (системный промпт, сниппеты RAG, последние реплики, вопрос)."""
+
+    def __init__(self, redis: Any, namespace: str, system_prompt: str, ttl_seconds: int, history_turns: int) -> None:
+        self.redis = redis
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.history_turns = history_turns
+        self._system_digest = hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def key(
+        self,
+        history: Sequence[Dict[str, str]],
+        user_message: str,
+        snippets: Sequence[RetrievalResult],
+    ) -> str:
+        user_turns = [item["content"] for item in history if item.get("role") == "user"]
+        recent = user_turns[-self.history_turns :] if self.history_turns > 0 else []
+        canonical = json.dumps(
+            {
+                "sys": self._system_digest,
+                "rag": sorted(f"{item.source or ''}\x00{item.content}" for item in snippets),
+                "hist": recent,
+                "q": " ".join(user_message.lower().split()),
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        digest = hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{self.namespace}:respcache:{digest}"
+
+    async def get(self, key: str) -> Optional[str]:
+        raw = await self.redis.get(key)
+        if raw is None:
+            return None
+        return raw.decode("utf-8") if isinstance(raw, bytes) else raw
+
+    async def set(self, key: str, response: str) -> None:
+        if response:
+            await self.redis.set(key, response, ex=self.ttl_seconds)
+
+
+# Реплики, для которых поиск по базе товаров заведомо бесполезен.
+TRIVIAL_MESSAGES = frozenset(
+    {
+        "привет", "здравствуйте", "добрый день", "добрый вечер", "доброе утро", "хай", "hi", "hello",
+        "ок", "ok", "окей", "ага", "угу", "да", "нет", "понял", "поняла", "понятно", "хорошо", "ясно",
+        "спасибо", "спс", "благодарю", "пока", "до свидания", "отлично", "супер", "класс",
+    }
+)
+RETRIEVAL_CACHE_SIZE = 1024
+
+
+def is_trivial_message(text: str) -> bool:
+    if not any(ch.isalnum() for ch in text):
+        return True
+    normalized = " ".join("".join(ch if ch.isalnum() or ch.isspace() else " " for ch in text.lower()).split())
+    return normalized in TRIVIAL_MESSAGES
+
+
+async def drain_queue(queue: asyncio.Queue, max_items: int, max_wait: float) -> List[Any]:
+    """Ждёт первый элемент, затем добирает до max_items, но не дольше max_wait секунд."""
+    batch = [await queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+    while len(batch) < max_items:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+class EmbeddingBatcher:
+    """Объединяет одновременные RAG-запросы в один encode и одно умножение на корпус."""
+
+    def __init__(
+        self,
+        search_batch: Callable[[List[str]], List[List[RetrievalResult]]],
+        executor: Optional[ThreadPoolExecutor] = None,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+    ) -> None:
+        self.search_batch = search_batch
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: Optional[asyncio.Queue[Tuple[str, asyncio.Future]]] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, query: str) -> List[RetrievalResult]:
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((query, future))
+        return await future
+
+    async def _batch_loop(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await drain_queue(self._queue, self.max_batch_size, self.max_wait)
+            pending = [(query, future) for query, future in batch if not future.cancelled()]
+            if not pending:
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.search_batch, [query for query, _ in pending]
+                )
+            except Exception as exc:  # pragma: no cover - зависит от индекса и модели
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), result in zip(pending, results):
+                if not future.done():
+                    future.set_result(result)
 
 
 class RAGService:
     """Обёртка над KnowledgeRetriever для получения релевантных чанков."""
 
-    def __init__(self, index_dir: Path, embedding_model: str, top_k: int) -> None:
+    def __init__(
+        self,
+        index_dir: Path,
+        embedding_model: str,
+        top_k: int,
+        compile_embedder: Optional[bool] = None,
+        executor: Optional[ThreadPoolExecutor] = None,
+    ) -> None:
         logger.info("Загружаем RAG-индекс из %s", index_dir)
-        self.retriever = KnowledgeRetriever(index_dir=index_dir, embedding_model=embedding_model)
+        self.retriever = KnowledgeRetriever(
+            index_dir=index_dir,
+            embedding_model=embedding_model,
+            compile_embedder=compile_embedder,
+        )
         self.top_k = top_k
+        # Одинаковые вопросы о товарах приходят от разных пользователей; поиск идёт из пула потоков.
+        self._cache: "OrderedDict[str, List[RetrievalResult]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._batcher = EmbeddingBatcher(self._search_batch, executor=executor)
+        # Несколько параллельных поисков не должны пересоздавать потоки intra-op сверх числа ядер.
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+        # Прогрев: инициализация CUDA/cuBLAS и автотюнинг ядер проходят до первого пользователя.
+        self.retriever.backend.encode(["прогрев"], use_cache=False)
+
+    @staticmethod
+    def _cache_key(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _cached(self, key: str) -> Optional[List[RetrievalResult]]:
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+            return cached
+
+    def _remember(self, key: str, results: List[RetrievalResult]) -> None:
+        with self._cache_lock:
+            self._cache[key] = results
+            while len(self._cache) > RETRIEVAL_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _search_batch(self, queries: List[str]) -> List[List[RetrievalResult]]:
+        return self.retriever.batch_search(queries, k=self.top_k)
 
     def retrieve(self, query: str) -> List[RetrievalResult]:
-        if not query.strip():
+        query = query.strip()
+        if not query or is_trivial_message(query):
+            return []
+        key = self._cache_key(query)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        results = self.retriever.search(query, k=self.top_k)
+        self._remember(key, results)
+        return results
+
+    async def retrieve_async(self, query: str) -> List[RetrievalResult]:
+        """Как retrieve, но промахи кэша от разных пользователей ищутся одним батчем."""
+        query = query.strip()
+        if not query or is_trivial_message(query):
             return []
-        return self.retriever.search(query, k=self.top_k)
+        key = self._cache_key(query)
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+        results = await self._batcher.submit(query)
+        self._remember(key, results)
+        return results
+
+
+# Накопитель токенов одного запроса: поток генерации дописывает, event loop читает.
+TokenSink = List[int]
+BatchItem = Tuple[Sequence[Dict[str, str]], asyncio.Future, TokenSink]
+STREAM_POLL_SECONDS = 0.05
+
+
+class RowStreamer(BaseStreamer):
+    """Раскладывает токены каждого шага батчевого generate по накопителям запросов."""
+
+    def __init__(self, sinks: List[TokenSink]) -> None:
+        self.sinks = sinks
+        self._prompt_seen = False
+
+    def put(self, value: torch.Tensor) -> None:
+        # Первый вызов — сами промпты, дальше по одному новому токену на строку.
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        tokens = value.reshape(len(self.sinks), -1)[:, -1].tolist()
+        for sink, token in zip(self.sinks, tokens):
+            sink.append(token)
+
+    def end(self) -> None:
+        pass
+
+
+class BatchScheduler:
+    """Собирает одновременные запросы в один вызов generate.
+
+    Декодирование упирается в чтение весов, поэтому батч из нескольких
+    пользователей стоит почти как один запрос.
+    """
+
+    def __init__(
+        self,
+        generate_batch: Callable[[List[Sequence[Dict[str, str]]], List[TokenSink]], List[str]],
+        max_batch_size: int,
+        max_wait_ms: float,
+    ) -> None:
+        self.generate_batch = generate_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: Optional[asyncio.Queue[BatchItem]] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def submit_nowait(self, messages: Sequence[Dict[str, str]], sink: Optional[TokenSink] = None) -> asyncio.Future:
+        if self._worker is None or self._worker.done():
+            # Очередь и задача создаются лениво внутри уже запущенного event loop.
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((messages, future, sink if sink is not None else []))
+        return future
+
+    async def submit(self, messages: Sequence[Dict[str, str]], sink: Optional[TokenSink] = None) -> str:
+        return await self.submit_nowait(messages, sink)
+
+    async def _collect(self) -> List[BatchItem]:
+        assert self._queue is not None
+        return await drain_queue(self._queue, self.max_batch_size, self.max_wait)
+
+    async def _batch_loop(self) -> None:
+        while True:
+            batch = await self._collect()
+            pending = [item for item in batch if not item[1].cancelled()]
+            if not pending:
+                continue
+            try:
+                replies = await asyncio.to_thread(
+                    self.generate_batch,
+                    [messages for messages, _, _ in pending],
+                    [sink for _, _, sink in pending],
+                )
+            except Exception as exc:  # pragma: no cover - зависит от инференса
+                for _, future, _ in pending:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future, _), reply in zip(pending, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+
+def batch_bucket_sizes(max_batch_size: int) -> List[int]:
+    """Степени двойки до max_batch_size (и сам максимум): под static cache батч добивается до корзины."""
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max(1, max_batch_size))
+    return sizes
 
 
 class LLMService:
@@ -226,16 +614,44 @@ class LLMService:
     def __init__(self, config: BotConfig) -> None:
         logger.info("Загружаем модель %s", config.model_id)
         adapter_path = config.adapter_path if config.adapter_path.exists() else None
+        if config.quantization == "fp8":
+            raise ValueError("QUANTIZATION=fp8 поддерживается только с INFERENCE_BACKEND=vllm.")
+        # awq/gptq: transformers читает quantization_config из чекпоинта и берёт INT4-ядра сам.
         self.model, self.tokenizer = load_model(
             model_id=config.model_id,
             adapter_path=adapter_path,
-            load_in_4bit=config.load_in_4bit,
+            load_in_4bit=config.quantization in {"auto", "bnb4"},
             trust_remote_code=config.trust_remote_code,
+            force_nf4=config.quantization == "bnb4",
+            compile_model=config.enable_cuda_graphs,
         )
+        # Левый паддинг выравнивает концы промптов, и новые токены всех строк батча идут с одной позиции.
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
         self.config = config
-        self._generation_lock = asyncio.Lock()
+        self.scheduler = BatchScheduler(
+            self._generate_batch,
+            max_batch_size=config.batch_max_size,
+            max_wait_ms=config.batch_max_wait_ms,
+        )
+        self.batch_buckets = batch_bucket_sizes(config.batch_max_size)
+        if self._static_cache():
+            self._warmup_batch_buckets()
         logger.info("Модель успешно загружена (устройство: %s)", self.model.device)
 
+    def _static_cache(self) -> bool:
+        return getattr(self.model.generation_config, "cache_implementation", None) == "static"
+
+    def _warmup_batch_buckets(self) -> None:
+        # load_model прогревает только батч из одной строки; остальные корзины захватываем здесь,
+        # чтобы первые всплески нагрузки не платили за перекомпиляцию. Корзины по длине промпта
+        # сверх минимальной по-прежнему захватываются при первом запросе такой длины.
+        messages = [{"role": "system", "content": self.config.system_prompt}, {"role": "user", "content": "warmup"}]
+        for size in self.batch_buckets:
+            logger.info("Прогрев CUDA-графа для батча из %d строк", size)
+            self._generate_batch([messages] * size, [[] for _ in range(size)])
+
     def _compose_system_prompt(self, context_snippets: Sequence[RetrievalResult]) -> str:
         if not context_snippets:
             return self.config.system_prompt
@@ -258,14 +674,25 @@ class LLMService:
         messages.append({"role": "user", "content": user_message})
         return messages
 
-    def _generate(self, messages: Sequence[Dict[str, str]]) -> str:
-        prompt = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True,
-        )
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-        with torch.no_grad():
+    def _generate_batch(self, batch: List[Sequence[Dict[str, str]]], sinks: List[TokenSink]) -> List[str]:
+        # Системный блок (промпт + RAG-контекст) токенизируется один раз на набор сниппетов,
+        # на каждый запрос остаются только история и новая реплика.
+        encoded = [{"input_ids": prompt_token_ids(self.tokenizer, list(messages))} for messages in batch]
+        rows = len(encoded)
+        if self._static_cache():
+            # Длины промптов и число строк округляются до корзин, чтобы граф переиспользовался,
+            # а не захватывался заново: StaticCache и CUDA-граф зависят от обеих размерностей.
+            longest = max(len(item["input_ids"]) for item in encoded)
+            padding = {"padding": "max_length", "max_length": prompt_bucket_length(longest)}
+            bucket = next((size for size in self.batch_buckets if size >= rows), rows)
+            # Строки-заполнители повторяют первый промпт (без пустого attention), их вывод отбрасывается.
+            encoded.extend({"input_ids": encoded[0]["input_ids"]} for _ in range(bucket - rows))
+            sinks = list(sinks) + [[] for _ in range(bucket - rows)]
+        else:
+            padding = {"padding": True}
+        inputs = self.tokenizer.pad(encoded, return_tensors="pt", **padding).to(self.model.device)
+        # inference_mode строже no_grad: тензоры не получают счётчиков версий.
+        with torch.inference_mode():
             output = self.model.generate(
                 **inputs,
                 max_new_tokens=self.config.max_new_tokens,
@@ -273,10 +700,11 @@ class LLMService:
                 temperature=self.config.temperature if not self.config.greedy else None,
                 top_p=self.config.sample_top_p if not self.config.greedy else None,
                 top_k=self.config.sample_top_k if not self.config.greedy else None,
-                pad_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=RowStreamer(sinks),
             )
-        generated = output[0][inputs["input_ids"].shape[-1] :]
-        return self.tokenizer.decode(generated, skip_special_tokens=True).strip()
+        generated = output[:rows, inputs["input_ids"].shape[-1] :]
+        return [text.strip() for text in self.tokenizer.batch_decode(generated, skip_special_tokens=True)]
 
     async def generate_reply(
         self,
@@ -287,9 +715,118 @@ class LLMService:
         """Асинхронная генерация ответа с учётом истории и RAG."""
         system_prompt = self._compose_system_prompt(context_snippets)
         messages = self._build_messages(system_prompt, history, user_message)
+        return await self.scheduler.submit(messages)
 
-        async with self._generation_lock:
-            return await asyncio.to_thread(self._generate, messages)
+    async def generate_reply_stream(
+        self,
+        history: Sequence[Dict[str, str]],
+        user_message: str,
+        context_snippets: Sequence[RetrievalResult],
+    ) -> AsyncIterator[str]:
+        """Отдаёт накопленный текст ответа по мере генерации; последний элемент — полный ответ."""
+        system_prompt = self._compose_system_prompt(context_snippets)
+        messages = self._build_messages(system_prompt, history, user_message)
+        tokens: TokenSink = []
+        future = self.scheduler.submit_nowait(messages, tokens)
+        decoded = 0
+        while not future.done():
+            await asyncio.wait({future}, timeout=STREAM_POLL_SECONDS)
+            # Декодируем только когда пришли новые токены, а не на каждом опросе.
+            if len(tokens) != decoded and not future.done():
+                decoded = len(tokens)
+                yield self.tokenizer.decode(tokens[:decoded], skip_special_tokens=True)
+        yield future.result()
+
+
+# auto/none: vLLM сам читает quantization_config чекпоинта (AWQ/GPTQ/FP8 распознаются автоматически).
+VLLM_QUANTIZATION: Dict[str, Optional[str]] = {
+    "auto": None,
+    "none": None,
+    "awq": "awq_marlin",
+    "gptq": "gptq_marlin",
+    "fp8": "fp8",
+    "bnb4": "bitsandbytes",
+}
+
+
+class VLLMService(LLMService):
+    """Генерация через vLLM: PagedAttention и continuous batching одновременных пользователей."""
+
+    def __init__(self, config: BotConfig) -> None:
+        if AsyncLLMEngine is None:
+            raise RuntimeError("INFERENCE_BACKEND=vllm требует пакет vllm: `pip install vllm`.")
+        logger.info("Запускаем vLLM-движок для %s", config.model_id)
+        adapter_path = config.adapter_path if config.adapter_path.exists() else None
+        engine_args = AsyncEngineArgs(
+            model=config.model_id,
+            trust_remote_code=config.trust_remote_code,
+            enable_lora=adapter_path is not None,
+            max_lora_rank=config.max_lora_rank,
+            quantization=VLLM_QUANTIZATION[config.quantization],
+            load_format="bitsandbytes" if config.quantization == "bnb4" else "auto",
+            max_model_len=config.max_model_len,
+            gpu_memory_utilization=config.gpu_memory_utilization,
+            enable_prefix_caching=config.enable_prefix_caching,
+        )
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+        self.lora_request = LoRARequest("clone", 1, str(adapter_path)) if adapter_path else None
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            adapter_path or config.model_id,
+            trust_remote_code=config.trust_remote_code,
+        )
+        self.sampling_params = SamplingParams(
+            max_tokens=config.max_new_tokens,
+            # temperature=0 — жадное декодирование в vLLM.
+            temperature=0.0 if config.greedy else config.temperature,
+            top_p=1.0 if config.greedy else config.sample_top_p,
+            top_k=-1 if config.greedy else config.sample_top_k,
+        )
+        self.config = config
+        logger.info("vLLM-движок готов.")
+
+    async def generate_reply(
+        self,
+        history: Sequence[Dict[str, str]],
+        user_message: str,
+        context_snippets: Sequence[RetrievalResult],
+    ) -> str:
+        """Без глобального лока: планировщик vLLM сам объединяет запросы в батчи."""
+        reply = ""
+        async for reply in self.generate_reply_stream(history, user_message, context_snippets):
+            pass
+        return reply
+
+    async def generate_reply_stream(
+        self,
+        history: Sequence[Dict[str, str]],
+        user_message: str,
+        context_snippets: Sequence[RetrievalResult],
+    ) -> AsyncIterator[str]:
+        system_prompt = self._compose_system_prompt(context_snippets)
+        messages = self._build_messages(system_prompt, history, user_message)
+        prompt = render_prompt(self.tokenizer, messages)
+
+        text = ""
+        # RequestOutput несёт накопленный текст, так что каждый элемент можно показывать как есть.
+        async for output in self.engine.generate(
+            prompt,
+            self.sampling_params,
+            request_id=uuid4().hex,
+            lora_request=self.lora_request,
+        ):
+            if output.outputs:
+                text = output.outputs[0].text
+                if not output.finished:
+                    yield text
+        yield text.strip()
+
+
+def create_llm_service(config: BotConfig) -> LLMService:
+    if config.inference_backend == "vllm":
+        return VLLMService(config)
+    if config.inference_backend != "hf":
+        raise ValueError(f"Неизвестный INFERENCE_BACKEND={config.inference_backend!r}; ожидается hf или vllm.")
+    return LLMService(config)
 
 
 class TelegramCloneBot:
@@ -303,20 +840,31 @@ class TelegramCloneBot:
         )
         self.dispatcher = Dispatcher()
 
-        self.redis, _ = create_redis_client(config.redis_url)
+        self.redis, self._is_real_redis = create_redis_client(config.redis_url)
         self.memory = ConversationMemory(
             redis=self.redis,
             namespace=config.redis_namespace,
             max_messages=config.max_history_messages,
             ttl_seconds=config.redis_ttl_seconds,
+            max_message_chars=config.max_message_chars,
         )
-        self.rag = RAGService(
-            index_dir=config.index_dir,
-            embedding_model=config.embedding_model,
-            top_k=config.rag_top_k,
+        self.response_cache = ResponseCache(
+            redis=self.redis,
+            namespace=config.redis_namespace,
+            system_prompt=config.system_prompt,
+            ttl_seconds=config.cache_ttl_seconds,
+            history_turns=config.cache_history_turns,
         )
-        self.llm = LLMService(config)
-        self._locks: Dict[int, asyncio.Lock] = {}
+        # Индекс и модель грузятся в warmup(): параллельно друг с другом и с подключением к Redis.
+        self.rag: Optional[RAGService] = None
+        self.llm: Optional[LLMService] = None
+        self._redis_ready = False
+        # Отдельный пул под RAG: поиск не конкурирует с default executor (to_thread генерации).
+        self._rag_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rag")
+        # Лок на пользователя сохраняет порядок его реплик в истории; между пользователями
+        # запросы идут параллельно.
+        self._locks: "OrderedDict[int, asyncio.Lock]" = OrderedDict()
+        self._locks_cap = 10_000
 
         # Регистрация хендлеров
         self.dispatcher.message.register(self.handle_start, CommandStart())
@@ -326,17 +874,56 @@ class TelegramCloneBot:
         self.dispatcher.startup.register(self.on_startup)
         self.dispatcher.shutdown.register(self.on_shutdown)
 
+    async def warmup(self) -> None:
+        """Загружает RAG-индекс и LLM в потоках одновременно, пока проверяется Redis."""
+        config = self.config
+        self.rag, self.llm, _ = await asyncio.gather(
+            asyncio.to_thread(
+                RAGService,
+                index_dir=config.index_dir,
+                embedding_model=config.embedding_model,
+                top_k=config.rag_top_k,
+                compile_embedder=config.compile_embedder,
+                executor=self._rag_pool,
+            ),
+            asyncio.to_thread(create_llm_service, config),
+            self._connect_redis(),
+        )
+
     async def on_startup(self) -> None:
+        if not self._redis_ready:
+            await self._connect_redis()
+
+    async def _connect_redis(self) -> None:
         logger.info("Проверяем подключение к Redis: %s", self.config.redis_url)
         try:
             await self.redis.ping()
-            logger.info("Redis доступен.")
+            logger.info("✅ Redis доступен.")
         except Exception as exc:  # pragma: no cover - зависит от окружения
-            logger.error("Не удалось подключиться к Redis: %s", exc)
-            raise
+            if not self._is_real_redis:
+                logger.error("Не удалось подключиться к Redis: %s", exc)
+                raise
+            logger.warning("Redis недоступен (%s) — переключаемся на FakeRedis, если доступен.", exc)
+            await self.redis.close()
+            self._use_redis(create_fake_redis(), is_real=False)
+        if self.config.redis_maxmemory and self._is_real_redis:
+            try:
+                await self.redis.config_set("maxmemory", self.config.redis_maxmemory)
+                await self.redis.config_set("maxmemory-policy", "allkeys-lru")
+                logger.info("Redis maxmemory=%s, политика allkeys-lru.", self.config.redis_maxmemory)
+            except Exception as exc:  # pragma: no cover - CONFIG может быть запрещён (managed Redis)
+                logger.warning("Не удалось выставить maxmemory в Redis: %s", exc)
+        self._redis_ready = True
+
+    def _use_redis(self, client: Any, is_real: bool) -> None:
+        self.redis = client
+        self._is_real_redis = is_real
+        self.memory.redis = client
+        self.response_cache.redis = client
 
     async def on_shutdown(self) -> None:
         logger.info("Корректное завершение работы бота...")
+        self._rag_pool.shutdown(wait=False, cancel_futures=True)
         await self.redis.close()
         await self.bot.session.close()
 
@@ -361,25 +948,116 @@ class TelegramCloneBot:
             await message.answer("Я могу отвечать только на текстовые сообщения.")
             return
 
-        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        lock = self._user_lock(user_id)
         async with lock:
             try:
                 logger.info("Новое сообщение от %s: %s", user_id, text)
-                history = await self.memory.get_history(user_id)
-                snippets = self.rag.retrieve(text)
-                response = await self.llm.generate_reply(
-                    history=history,
-                    user_message=text,
-                    context_snippets=snippets,
+                # Redis и поиск по индексу независимы; поиск уходит в пул RAG, чтобы не держать loop.
+                history, snippets = await asyncio.gather(
+                    self.memory.get_history(user_id),
+                    self.rag.retrieve_async(text),
                 )
+                cache_key = self.response_cache.key(history, text, snippets) if self.response_cache.enabled else None
+                cached = await self.response_cache.get(cache_key) if cache_key else None
+                if cached is not None:
+                    logger.info("Ответ для %s взят из кэша", user_id)
+                    await message.answer(cached)
+                    await self.memory.append_turn(user_id, text, cached)
+                    return
+                if self.config.stream_replies:
+                    response = await self._stream_reply(message, history, text, snippets)
+                else:
+                    response = await self.llm.generate_reply(
+                        history=history,
+                        user_message=text,
+                        context_snippets=snippets,
+                    )
+                    await message.answer(response)
                 await self.memory.append_turn(user_id, text, response)
-                await message.answer(response)
+                if cache_key:
+                    await self.response_cache.set(cache_key, response)
             except Exception as exc:  # pragma: no cover - зависит от инференса
                 logger.exception("Ошибка во время обработки сообщения")
                 await message.answer("Извини, что-то пошло не так. Попробуй ещё раз позже.")
 
+    def _user_lock(self, user_id: int) -> asyncio.Lock:
+        """Лок пользователя из LRU; вытесняются только свободные локи давно молчащих пользователей."""
+        lock = self._locks.get(user_id)
+        if lock is not None:
+            self._locks.move_to_end(user_id)
+            return lock
+        lock = self._locks[user_id] = asyncio.Lock()
+        overflow = len(self._locks) - self._locks_cap
+        if overflow > 0:
+            idle: List[int] = []
+            for uid, candidate in self._locks.items():
+                if len(idle) >= overflow:
+                    break
+                if not candidate.locked():
+                    idle.append(uid)
+            for uid in idle:
+                del self._locks[uid]
+        return lock
+
+    async def _stream_reply(
+        self,
+        message: Message,
+        history: Sequence[Dict[str, str]],
+        text: str,
+        snippets: Sequence[RetrievalResult],
+    ) -> str:
+        """Показывает ответ по мере генерации, редактируя одно сообщение."""
+        sent = await message.answer("…")
+        loop = asyncio.get_running_loop()
+        shown = "…"
+        interval = self.config.stream_edit_interval
+        next_edit = loop.time() + interval
+        response = ""
+        async for response in self.llm.generate_reply_stream(
+            history=history,
+            user_message=text,
+            context_snippets=snippets,
+        ):
+            now = loop.time()
+            # Telegram ограничивает частоту правок, а одинаковый текст правка не принимает.
+            if not response.strip() or response == shown or now < next_edit:
+                continue
+            next_edit = now + interval
+            try:
+                # Незаконченный ответ может оборвать HTML-тег или сущность: промежуточные правки без разметки.
+                await sent.edit_text(response, parse_mode=None)
+                shown = response
+            except TelegramRetryAfter as exc:
+                next_edit = now + exc.retry_after
+            except TelegramAPIError as exc:
+                logger.debug("Промежуточная правка не прошла: %s", exc)
+        if response:
+            await self._finish_stream(message, sent, response)
+        return response
+
+    async def _finish_stream(self, message: Message, sent: Message, response: str) -> None:
+        """Финальная правка с HTML; при любой ошибке Telegram ответ уходит отдельным сообщением."""
+        try:
+            await sent.edit_text(response)
+            return
+        except TelegramBadRequest as exc:
+            if "message is not modified" in str(exc):
+                return
+            logger.warning("Финальная правка не прошла, отправляю ответ заново: %s", exc)
+        except TelegramRetryAfter as exc:
+            await asyncio.sleep(exc.retry_after)
+        except TelegramAPIError as exc:
+            logger.warning("Финальная правка не прошла, отправляю ответ заново: %s", exc)
+        try:
+            # Текст уже мог не пройти HTML-разбор, поэтому запасной вариант — без разметки.
+            await message.answer(response, parse_mode=None)
+        except TelegramAPIError as exc:
+            logger.warning("Не удалось доставить ответ: %s", exc)
+
     async def run(self) -> None:
         """Запускает long polling."""
+        if self.rag is None or self.llm is None:
+            await self.warmup()
         await self.dispatcher.start_polling(self.bot, allowed_updates=[])
 
 
@@ -394,11 +1072,16 @@ async def main() -> None:
             "TELEGRAM_BOT_TOKEN не указан. Задайте его в переменных окружения или в файле .env."
         )
     bot = TelegramCloneBot(config)
+    await bot.warmup()
     await bot.run()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            # Long-poll Telegram, Redis и пулы потоков — всё на event loop; libuv быстрее selector-цикла.
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\nОстановка бота.")
@@ -4,12 +4,20 @@
 from __future__ import annotations
 
 import argparse
+import array
+import functools
+import gc
+import itertools
 import json
 import logging
+import os
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import torch
 from datasets import Dataset, load_dataset
@@ -24,8 +32,14 @@ from transformers import (
     Trainer,
     TrainingArguments,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from PIL import Image
 
+try:  # pragma: no cover - AcceleratorConfig есть только в новых transformers
+    from transformers.trainer_pt_utils import AcceleratorConfig
+except ImportError:  # pragma: no cover
+    AcceleratorConfig = None
+
 try:  # pragma: no cover - optional for older transformers
     from transformers.trainer_callback import EarlyStoppingCallback
 except ImportError:  # pragma: no cover
@@ -37,10 +51,33 @@ except ImportError:  # pragma: no cover
     IntervalStrategy = None
     SaveStrategy = None
 
+try:  # pragma: no cover - optional faster JSON backend
+    import orjson  # type: ignore
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # pragma: no cover - libjpeg-turbo ускоряет декодирование JPEG, необязателен
+    from turbojpeg import TJPF_RGB, TurboJPEG
+except ImportError:  # pragma: no cover
+    TurboJPEG = None
+
 from qwen_vl_utils import process_vision_info
 
 logger = logging.getLogger(__name__)
 
+# Базовые модели, оставшиеся в памяти после run_training(reuse_base_model=True).
+# Используется долгоживущим процессом обучения из prompt_optimizer.
+_BASE_MODEL_CACHE: Dict[Tuple[str, str, bool], Any] = {}
+# Шаг дополнения длины батча под torch.compile: меньше уникальных форм — меньше перекомпиляций.
+COMPILE_PAD_MULTIPLE = 128
+TENSOR_CORE_PAD_MULTIPLE = 8
+GRADIENT_CHECKPOINTING_KWARGS: Dict[str, Any] = {"use_reentrant": False}
+MAX_DEFAULT_WORKERS = 8
+# Потоков на воркер DataLoader для декодирования изображений внутри батча.
+DECODE_THREADS = 4
+# Строк Arrow-датасета на одну конвертацию в Python при форматировании примеров.
+ROW_BATCH_SIZE = 1000
+
 
 @dataclass(slots=True)
 class TrainingRunResult:
@@ -139,8 +176,13 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     parser.add_argument(
         "--target-modules",
         nargs="+",
-        default=["q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj"],
-        help="Модули для LoRA адаптации.",
+        default=["q_proj", "v_proj"],
+        help="Модули для LoRA адаптации (по умолчанию только q/v проекции attention).",
+    )
+    parser.add_argument(
+        "--use-rslora",
+        action="store_true",
+        help="Rank-stabilized LoRA: масштаб alpha/sqrt(r) вместо alpha/r.",
     )
     parser.add_argument(
         "--lora-r",
@@ -162,14 +204,38 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     )
     parser.add_argument(
         "--bf16",
-        action="store_true",
-        help="Включить bf16 тренировку (рекомендуется, если доступно).",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help=(
+            "Смешанная точность: --bf16 принудительно bf16, --no-bf16 — fp16 (например, чтобы повторить "
+            "старые fp16-прогоны). По умолчанию bf16 включается сам, если GPU его поддерживает."
+        ),
     )
     parser.add_argument(
         "--tf32",
         action="store_true",
         help="Включить TF32 (полезно на Ampere).",
     )
+    parser.add_argument(
+        "--torch-compile",
+        action="store_true",
+        help="Скомпилировать модель через torch.compile (mode=reduce-overhead, CUDA graphs).",
+    )
+    parser.add_argument(
+        "--torch-compile-mode",
+        choices=("default", "reduce-overhead", "max-autotune"),
+        default="reduce-overhead",
+        help="Режим torch.compile при --torch-compile (max-autotune дольше компилирует, но подбирает ядра).",
+    )
+    parser.add_argument(
+        "--pad-to-multiple-of",
+        type=int,
+        default=None,
+        help=(
+            "Дополнять длину батча до кратной N: по умолчанию 8 для тензорных ядер, "
+            "128 при --torch-compile. На H100 с bf16 имеет смысл 16."
+        ),
+    )
     parser.add_argument(
         "--trust-remote-code",
         action="store_true",
@@ -248,6 +314,11 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
         default=200,
         help="Как часто сохранять чекпойнты (в шагах).",
     )
+    parser.add_argument(
+        "--no-group-by-length",
+        action="store_true",
+        help="Не группировать батчи по длине (по умолчанию группируются при batch-size > 1).",
+    )
     parser.add_argument(
         "--early-stopping-patience",
         type=int,
@@ -263,8 +334,8 @@ def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
     parser.add_argument(
         "--dataloader-num-workers",
         type=int,
-        default=2,
-        help="Количество воркеров DataLoader.",
+        default=None,
+        help="Количество воркеров DataLoader. По умолчанию половина ядер CPU, от 2 до 8.",
     )
     parser.add_argument(
         "--max-train-samples",
@@ -302,7 +373,20 @@ def ensure_file(path: Path, description: str) -> None:
 
 
 def load_json_dataset(path: Path) -> Dataset:
-    return load_dataset("json", data_files=str(path), split="train")
+    if orjson is None:
+        return load_dataset("json", data_files=str(path), split="train")
+    # orjson разбирает байты напрямую и быстрее pyarrow-ридера на вложенных messages;
+    # заодно не создаётся кэш load_dataset на диске.
+    with path.open("rb") as fh:
+        payload = fh.read()
+    if payload.lstrip().startswith(b"["):
+        records = orjson.loads(payload)
+    else:
+        records = [orjson.loads(line) for line in payload.splitlines() if line.strip()]
+    # from_list берёт колонки только из первой записи: собираем объединение ключей
+    # по всем строкам (как load_dataset("json")), отсутствующие поля — None.
+    columns = list(dict.fromkeys(key for record in records for key in record))
+    return Dataset.from_dict({key: [record.get(key) for record in records] for key in columns})
 
 
 def load_optional_dataset(path: Path) -> Optional[Dataset]:
@@ -319,7 +403,20 @@ def load_optional_dataset(path: Path) -> Optional[Dataset]:
         return None
 
 
+def iter_rows(dataset: Dataset, batch_size: int = ROW_BATCH_SIZE) -> Iterator[Dict[str, Any]]:
+    """Отдаёт строки Arrow-датасета, конвертируя колонки в Python пачками, а не по строке."""
+    if not hasattr(dataset, "iter"):
+        yield from dataset
+        return
+    for batch in dataset.iter(batch_size=batch_size):
+        columns = list(batch)
+        for values in zip(*batch.values()):
+            yield dict(zip(columns, values))
+
+
+@functools.lru_cache(maxsize=8)
 def build_persona_header(persona_name: str, persona_description: str) -> str:
+    # Вызывается на каждый пример с одними и теми же аргументами — строку собираем один раз.
     persona = persona_name.strip() or "цифровой двойник"
     description = persona_description.strip()
     header = f"Ты — {persona}."
@@ -335,13 +432,8 @@ def build_persona_header(persona_name: str, persona_description: str) -> str:
 
 
 def dedupe_preserving_order(items: Iterable[str]) -> List[str]:
-    seen: set[str] = set()
-    result: List[str] = []
-    for item in items:
-        if item and item not in seen:
-            seen.add(item)
-            result.append(item)
-    return result
+    # dict.fromkeys сохраняет порядок вставки и убирает дубликаты за один проход на C.
+    return [item for item in dict.fromkeys(items) if item]
 
 
 def extract_image_refs(message: Optional[Dict[str, Any]]) -> List[str]:
@@ -399,7 +491,82 @@ def extract_image_refs(message: Optional[Dict[str, Any]]) -> List[str]:
     return dedupe_preserving_order(collected)
 
 
-def load_image_from_ref(ref: Optional[str]) -> Optional[Image.Image]:
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+# Кэш декодированных изображений ограничен по пикселям, а не по числу файлов: на процесс
+# (каждый воркер DataLoader держит свой) уходит не больше ~100 МБ RGB даже для фото 4K.
+IMAGE_CACHE_PIXELS = 32 * 1024 * 1024
+_decoded_images: "OrderedDict[Tuple[str, int, Optional[Tuple[int, int]]], Image.Image]" = OrderedDict()
+_decoded_pixels = 0
+_decoded_images_lock = threading.Lock()
+_turbo_jpeg: Any = None
+
+
+def get_turbo_jpeg() -> Any:
+    """TurboJPEG создаётся лениво: без системной libturbojpeg остаёмся на PIL."""
+    global _turbo_jpeg
+    if _turbo_jpeg is None and TurboJPEG is not None:
+        try:
+            _turbo_jpeg = TurboJPEG()
+        except (OSError, RuntimeError) as exc:  # pragma: no cover - зависит от системной библиотеки
+            logger.info("libturbojpeg недоступна, JPEG декодирует PIL: %s", exc)
+            _turbo_jpeg = False
+    return _turbo_jpeg or None
+
+
+def decode_image(path: str, mtime_ns: int, draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """Декодирует с кэшем и отдаёт копию: процессоры могут менять картинку на месте."""
+    global _decoded_pixels
+    # mtime_ns входит в ключ: перезаписанный файл декодируется заново.
+    key = (path, mtime_ns, draft_size)
+    with _decoded_images_lock:
+        cached = _decoded_images.get(key)
+        if cached is not None:
+            _decoded_images.move_to_end(key)
+            # copy() — это memcpy буфера, на порядок дешевле повторного декодирования.
+            return cached.copy()
+    image = _read_image(path, draft_size)
+    pixels = image.width * image.height
+    if pixels <= IMAGE_CACHE_PIXELS:
+        with _decoded_images_lock:
+            if key not in _decoded_images:
+                _decoded_images[key] = image
+                _decoded_pixels += pixels
+            while _decoded_pixels > IMAGE_CACHE_PIXELS:
+                _, evicted = _decoded_images.popitem(last=False)
+                _decoded_pixels -= evicted.width * evicted.height
+    return image.copy()
+
+
+def _read_image(path: str, draft_size: Optional[Tuple[int, int]]) -> Image.Image:
+    is_jpeg = path.lower().endswith(JPEG_SUFFIXES)
+    turbo = get_turbo_jpeg() if is_jpeg and draft_size is None else None
+    if turbo is not None:
+        with open(path, "rb") as fh:
+            return Image.fromarray(turbo.decode(fh.read(), pixel_format=TJPF_RGB))
+    with Image.open(path) as img:
+        if draft_size is not None:
+            # libjpeg уменьшает JPEG кратно 1/2..1/8 прямо при IDCT, но не меньше draft_size;
+            # для остальных форматов draft ничего не делает.
+            img.draft("RGB", draft_size)
+        return img.convert("RGB")
+
+
+def image_target_size(processor: AutoProcessor) -> Optional[Tuple[int, int]]:
+    """Фиксированное разрешение image processor'а (W, H) или None для динамического разрешения."""
+    size = getattr(getattr(processor, "image_processor", None), "size", None)
+    if not isinstance(size, dict):
+        return None
+    if "height" in size and "width" in size:
+        return int(size["width"]), int(size["height"])
+    if "shortest_edge" in size and "longest_edge" not in size:
+        return int(size["shortest_edge"]), int(size["shortest_edge"])
+    return None
+
+
+def load_image_from_ref(
+    ref: Optional[str],
+    draft_size: Optional[Tuple[int, int]] = None,
+) -> Optional[Image.Image]:
     if not ref:
         return None
     ref = ref.strip()
@@ -407,13 +574,14 @@ def load_image_from_ref(ref: Optional[str]) -> Optional[Image.Image]:
         return None
     if ref.startswith("file://"):
         ref = ref[7:]
-    path = Path(ref)
-    if not path.exists():
+    # Без предварительного exists(): отсутствие файла ловим по FileNotFoundError из stat.
+    # Декодированные картинки кэшируются в каждом воркере DataLoader и переживают эпохи;
+    # вызывающий получает собственную копию.
+    try:
+        return decode_image(ref, os.stat(ref).st_mtime_ns, draft_size)
+    except FileNotFoundError:
         logger.warning("Изображение %s не найдено для GLM.", ref)
         return None
-    try:
-        with Image.open(path) as img:
-            return img.convert("RGB")
     except Exception as exc:
         logger.warning("Не удалось загрузить изображение %s: %s", ref, exc)
         return None
@@ -423,34 +591,54 @@ def create_dummy_image(size: Tuple[int, int] = (448, 448), color: Tuple[int, int
     return Image.new("RGB", size, color=color)
 
 
-def extract_text_from_block(block: Any) -> str:
-    if block is None:
-        return ""
+def _text_from_dict(block: Dict[str, Any]) -> str:
+    text = block.get("text")
+    if isinstance(text, str):
+        return text
+    if "content" in block:
+        return extract_text_from_block(block["content"])
+    value = block.get("value")
+    return value if isinstance(value, str) else ""
+
+
+def _text_from_sequence(block: Sequence[Any]) -> str:
+    return " ".join(part for part in map(extract_text_from_block, block) if part).strip()
+
+
+def _text_from_other(block: Any) -> str:
+    # Подклассы dict/list/str не попадают в таблицу по точному типу — разбираем через isinstance.
     if isinstance(block, str):
-        return block
+        return str(block)
     if isinstance(block, dict):
-        block_type = block.get("type")
-        if block_type == "text":
-            text = block.get("text")
-            if isinstance(text, str):
-                return text
-        if "text" in block and isinstance(block["text"], str):
-            return block["text"]
-        if "content" in block:
-            return extract_text_from_block(block["content"])
-        if "value" in block and isinstance(block["value"], str):
-            return block["value"]
-        return ""
+        return _text_from_dict(block)
     if isinstance(block, (list, tuple)):
-        parts = [extract_text_from_block(item) for item in block]
-        return " ".join(part for part in parts if part).strip()
+        return _text_from_sequence(block)
     return str(block)
 
 
+# Диспетчеризация по точному типу: один поиск в dict вместо цепочки isinstance на каждый блок.
+_TEXT_EXTRACTORS: Dict[type, Any] = {
+    str: lambda block: block,
+    dict: _text_from_dict,
+    list: _text_from_sequence,
+    tuple: _text_from_sequence,
+    type(None): lambda block: "",
+}
+
+
+def extract_text_from_block(block: Any) -> str:
+    return _TEXT_EXTRACTORS.get(type(block), _text_from_other)(block)
+
+
 def make_text_block(text: str) -> Dict[str, str]:
     return {"type": "text", "text": text}
 
 
+STYLE_DESCRIPTOR_FIELDS = ("emotion", "tone", "topic")
+# Большинство сообщений без меток: isdisjoint по frozenset отсекает их одной проверкой на C.
+STYLE_DESCRIPTOR_SET = frozenset(STYLE_DESCRIPTOR_FIELDS)
+
+
 def _get_field(source: Any, key: str) -> Any:
     if isinstance(source, dict):
         return source.get(key)
@@ -470,24 +658,28 @@ def normalize_plain_message(message: Dict[str, Any]) -> Optional[Dict[str, Any]]
     normalized: Dict[str, Any] = {"role": role, "content": text}
     if sender:
         normalized["sender"] = sender
-    for label in ("emotion", "tone", "topic"):
-        value = _get_field(message, label)
-        if value:
-            normalized[label] = value
+    if isinstance(message, dict):
+        if not STYLE_DESCRIPTOR_SET.isdisjoint(message):
+            for label in STYLE_DESCRIPTOR_FIELDS:
+                value = message.get(label)
+                if value:
+                    normalized[label] = value
+    else:
+        for label in STYLE_DESCRIPTOR_FIELDS:
+            value = getattr(message, label, None)
+            if value:
+                normalized[label] = value
     return normalized
 
 
 def summarize_messages(messages: Sequence[Dict[str, Any]], max_chars: int) -> str:
     if not messages:
         return ""
-    fragments: List[str] = []
-    for msg in messages:
-        sender = msg.get("sender") or msg.get("role") or "собеседник"
-        content = msg.get("content", "")
-        if not content:
-            continue
-        fragments.append(f"{sender}: {content}")
-    summary = " ".join(fragments).strip()
+    summary = " ".join(
+        f"{msg.get('sender') or msg.get('role') or 'собеседник'}: {content}"
+        for msg in messages
+        if (content := msg.get("content"))
+    ).strip()
     if max_chars > 0 and len(summary) > max_chars:
         summary = summary[: max_chars - 3].rsplit(" ", 1)[0].strip() + "..."
     return summary
@@ -524,6 +716,17 @@ def plain_to_chat_message(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     }
 
 
+def render_context_line(msg: Dict[str, Any]) -> str:
+    role = msg.get("sender") or msg.get("role") or "собеседник"
+    descriptor = ""
+    if not STYLE_DESCRIPTOR_SET.isdisjoint(msg):
+        descriptors = ", ".join(
+            f"{label}={value}" for label in STYLE_DESCRIPTOR_FIELDS if (value := msg.get(label))
+        )
+        descriptor = f" ({descriptors})" if descriptors else ""
+    return f"{role}: {msg.get('content', '')}{descriptor}".strip()
+
+
 def build_style_prompt(
     example: Dict[str, Any],
     persona_name: str,
@@ -551,16 +754,7 @@ def build_style_prompt(
     if normalized_context:
         windowed = apply_history_window(normalized_context, history_config)
         prompt_lines.append("История диалога:")
-        for msg in windowed:
-            role = msg.get("sender") or msg.get("role") or "собеседник"
-            content = msg.get("content", "")
-            descriptors: List[str] = []
-            for label in ("emotion", "tone", "topic"):
-                value = _get_field(msg, label)
-                if value:
-                    descriptors.append(f"{label}={value}")
-            descriptor = f" ({', '.join(descriptors)})" if descriptors else ""
-            prompt_lines.append(f"{role}: {content}{descriptor}".strip())
+        prompt_lines.extend(render_context_line(msg) for msg in windowed)
     else:
         prompt = (example.get("prompt") or "").strip()
         if prompt:
@@ -719,13 +913,12 @@ def format_style_examples(
     persona_name: str,
     persona_description: str,
     history_config: HistoryConfig,
-) -> List[Dict[str, Any]]:
+) -> Iterator[Dict[str, Any]]:
     system_prompt = build_persona_header(persona_name, persona_description)
-    formatted: List[Dict[str, Any]] = []
-    for example in dataset:
+    for example in iter_rows(dataset):
         multiturn = build_multiturn_example(example, system_prompt, history_config)
         if multiturn:
-            formatted.append(multiturn)
+            yield multiturn
             continue
         prompt_entry = build_style_prompt(
             example,
@@ -737,38 +930,90 @@ def format_style_examples(
             prompt_entry["system_prompt"] = system_prompt
             convo = conversation_from_prompt(prompt_entry)
             if convo:
-                formatted.append(convo)
-    return formatted
+                yield convo
 
 
 def format_knowledge_examples(
     dataset: Dataset,
     persona_name: str,
     persona_description: str,
-) -> List[Dict[str, Any]]:
+) -> Iterator[Dict[str, Any]]:
     system_prompt = build_persona_header(persona_name, persona_description)
-    formatted: List[Dict[str, Any]] = []
-    for example in dataset:
+    for example in iter_rows(dataset):
         prompt_entry = build_knowledge_prompt(example, persona_name, persona_description)
         if not prompt_entry:
             continue
         prompt_entry["system_prompt"] = system_prompt
         convo = conversation_from_prompt(prompt_entry)
         if convo:
-            formatted.append(convo)
-    return formatted
+            yield convo
+
+
+_SAMPLE_IDS = itertools.count()
 
 
 class ConversationDataset(TorchDataset):
-    def __init__(self, conversations: Sequence[Dict[str, Any]]):
-        self._data = list(conversations)
+    def __init__(self, conversations: Iterable[Dict[str, Any]]):
+        # Готовый список берём как есть: prepare_datasets собирает его один раз, без лишней копии.
+        self._data = conversations if isinstance(conversations, list) else list(conversations)
+        # Стабильный id примера — ключ кэшей коллатора. Счётчик общий для train и eval, так как
+        # коллатор у них один; повторы knowledge делят один dict и один id.
+        for conv in self._data:
+            if "sample_id" not in conv:
+                conv["sample_id"] = next(_SAMPLE_IDS)
+        self._blob: Optional[bytes] = None
+        self._offsets: Optional[array.array] = None
+        self._lengths: Optional[List[int]] = None
+
+    @property
+    def conversations(self) -> List[Dict[str, Any]]:
+        if self._blob is not None:
+            return [self[idx] for idx in range(len(self))]
+        return self._data
 
     def __len__(self) -> int:
+        if self._offsets is not None:
+            return len(self._offsets) - 1
         return len(self._data)
 
     def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if self._blob is not None:
+            if idx < 0:
+                idx += len(self)
+            return orjson.loads(self._blob[self._offsets[idx] : self._offsets[idx + 1]])
         return self._data[idx]
 
+    @property
+    def lengths(self) -> Optional[List[int]]:
+        """Длины примеров в токенах из precompute_lengths или None, если они не посчитаны."""
+        if self._blob is not None:
+            return self._lengths
+        if not self._data or any("num_tokens" not in conv for conv in self._data):
+            return None
+        return [conv["num_tokens"] for conv in self._data]
+
+    def compact(self) -> None:
+        """Упаковывает примеры в один bytes-буфер после всех precompute-проходов.
+
+        Список dict после fork копируется в каждый воркер DataLoader: счётчики ссылок
+        пишутся в те же страницы памяти. Один буфер со смещениями не трогается при чтении,
+        а orjson.loads на пример дешевле работы коллатора.
+        """
+        if orjson is None or self._blob is not None or not self._data:
+            return
+        try:
+            encoded = [orjson.dumps(conv) for conv in self._data]
+        except TypeError as exc:  # orjson.JSONEncodeError — подкласс TypeError
+            logger.info("Примеры не сериализуются в JSON, оставляю их как dict: %s", exc)
+            return
+        self._lengths = self.lengths
+        offsets = array.array("q", [0])
+        for chunk in encoded:
+            offsets.append(offsets[-1] + len(chunk))
+        self._blob = b"".join(encoded)
+        self._offsets = offsets
+        self._data = []
+
 
 def build_data_collator(
     backend: str,
@@ -799,7 +1044,57 @@ def build_data_collator(
 
 class BaseVLDataCollator:
     """Marker base class for type checking."""
-    pass
+
+    _prompt_len_cache: Dict[str, int]
+    _decode_pool: Optional[Tuple[int, ThreadPoolExecutor]] = None
+
+    def map_in_threads(self, fn: Any, items: Sequence[Any]) -> List[Any]:
+        """Декодирует медиа примеров батча параллельно: PIL отпускает GIL на decode/resize.
+
+        Пул создаётся лениво и привязан к pid: после fork воркера DataLoader
+        унаследованный пул без потоков не годится, поэтому заводим свой.
+        """
+        if len(items) < 2:
+            return [fn(item) for item in items]
+        pid = os.getpid()
+        if self._decode_pool is None or self._decode_pool[0] != pid:
+            self._decode_pool = (pid, ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix="vl-decode"))
+        return list(self._decode_pool[1].map(fn, items))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Пул потоков не сериализуется — при spawn-воркерах он создаётся заново.
+        state = self.__dict__.copy()
+        state.pop("_decode_pool", None)
+        return state
+
+    def cached_prompt_lengths(self, tokenizer: Any, prompt_texts: Sequence[str]) -> List[int]:
+        """Длины промптов в токенах; токенизатор вызывается одним батчем и только для новых текстов.
+
+        Воркеры DataLoader постоянные, поэтому со второй эпохи все промпты уже в кэше.
+        """
+        cache = self._prompt_len_cache
+        missing = [text for text in dict.fromkeys(prompt_texts) if text not in cache]
+        if missing:
+            lengths = tokenizer(missing, add_special_tokens=False, return_length=True)["length"]
+            cache.update(zip(missing, lengths))
+        return [cache[text] for text in prompt_texts]
+
+
+def build_labels(
+    input_ids: torch.Tensor,
+    prompt_lengths: Sequence[int],
+    attention_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Метки из input_ids с -100 на промпте и паддинге (паддинг справа).
+
+    torch.where пишет результат сразу в новый тензор — без отдельного clone() и второго прохода.
+    """
+    lengths = torch.as_tensor(prompt_lengths, dtype=torch.long, device=input_ids.device)
+    positions = torch.arange(input_ids.shape[1], device=input_ids.device)
+    mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+    if attention_mask is not None:
+        mask |= attention_mask == 0
+    return torch.where(mask, torch.full_like(input_ids, -100), input_ids)
 
 
 def render_with_template(
@@ -833,6 +1128,26 @@ def render_with_template(
     return "\n".join(lines).strip()
 
 
+def render_batch_with_template(
+    processor: AutoProcessor,
+    conversations: Sequence[Sequence[Dict[str, Any]]],
+    add_generation_prompt: bool,
+) -> List[str]:
+    """Рендерит весь минибатч одним вызовом apply_chat_template, если процессор принимает список диалогов."""
+    if len(conversations) > 1 and callable(getattr(processor, "apply_chat_template", None)):
+        try:
+            rendered = processor.apply_chat_template(
+                [list(conv) for conv in conversations],
+                tokenize=False,
+                add_generation_prompt=add_generation_prompt,
+            )
+        except (TypeError, ValueError, KeyError, AttributeError):
+            rendered = None
+        if isinstance(rendered, list) and len(rendered) == len(conversations):
+            return rendered
+    return [render_with_template(processor, conv, add_generation_prompt) for conv in conversations]
+
+
 def convert_messages_for_glm(
     messages: Sequence[Dict[str, Any]]
 ) -> Tuple[List[Dict[str, Any]], List[Image.Image]]:
@@ -879,6 +1194,107 @@ def convert_messages_for_glm(
     return converted, images
 
 
+MEDIA_BLOCK_TYPES = frozenset({"image", "video"})
+IMAGE_BLOCK_TYPES = frozenset({"image"})
+
+
+def scan_media_blocks(messages: Sequence[Dict[str, Any]], supports_videos: bool = True) -> Tuple[bool, bool]:
+    # Типы блоков копим в set и выходим, как только найдено всё, что интересует коллатор.
+    wanted = MEDIA_BLOCK_TYPES if supports_videos else IMAGE_BLOCK_TYPES
+    found: set = set()
+    for message in messages:
+        content = message.get("content")
+        if not content or isinstance(content, str):
+            continue
+        if isinstance(content, dict):
+            content = (content,)
+        found.update(block.get("type") for block in content if isinstance(block, dict))
+        if wanted <= found:
+            break
+    return "image" in found, "video" in found
+
+
+def unique_conversations(conversations: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Одна запись на объект: повторы knowledge_repeat ссылаются на те же dict."""
+    return list({id(conv): conv for conv in conversations}.values())
+
+
+def precompute_qwen_features(conversations: List[Dict[str, Any]], processor: AutoProcessor) -> None:
+    """Один раз за прогон рендерит шаблон и считает длину промпта.
+
+    Без этого коллатор повторяет apply_chat_template и токенизацию промпта
+    для каждого примера на каждой эпохе.
+    """
+    valid = [
+        conv
+        for conv in unique_conversations(conversations)
+        if len(conv.get("messages") or []) >= 2 and conv["messages"][-1]["role"] == "assistant"
+    ]
+    if not valid:
+        return
+    prompt_texts: List[str] = []
+    for conv in valid:
+        messages = conv["messages"]
+        conv["full_text"] = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+        prompt_texts.append(
+            processor.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=True)
+        )
+        conv["has_images"], conv["has_videos"] = scan_media_blocks(messages)
+    # Батчевый вызов fast-токенизатора идёт в Rust и параллелится, в отличие от поштучного.
+    lengths = processor.tokenizer(prompt_texts, add_special_tokens=False, return_length=True)["length"]
+    for conv, length in zip(valid, lengths):
+        conv["prompt_length"] = length
+
+
+def precompute_rendered_texts(conversations: List[Dict[str, Any]], processor: AutoProcessor) -> None:
+    """Рендерит шаблон и длину промпта один раз за прогон для коллаторов на render_with_template."""
+    valid = [
+        conv
+        for conv in unique_conversations(conversations)
+        if len(conv.get("messages") or []) >= 2 and conv["messages"][-1]["role"] == "assistant"
+    ]
+    tokenizer = getattr(processor, "tokenizer", None)
+    if not valid or tokenizer is None:
+        return
+    all_messages = [conv["messages"] for conv in valid]
+    full_texts = render_batch_with_template(processor, all_messages, add_generation_prompt=False)
+    prompt_texts = render_batch_with_template(
+        processor,
+        [messages[:-1] for messages in all_messages],
+        add_generation_prompt=True,
+    )
+    lengths = tokenizer(prompt_texts, add_special_tokens=False, return_length=True)["length"]
+    for conv, full_text, length in zip(valid, full_texts, lengths):
+        conv["full_text"] = full_text
+        conv["prompt_length"] = length
+
+
+def precompute_image_refs(conversations: List[Dict[str, Any]]) -> None:
+    """Собирает ссылки на изображения один раз, чтобы коллатор не обходил вложенные dict на каждом батче."""
+    for conv in unique_conversations(conversations):
+        refs: List[str] = []
+        for message in conv.get("messages") or []:
+            refs.extend(extract_image_refs(message))
+        conv["image_refs"] = dedupe_preserving_order(refs)
+
+
+def precompute_lengths(conversations: List[Dict[str, Any]], processor: AutoProcessor) -> None:
+    """Считает длину каждого примера в токенах для сэмплера, группирующего батчи по длине."""
+    tokenizer = getattr(processor, "tokenizer", None)
+    conversations = unique_conversations(conversations)
+    if tokenizer is None or not conversations:
+        return
+    # Для группировки достаточно относительного порядка: токены изображений не учитываем.
+    texts = [
+        conv.get("full_text")
+        or "\n".join(extract_text_from_block(msg.get("content")) for msg in conv.get("messages") or [])
+        for conv in conversations
+    ]
+    lengths = tokenizer(texts, add_special_tokens=False, return_length=True)["length"]
+    for conv, length in zip(conversations, lengths):
+        conv["num_tokens"] = length
+
+
 class QwenVLDataCollator(BaseVLDataCollator):
     def __init__(
         self,
@@ -889,13 +1305,14 @@ class QwenVLDataCollator(BaseVLDataCollator):
         self.processor = processor
         self.max_length = max_length
         self.pad_to_multiple_of = pad_to_multiple_of
+        self._prompt_len_cache = {}
         self.supports_videos = True
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
         texts: List[str] = []
-        prompt_texts: List[str] = []
-        image_inputs: List[Any] = []
+        prompt_lengths: List[int] = []
         video_inputs: Optional[List[Any]] = [] if self.supports_videos else None
+        media_jobs: List[Tuple[int, Any]] = []
 
         for feature in features:
             messages = feature.get("messages")
@@ -904,67 +1321,52 @@ class QwenVLDataCollator(BaseVLDataCollator):
             if messages[-1]["role"] != "assistant":
                 raise ValueError("Последнее сообщение должно быть ассистента для вычисления лосса.")
 
-            prompt_messages = messages[:-1]
-            full_text = self.processor.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=False,
-            )
-            prompt_text = self.processor.apply_chat_template(
-                prompt_messages,
-                tokenize=False,
+        # Примеры без предрассчитанных полей (датасет подан в обход run_training) рендерим
+        # и токенизируем одним батчевым вызовом, а не по одному.
+        pending = [idx for idx, feature in enumerate(features) if "full_text" not in feature or "prompt_length" not in feature]
+        rendered: Dict[int, Tuple[str, int]] = {}
+        if pending:
+            pending_messages = [features[idx]["messages"] for idx in pending]
+            full_texts = render_batch_with_template(self.processor, pending_messages, add_generation_prompt=False)
+            pending_prompts = render_batch_with_template(
+                self.processor,
+                [messages[:-1] for messages in pending_messages],
                 add_generation_prompt=True,
             )
-            texts.append(full_text)
-            prompt_texts.append(prompt_text)
-
-            has_images = False
-            has_videos = False
-            for message in messages:
-                content = message.get("content") or []
-                if isinstance(content, dict):
-                    content = [content]
-                for block in content:
-                    if not isinstance(block, dict):
-                        continue
-                    block_type = block.get("type")
-                    if block_type == "image":
-                        has_images = True
-                    elif block_type == "video":
-                        has_videos = True
-                if has_images and (has_videos or not self.supports_videos):
-                    break
-
-            image_input: Any = None
-            video_input: Any = None
-            needs_media = has_images or (self.supports_videos and has_videos)
-            if needs_media:
-                image_input, video_input = process_vision_info(messages)
-
-            image_inputs.append(image_input)
-            if self.supports_videos and video_inputs is not None:
-                video_inputs.append(video_input)
-
-        images_arg: Optional[List[Any]]
-        videos_arg: Optional[List[Any]]
-
-        if any(item is not None for item in image_inputs):
-            images_arg = [
-                sample if sample is not None else []
-                for sample in image_inputs
-            ]
-        else:
-            images_arg = None
-
-        if self.supports_videos and video_inputs is not None and any(
-            item is not None for item in video_inputs
-        ):
-            videos_arg = [
-                sample if sample is not None else []
-                for sample in video_inputs
-            ]
-        else:
-            videos_arg = None
+            pending_lengths = self.cached_prompt_lengths(self.processor.tokenizer, pending_prompts)
+            for idx, full_text, prompt_length in zip(pending, full_texts, pending_lengths):
+                rendered[idx] = (full_text, prompt_length)
+
+        for idx, feature in enumerate(features):
+            messages = feature["messages"]
+            if idx in rendered:
+                full_text, prompt_length = rendered[idx]
+                texts.append(full_text)
+                prompt_lengths.append(prompt_length)
+                has_images, has_videos = scan_media_blocks(messages, self.supports_videos)
+            else:
+                texts.append(feature["full_text"])
+                prompt_lengths.append(feature["prompt_length"])
+                has_images, has_videos = feature["has_images"], feature["has_videos"]
+
+            if has_images or (self.supports_videos and has_videos):
+                media_jobs.append((idx, messages))
+
+        media_by_idx: List[Tuple[Any, Any]] = [(None, None)] * len(features)
+        if media_jobs:
+            decoded = self.map_in_threads(process_vision_info, [messages for _, messages in media_jobs])
+            for (idx, _), media in zip(media_jobs, decoded):
+                media_by_idx[idx] = media
+        image_inputs: List[Any] = [image_input for image_input, _ in media_by_idx]
+        if self.supports_videos and video_inputs is not None:
+            video_inputs = [video_input for _, video_input in media_by_idx]
+
+        # Процессор Qwen всё равно расплющивает вложенные списки по порядку <|image_pad|> в тексте,
+        # поэтому передаём сразу плоский список без пустых [] на текстовые примеры.
+        images_arg: List[Any] = [image for sample in image_inputs if sample for image in sample]
+        videos_arg: List[Any] = []
+        if self.supports_videos and video_inputs is not None:
+            videos_arg = [video for sample in video_inputs if sample for video in sample]
 
         processor_kwargs: Dict[str, Any] = {
             "text": texts,
@@ -973,23 +1375,14 @@ class QwenVLDataCollator(BaseVLDataCollator):
             "pad_to_multiple_of": self.pad_to_multiple_of,
             "return_tensors": "pt",
         }
-        if images_arg is not None:
+        if images_arg:
             processor_kwargs["images"] = images_arg
-        if videos_arg is not None:
+        if videos_arg:
             processor_kwargs["videos"] = videos_arg
 
         batch = self.processor(**processor_kwargs)
 
-        labels = batch["input_ids"].clone()
-        for idx, prompt_text in enumerate(prompt_texts):
-            prompt_ids = self.processor.tokenizer(
-                prompt_text,
-                add_special_tokens=False,
-            )["input_ids"]
-            prompt_length = min(len(prompt_ids), labels.shape[1])
-            labels[idx, :prompt_length] = -100
-        labels[batch["attention_mask"] == 0] = -100
-        batch["labels"] = labels
+        batch["labels"] = build_labels(batch["input_ids"], prompt_lengths, batch["attention_mask"])
         return batch
 
 
@@ -1003,38 +1396,51 @@ class PaligemmaDataCollator(BaseVLDataCollator):
         self.processor = processor
         self.max_length = max_length
         self.pad_to_multiple_of = pad_to_multiple_of
+        self._prompt_len_cache = {}
         self._warned_images = False
+        # PaliGemma всё равно ресайзит в фиксированное разрешение — JPEG декодируем сразу уменьшенным.
+        self.draft_size = image_target_size(processor)
+
+    def _first_image(self, refs: Sequence[str]) -> Optional[Image.Image]:
+        for ref in refs:
+            image = load_image_from_ref(ref, self.draft_size)
+            if image is not None:
+                return image
+        return None
 
     def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
-        texts: List[str] = []
-        prompt_texts: List[str] = []
-        batch_images: List[Image.Image] = []
-        missing_images = False
-
+        batch_refs: List[List[str]] = []
         for feature in features:
             messages = feature.get("messages")
             if not messages or len(messages) < 2:
                 raise ValueError("Каждый пример должен содержать минимум system и user сообщения.")
             if messages[-1]["role"] != "assistant":
                 raise ValueError("Последнее сообщение должно быть ассистента для вычисления лосса.")
-            full_text = render_with_template(self.processor, messages, add_generation_prompt=False)
-            prompt_messages = messages[:-1] if len(messages) > 1 else messages
-            prompt_text = render_with_template(self.processor, prompt_messages, add_generation_prompt=True)
-            texts.append(full_text)
-            prompt_texts.append(prompt_text)
-
-            sample_refs: List[str] = []
-            for message in messages:
-                sample_refs.extend(extract_image_refs(message))
-            sample_image: Optional[Image.Image] = None
-            for ref in sample_refs:
-                sample_image = load_image_from_ref(ref)
-                if sample_image is not None:
-                    break
-            if sample_image is None:
-                missing_images = True
-                sample_image = create_dummy_image()
-            batch_images.append(sample_image)
+            sample_refs: List[str] = feature.get("image_refs")
+            if sample_refs is None:
+                sample_refs = []
+                for message in messages:
+                    sample_refs.extend(extract_image_refs(message))
+            batch_refs.append(sample_refs)
+
+        loaded = self.map_in_threads(self._first_image, batch_refs)
+        missing_images = any(image is None for image in loaded)
+        batch_images = [image if image is not None else create_dummy_image() for image in loaded]
+
+        if not hasattr(self.processor, "tokenizer") or self.processor.tokenizer is None:
+            raise ValueError("Paligemma processor не содержит tokenizer для маскирования меток.")
+        if all("full_text" in feature and "prompt_length" in feature for feature in features):
+            texts = [feature["full_text"] for feature in features]
+            prompt_lengths = [feature["prompt_length"] for feature in features]
+        else:
+            batch_messages = [feature["messages"] for feature in features]
+            texts = render_batch_with_template(self.processor, batch_messages, add_generation_prompt=False)
+            prompt_texts = render_batch_with_template(
+                self.processor,
+                [messages[:-1] for messages in batch_messages],
+                add_generation_prompt=True,
+            )
+            prompt_lengths = self.cached_prompt_lengths(self.processor.tokenizer, prompt_texts)
 
         if missing_images and not self._warned_images:
             logger.warning(
@@ -1054,21 +1460,7 @@ class PaligemmaDataCollator(BaseVLDataCollator):
         processor_kwargs["images"] = batch_images
 
         batch = self.processor(**processor_kwargs)
-        if not hasattr(self.processor, "tokenizer") or self.processor.tokenizer is None:
-            raise ValueError("Paligemma processor не содержит tokenizer для маскирования меток.")
-
-        labels = batch["input_ids"].clone()
-        for idx, prompt_text in enumerate(prompt_texts):
-            prompt_ids = self.processor.tokenizer(
-                prompt_text,
-                add_special_tokens=False,
-            )["input_ids"]
-            prompt_len = min(len(prompt_ids), labels.shape[1])
-            labels[idx, :prompt_len] = -100
-        attention_mask = batch.get("attention_mask")
-        if attention_mask is not None:
-            labels[attention_mask == 0] = -100
-        batch["labels"] = labels
+        batch["labels"] = build_labels(batch["input_ids"], prompt_lengths, batch.get("attention_mask"))
         return batch
 
 
@@ -1082,6 +1474,9 @@ class GLM4VDataCollator(BaseVLDataCollator):
         self.processor = processor
         self.max_length = max_length
         self.pad_to_multiple_of = pad_to_multiple_of
+        self._prompt_len_cache = {}
+        # Отрендеренные (full_text, prompt_text) по примеру: со второй эпохи Jinja не вызывается.
+        self._render_cache: Dict[Tuple[int, int], Tuple[str, str]] = {}
         tokenizer = getattr(processor, "tokenizer", None)
         if tokenizer is None:
             raise ValueError("AutoProcessor для GLM должен иметь tokenizer.")
@@ -1103,29 +1498,36 @@ class GLM4VDataCollator(BaseVLDataCollator):
                 raise ValueError("Каждый пример должен содержать минимум system и user сообщения.")
             if messages[-1]["role"] != "assistant":
                 raise ValueError("Последнее сообщение должно быть ассистента для вычисления лосса.")
-            converted, images = convert_messages_for_glm(messages)
+
+        conversions = self.map_in_threads(convert_messages_for_glm, [feature["messages"] for feature in features])
+        for converted, images in conversions:
             prompt_converted = converted[:-1] if len(converted) > 1 else converted
             batch_messages.append(converted)
             batch_prompt_messages.append(prompt_converted)
             batch_images.append(images)
 
-        full_texts: List[str] = []
-        prompt_texts: List[str] = []
-        for converted, prompt_converted in zip(batch_messages, batch_prompt_messages):
-            full_texts.append(
-                self.processor.apply_chat_template(
-                    converted,
-                    tokenize=False,
-                    add_generation_prompt=False,
-                )
+        # Шаблон зависит от того, какие картинки загрузились, поэтому ключ — (sample_id, число картинок).
+        keys = [
+            (feature.get("sample_id"), len(images)) if feature.get("sample_id") is not None else None
+            for feature, images in zip(features, batch_images)
+        ]
+        misses = [idx for idx, key in enumerate(keys) if key is None or key not in self._render_cache]
+        if misses:
+            rendered_full = render_batch_with_template(
+                self.processor, [batch_messages[idx] for idx in misses], add_generation_prompt=False
             )
-            prompt_texts.append(
-                self.processor.apply_chat_template(
-                    prompt_converted,
-                    tokenize=False,
-                    add_generation_prompt=True,
-                )
+            rendered_prompts = render_batch_with_template(
+                self.processor, [batch_prompt_messages[idx] for idx in misses], add_generation_prompt=True
             )
+            fresh = dict(zip(misses, zip(rendered_full, rendered_prompts)))
+            for idx, texts in fresh.items():
+                if keys[idx] is not None:
+                    self._render_cache[keys[idx]] = texts
+        else:
+            fresh = {}
+        pairs = [fresh[idx] if idx in fresh else self._render_cache[key] for idx, key in enumerate(keys)]
+        full_texts = [full_text for full_text, _ in pairs]
+        prompt_texts = [prompt_text for _, prompt_text in pairs]
 
         processor_kwargs: Dict[str, Any] = {
             "text": full_texts,
@@ -1139,29 +1541,38 @@ class GLM4VDataCollator(BaseVLDataCollator):
         if any(images for images in batch_images):
             processor_kwargs["images"] = batch_images
 
-        outputs = self.processor(**processor_kwargs)
-        batch = {key: value for key, value in outputs.items()}
+        # BatchFeature уже ведёт себя как dict: метки дописываем в него без копии.
+        batch = self.processor(**processor_kwargs)
 
         if "labels" not in batch:
-            labels = batch["input_ids"].clone()
-            for idx, prompt_text in enumerate(prompt_texts):
-                prompt_ids = self.tokenizer(
-                    prompt_text,
-                    add_special_tokens=False,
-                )["input_ids"]
-                prompt_len = min(len(prompt_ids), labels.shape[1])
-                labels[idx, :prompt_len] = -100
             attention = batch.get("attention_mask")
-            if attention is not None:
-                labels[attention == 0] = -100
-            else:
-                labels[labels == self.pad_token_id] = -100
+            labels = build_labels(batch["input_ids"], self.cached_prompt_lengths(self.tokenizer, prompt_texts), attention)
+            if attention is None:
+                labels.masked_fill_(labels == self.pad_token_id, -100)
             batch["labels"] = labels
 
         return batch
 
 
-class GLMTrainer(Trainer):
+class LengthGroupedTrainer(Trainer):
+    """Trainer, который группирует батчи по длинам ConversationDataset.lengths.
+
+    Штатный group_by_length умеет брать длины только из datasets.Dataset или из input_ids
+    самих примеров, а наши примеры токенизируются в коллаторе.
+    """
+
+    def _get_train_sampler(self, *args, **kwargs):
+        dataset = args[0] if args else kwargs.get("train_dataset", self.train_dataset)
+        lengths = getattr(dataset, "lengths", None)
+        if not self.args.group_by_length or lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthGroupedSampler(
+            self.args.train_batch_size * self.args.gradient_accumulation_steps,
+            lengths=lengths,
+        )
+
+
+class GLMTrainer(LengthGroupedTrainer):
     def compute_loss(
         self,
         model,
@@ -1188,6 +1599,44 @@ def maybe_enable_tf32(enable: bool) -> None:
         torch.backends.cudnn.allow_tf32 = True
 
 
+def bf16_supported() -> bool:
+    return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
+
+def use_bf16(args: argparse.Namespace) -> bool:
+    """--bf16/--no-bf16 побеждают; без флага выбираем bf16 по возможностям GPU."""
+    explicit = getattr(args, "bf16", None)
+    return bf16_supported() if explicit is None else bool(explicit)
+
+
+# Бэкенды, для которых transformers поддерживает FlashAttention-2.
+FLASH_ATTENTION_BACKENDS = ("qwen2_vl", "glm4v")
+
+
+def select_attn_implementation(backend_name: str) -> str:
+    """FlashAttention-2 на Ampere+ при установленном flash-attn, иначе fused SDPA из PyTorch."""
+    if (
+        backend_name in FLASH_ATTENTION_BACKENDS
+        and torch.cuda.is_available()
+        and torch.cuda.get_device_capability()[0] >= 8
+    ):
+        try:
+            import flash_attn  # noqa: F401
+        except ImportError:
+            logger.info("flash-attn не установлен — используем SDPA.")
+        else:
+            return "flash_attention_2"
+    return "sdpa"
+
+
+def base_model_dtype(args: argparse.Namespace) -> torch.dtype:
+    # Неквантованные модули (vision tower, нормализации, lm_head) сразу в bf16, а не в fp32.
+    if use_bf16(args):
+        return torch.bfloat16
+    # --no-bf16 воспроизводит прежние fp16-прогоны: эти модули тогда оставались в fp32.
+    return torch.float32 if getattr(args, "bf16", None) is False else torch.float16
+
+
 def build_quant_config() -> BitsAndBytesConfig:
     return BitsAndBytesConfig(
         load_in_4bit=True,
@@ -1197,7 +1646,47 @@ def build_quant_config() -> BitsAndBytesConfig:
     )
 
 
+def load_base_model(backend_name: str, args: argparse.Namespace) -> Any:
+    if backend_name == "qwen2_vl":
+        model_class = Qwen2_5_VLForConditionalGeneration
+    elif backend_name == "glm4v":
+        model_class = Glm4vForConditionalGeneration
+    else:
+        model_class = PaliGemmaForConditionalGeneration
+    model = model_class.from_pretrained(
+        args.model_id,
+        device_map="auto",
+        quantization_config=build_quant_config(),
+        torch_dtype=base_model_dtype(args),
+        attn_implementation=select_attn_implementation(backend_name),
+        trust_remote_code=args.trust_remote_code,
+    )
+    logger.info("Реализация attention: %s", getattr(model.config, "_attn_implementation", "unknown"))
+    return model
+
+
+def acquire_base_model(backend_name: str, args: argparse.Namespace, reuse: bool) -> Any:
+    key = (backend_name, args.model_id, bool(args.trust_remote_code))
+    if reuse and key in _BASE_MODEL_CACHE:
+        logger.info("Переиспользую уже загруженную базовую модель %s.", args.model_id)
+        return _BASE_MODEL_CACHE.pop(key)
+    _BASE_MODEL_CACHE.clear()
+    return load_base_model(backend_name, args)
+
+
+def release_base_model(backend_name: str, args: argparse.Namespace, peft_model: Any) -> None:
+    """Снимает LoRA-слои и кладёт чистую базовую модель в кэш для следующего запуска."""
+    base_model = peft_model.unload()
+    if hasattr(base_model, "disable_input_require_grads"):
+        base_model.disable_input_require_grads()
+    _BASE_MODEL_CACHE[(backend_name, args.model_id, bool(args.trust_remote_code))] = base_model
+
+
 def build_lora_config(args: argparse.Namespace) -> LoraConfig:
+    extra: Dict[str, Any] = {}
+    if args.use_rslora:
+        # use_rslora есть только в peft>=0.7 — передаём лишь по явному запросу.
+        extra["use_rslora"] = True
     return LoraConfig(
         r=args.lora_r,
         lora_alpha=args.lora_alpha,
@@ -1205,6 +1694,7 @@ def build_lora_config(args: argparse.Namespace) -> LoraConfig:
         lora_dropout=args.lora_dropout,
         bias="none",
         task_type="CAUSAL_LM",
+        **extra,
     )
 
 
@@ -1222,40 +1712,59 @@ def prepare_datasets(
     knowledge_raw: Optional[Dataset],
     history_config: HistoryConfig,
 ) -> tuple[ConversationDataset, ConversationDataset]:
-    train_examples = format_style_examples(
-        style_train_raw,
-        persona_name=args.persona_name,
-        persona_description=args.persona_description,
-        history_config=history_config,
+    train_examples = list(
+        format_style_examples(
+            style_train_raw,
+            persona_name=args.persona_name,
+            persona_description=args.persona_description,
+            history_config=history_config,
+        )
     )
-    eval_examples = format_style_examples(
-        style_eval_raw,
-        persona_name=args.persona_name,
-        persona_description=args.persona_description,
-        history_config=history_config,
+    # Eval не перемешивается, поэтому форматируем только нужные max_eval_samples примеров.
+    eval_examples = list(
+        itertools.islice(
+            format_style_examples(
+                style_eval_raw,
+                persona_name=args.persona_name,
+                persona_description=args.persona_description,
+                history_config=history_config,
+            ),
+            args.max_eval_samples,
+        )
     )
 
+    knowledge_examples: List[Dict[str, Any]] = []
     if knowledge_raw is not None:
-        knowledge_examples = format_knowledge_examples(
-            knowledge_raw,
-            persona_name=args.persona_name,
-            persona_description=args.persona_description,
+        knowledge_examples = list(
+            format_knowledge_examples(
+                knowledge_raw,
+                persona_name=args.persona_name,
+                persona_description=args.persona_description,
+            )
         )
-        repeated = knowledge_examples * max(1, args.knowledge_repeat)
-        train_examples.extend(repeated)
 
     rng = random.Random(args.seed)
-    rng.shuffle(train_examples)
-
-    if args.max_train_samples is not None:
-        train_examples = train_examples[: args.max_train_samples]
-    if args.max_eval_samples is not None:
-        eval_examples = eval_examples[: args.max_eval_samples]
+    num_style = len(train_examples)
+    repeat = max(1, args.knowledge_repeat) if knowledge_examples else 0
+    total = num_style + len(knowledge_examples) * repeat
+
+    if args.max_train_samples is not None and args.max_train_samples < total:
+        # Выбираем индексы в виртуальном списке style + knowledge * repeat,
+        # не разворачивая повторы: память O(max_train_samples), а не O(total).
+        picks = rng.sample(range(total), max(0, args.max_train_samples))
+        train_examples = [
+            train_examples[idx] if idx < num_style else knowledge_examples[(idx - num_style) % len(knowledge_examples)]
+            for idx in picks
+        ]
+    else:
+        # Повторы ссылаются на те же dict, а не на копии.
+        train_examples.extend(knowledge_examples * repeat)
+        rng.shuffle(train_examples)
 
     return ConversationDataset(train_examples), ConversationDataset(eval_examples)
 
 
-def run_training(args: argparse.Namespace) -> TrainingRunResult:
+def run_training(args: argparse.Namespace, reuse_base_model: bool = False) -> TrainingRunResult:
     configure_logging(args.log_level)
     # Если пользователь указал явный системный промт, используем его как persona_description
     if getattr(args, "system_prompt", None):
@@ -1265,7 +1774,8 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
     args.vl_backend = backend_name
     logger.info("Запускаю тренировку QLoRA для модели %s (backend=%s)", args.model_id, backend_name)
 
-    maybe_enable_tf32(args.tf32)
+    # На картах с bf16 (Ampere+) есть и TF32: включаем оба без явных флагов.
+    maybe_enable_tf32(args.tf32 or bf16_supported())
 
     if not torch.cuda.is_available():
         raise SystemError("Для QLoRA требуется GPU с поддержкой CUDA.")
@@ -1310,40 +1820,50 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
         raise RuntimeError("Обучающий датасет пуст — нечего тренировать.")
     if len(eval_dataset) == 0:
         logger.warning("Eval датасет пуст — метрики по валидации недоступны.")
-
+    if backend_name == "qwen2_vl":
+        precompute_qwen_features(train_dataset.conversations, processor)
+        precompute_qwen_features(eval_dataset.conversations, processor)
+    elif backend_name == "paligemma":
+        precompute_image_refs(train_dataset.conversations)
+        precompute_image_refs(eval_dataset.conversations)
+        precompute_rendered_texts(train_dataset.conversations, processor)
+        precompute_rendered_texts(eval_dataset.conversations, processor)
+    group_by_length = args.batch_size > 1 and not args.no_group_by_length
+    if group_by_length:
+        precompute_lengths(train_dataset.conversations, processor)
+
+    if args.dataloader_num_workers is None:
+        # Каждый воркер держит свою копию процессора: больше 8 обычно не ускоряет, а память ест.
+        num_workers = min(MAX_DEFAULT_WORKERS, max(2, (os.cpu_count() or 4) // 2))
+    else:
+        num_workers = max(0, args.dataloader_num_workers)
+    # Примеры уже дополнены precompute-полями — упаковываем их для воркеров DataLoader.
+    if num_workers > 0:
+        train_dataset.compact()
+        eval_dataset.compact()
+
+    # Кратная 8 длина попадает в тайлы тензорных ядер; под torch.compile длины квантуем крупнее,
+    # чтобы Inductor перекомпилировал лишь несколько форм.
+    pad_to_multiple_of = args.pad_to_multiple_of or (
+        COMPILE_PAD_MULTIPLE if args.torch_compile else TENSOR_CORE_PAD_MULTIPLE
+    )
     data_collator = build_data_collator(
         backend_name,
         processor=processor,
         max_length=args.max_seq_length,
+        pad_to_multiple_of=pad_to_multiple_of,
     )
 
-    quant_config = build_quant_config()
-    if backend_name == "qwen2_vl":
-        model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            args.model_id,
-            device_map="auto",
-            quantization_config=quant_config,
-            trust_remote_code=args.trust_remote_code,
-        )
-    elif backend_name == "glm4v":
-        model = Glm4vForConditionalGeneration.from_pretrained(
-            args.model_id,
-            device_map="auto",
-            quantization_config=quant_config,
-            trust_remote_code=args.trust_remote_code,
-        )
-    else:
-        model = PaliGemmaForConditionalGeneration.from_pretrained(
-            args.model_id,
-            device_map="auto",
-            quantization_config=quant_config,
-            trust_remote_code=args.trust_remote_code,
-        )
+    model = acquire_base_model(backend_name, args, reuse_base_model)
     model = prepare_model_for_kbit_training(model)
     model = get_peft_model(model, build_lora_config(args))
     if hasattr(model, "config") and hasattr(model.config, "use_cache"):
         model.config.use_cache = False
-    model.gradient_checkpointing_enable()
+    # Нереентерабельный checkpointing: не требует requires_grad на входах и меньше держит в VRAM.
+    try:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs=GRADIENT_CHECKPOINTING_KWARGS)
+    except TypeError:  # pragma: no cover - старые transformers без gradient_checkpointing_kwargs
+        model.gradient_checkpointing_enable()
 
     training_kwargs = dict(
         output_dir=args.output_dir,
@@ -1358,11 +1878,32 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
         gradient_checkpointing=True,
         optim="paged_adamw_8bit",
         report_to="tensorboard",
-        dataloader_num_workers=max(0, args.dataloader_num_workers),
+        dataloader_num_workers=num_workers,
         remove_unused_columns=False,
     )
 
     fields = TrainingArguments.__dataclass_fields__
+    # Коллаторы (рендер + декодирование изображений) выполняются в воркерах DataLoader;
+    # постоянные воркеры с запасом батчей держат GPU занятым между шагами.
+    if "dataloader_pin_memory" in fields:
+        training_kwargs["dataloader_pin_memory"] = True
+        # Из pinned-памяти батч копируется на GPU асинхронно, пока идёт предыдущий шаг.
+        if (
+            AcceleratorConfig is not None
+            and "non_blocking" in AcceleratorConfig.__dataclass_fields__
+            and "accelerator_config" in fields
+        ):
+            training_kwargs["accelerator_config"] = {"non_blocking": True}
+    if num_workers > 0:
+        if "dataloader_persistent_workers" in fields:
+            training_kwargs["dataloader_persistent_workers"] = True
+        if "dataloader_prefetch_factor" in fields:
+            training_kwargs["dataloader_prefetch_factor"] = 4
+    if group_by_length and "group_by_length" in fields:
+        # Примеры близкой длины в одном батче — меньше паддинга и лишних FLOPs.
+        training_kwargs["group_by_length"] = True
+    if "gradient_checkpointing_kwargs" in fields:
+        training_kwargs["gradient_checkpointing_kwargs"] = dict(GRADIENT_CHECKPOINTING_KWARGS)
     if "logging_strategy" in fields:
         training_kwargs["logging_strategy"] = IntervalStrategy.STEPS if IntervalStrategy else "steps"
     if "save_steps" in fields:
@@ -1381,10 +1922,23 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
         training_kwargs["metric_for_best_model"] = "eval_loss"
     if "greater_is_better" in fields:
         training_kwargs["greater_is_better"] = False
-    if args.bf16 and "bf16" in fields:
+    # bf16 не требует GradScaler и совпадает с compute dtype NF4; fp16 — только для карт без bf16.
+    if use_bf16(args) and "bf16" in fields:
         training_kwargs["bf16"] = True
+        if "bf16_full_eval" in fields:
+            training_kwargs["bf16_full_eval"] = True
+        if "tf32" in fields and torch.cuda.get_device_capability()[0] >= 8:
+            training_kwargs["tf32"] = True
     elif "fp16" in fields:
         training_kwargs["fp16"] = True
+    if args.torch_compile and "torch_compile" in fields:
+        # Trainer сам оборачивает модель и снимает обёртку при save_pretrained.
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        training_kwargs["torch_compile"] = True
+        if "torch_compile_mode" in fields:
+            training_kwargs["torch_compile_mode"] = args.torch_compile_mode
+    elif args.torch_compile:
+        logger.warning("Эта версия transformers не поддерживает torch_compile — флаг проигнорирован.")
 
     training_args = TrainingArguments(**training_kwargs)
 
@@ -1392,7 +1946,7 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
     if EarlyStoppingCallback is not None and args.early_stopping_patience > 0:
         callbacks.append(EarlyStoppingCallback(early_stopping_patience=args.early_stopping_patience))
 
-    trainer_class = Trainer if backend_name != "glm4v" else GLMTrainer
+    trainer_class = LengthGroupedTrainer if backend_name != "glm4v" else GLMTrainer
     trainer = trainer_class(
         model=model,
         args=training_args,
@@ -1414,6 +1968,12 @@ def run_training(args: argparse.Namespace) -> TrainingRunResult:
     save_training_config(args, adapter_dir)
     logger.info("LoRA адаптер сохранён в %s", adapter_dir)
 
+    if reuse_base_model:
+        release_base_model(backend_name, args, trainer.model)
+        del trainer, model
+        gc.collect()
+        torch.cuda.empty_cache()
+
     return TrainingRunResult(
         adapter_dir=adapter_dir,
         output_dir=Path(args.output_dir),
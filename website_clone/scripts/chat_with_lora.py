@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 import argparse
+import functools
+import json
 import sys
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 
 import torch
@@ -12,20 +16,57 @@ from transformers import (
     AutoTokenizer,
     Qwen2_5_VLForConditionalGeneration,
 )
-from rag.retriever import KnowledgeRetriever, RetrievalResult
+from rag.rag_inference import select_attn_implementation
+from rag.retriever import EMBEDDING_DTYPES, KnowledgeRetriever, RetrievalResult
+
+# (model_id, adapter_dir) -> (model, processor/tokenizer, is_vl): в --serve веса грузятся один раз.
+_STATE: dict[tuple[str, str], tuple] = {}
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Chat with base model + LoRA adapter.")
     parser.add_argument("--model-id", required=True, help="Base model ID or path.")
     parser.add_argument("--adapter-dir", required=True, help="Path to LoRA adapter dir.")
-    parser.add_argument("--message", required=True, help="User message.")
+    parser.add_argument("--message", help="User message (required unless --serve).")
     parser.add_argument("--system-prompt", default="", help="Optional system prompt.")
     parser.add_argument("--max-new-tokens", type=int, default=200)
     parser.add_argument("--rag-index-dir", type=Path, help="Path to RAG index (embeddings.npy + records.jsonl).")
     parser.add_argument("--embedding-model", default="sentence-transformers/all-MiniLM-L6-v2", help="Embedding model id.")
     parser.add_argument("--top-k", type=int, default=4, help="How many knowledge snippets to include.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--embedding-dtype",
+        choices=EMBEDDING_DTYPES,
+        default="float32",
+        help="Resident precision of the corpus embeddings (float16/int8 shrink memory 2-4x).",
+    )
+    parser.add_argument(
+        "--quantize-embedder",
+        action="store_true",
+        help="Run the query embedder with dynamic int8 Linear layers when it is on CPU (on CUDA it already uses fp16).",
+    )
+    parser.add_argument("--serve", action="store_true", help="Keep the model loaded and answer POST /chat requests.")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address for --serve.")
+    parser.add_argument("--port", type=int, default=8765, help="Port for --serve.")
+    args = parser.parse_args()
+    if not args.serve and not args.message:
+        parser.error("--message is required unless --serve is set")
+    return args
+
+
+@functools.lru_cache(maxsize=8)
+def _get_retriever(
+    index_dir: str,
+    embedding_model: str,
+    embedding_dtype: str = "float32",
+    quantize_embedder: bool = False,
+) -> KnowledgeRetriever:
+    """One retriever per (index, embedder): the embedding model and index load once per process."""
+    return KnowledgeRetriever(
+        index_dir=Path(index_dir),
+        embedding_model=embedding_model,
+        embedding_dtype=embedding_dtype,
+        quantize_embedder=quantize_embedder,
+    )
 
 
 def maybe_retrieve(args: argparse.Namespace) -> tuple[list[RetrievalResult], str]:
@@ -35,7 +76,12 @@ def maybe_retrieve(args: argparse.Namespace) -> tuple[list[RetrievalResult], str
         return [], base_system
 
     try:
-        retriever = KnowledgeRetriever(index_dir=Path(args.rag_index_dir), embedding_model=args.embedding_model)
+        retriever = _get_retriever(
+            str(args.rag_index_dir),
+            args.embedding_model,
+            args.embedding_dtype,
+            args.quantize_embedder,
+        )
         snippets = retriever.search(args.message, k=max(1, args.top_k))
         if not snippets:
             return [], base_system
@@ -47,67 +93,180 @@ def maybe_retrieve(args: argparse.Namespace) -> tuple[list[RetrievalResult], str
         return [], base_system
 
 
-def main() -> None:
-    args = parse_args()
+def inference_dtype() -> torch.dtype:
+    """bf16 on Ampere+ (same speed as fp16, no overflow in softmax/norms), fp16 on older GPUs, fp32 on CPU."""
+    if not torch.cuda.is_available():
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
 
-    if not Path(args.adapter_dir).exists():
-        print(f"Adapter dir not found: {args.adapter_dir}", file=sys.stderr)
-        sys.exit(1)
 
-    snippets, system_prompt = maybe_retrieve(args)
-    model_id_lower = args.model_id.lower()
-    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+def load_adapter(base_model, adapter_dir: str):
+    """Attach the LoRA adapter and fold it into the base weights for decoding."""
+    model = PeftModel.from_pretrained(base_model, adapter_dir)
+    # База загружена в bf16/fp16/fp32 (см. inference_dtype), не в 4-bit: W + BA сливается без потерь,
+    # и на каждом шаге декодинга остаётся только базовый matmul.
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    # Адаптер мог сохранить use_cache=False из обучения — для декодинга KV-кэш обязателен.
+    model.config.use_cache = True
+    model.eval()
+    return model
+
+
+def load_chat_model(model_id: str, adapter_dir: str):
+    """Return (model, processor_or_tokenizer, is_vl), loading them once per process."""
+    key = (model_id, adapter_dir)
+    if key in _STATE:
+        return _STATE[key]
+
+    model_id_lower = model_id.lower()
+    dtype = inference_dtype()
+    attn_implementation = select_attn_implementation()
 
     # Qwen2.5-VL (and другие VL) требуют специфический класс, AutoModelForCausalLM не подходит.
     if "qwen" in model_id_lower and "vl" in model_id_lower:
-        processor = AutoProcessor.from_pretrained(args.model_id, trust_remote_code=True)
+        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
         base_model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            args.model_id,
+            model_id,
             trust_remote_code=True,
             device_map="auto",
             dtype=dtype,
+            attn_implementation=attn_implementation,
         )
-        model = PeftModel.from_pretrained(base_model, args.adapter_dir)
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": args.message},
-        ]
-
-        chat_text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        inputs = processor(text=[chat_text], return_tensors="pt").to(model.device)
-        outputs = model.generate(**inputs, max_new_tokens=args.max_new_tokens, do_sample=True)
-        # срезаем входные токены, чтобы получить только ответ
-        gen_ids = outputs[0][inputs["input_ids"].shape[-1] :]
-        text = processor.tokenizer.decode(gen_ids, skip_special_tokens=True).strip()
-        print(text)
-        return
+        _STATE[key] = (load_adapter(base_model, adapter_dir), processor, True)
+        return _STATE[key]
 
     # Текстовые модели (fallback)
-    tokenizer = AutoTokenizer.from_pretrained(args.model_id, trust_remote_code=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
     base_model = AutoModelForCausalLM.from_pretrained(
-        args.model_id,
+        model_id,
         trust_remote_code=True,
         device_map="auto",
         dtype=dtype,
+        attn_implementation=attn_implementation,
     )
-    model = PeftModel.from_pretrained(base_model, args.adapter_dir)
+    _STATE[key] = (load_adapter(base_model, adapter_dir), tokenizer, False)
+    return _STATE[key]
+
+
+def run_once(args: argparse.Namespace) -> str:
+    """Answer a single message with the (cached) model and return the reply text."""
+    snippets, system_prompt = maybe_retrieve(args)
+    model, processor, is_vl = load_chat_model(args.model_id, args.adapter_dir)
+    tokenizer = processor.tokenizer if is_vl else processor
 
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": args.message},
     ]
 
-    if hasattr(tokenizer, "apply_chat_template"):
-        prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    if is_vl:
+        chat_text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        inputs = processor(text=[chat_text], return_tensors="pt").to(model.device)
     else:
-        prompt = "\n".join([f"{m['role']}: {m['content']}" for m in messages]) + "\nassistant:"
+        if hasattr(tokenizer, "apply_chat_template"):
+            prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        else:
+            prompt = "\n".join([f"{m['role']}: {m['content']}" for m in messages]) + "\nassistant:"
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+
+    # pad id 0 допустим, поэтому проверяем именно на None.
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    with torch.inference_mode():
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=args.max_new_tokens,
+            do_sample=True,
+            use_cache=True,
+            pad_token_id=pad_token_id,
+        )
+    # срезаем входные токены, чтобы получить только ответ
+    gen_ids = outputs[0][inputs["input_ids"].shape[-1] :]
+    return tokenizer.decode(gen_ids, skip_special_tokens=True).strip()
+
+
+# Поля запроса /chat, которые можно переопределить, и их типы.
+CHAT_OVERRIDES: dict[str, type] = {"message": str, "system_prompt": str, "max_new_tokens": int, "top_k": int}
+
+
+def parse_chat_request(raw: bytes, defaults: argparse.Namespace) -> argparse.Namespace:
+    """Аргументы одного запроса /chat; ValueError — ошибка клиента (битый JSON, неверные поля)."""
+    try:
+        payload = json.loads(raw or b"{}")
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"invalid JSON: {exc}") from exc
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a JSON object")
+    request_args = argparse.Namespace(**vars(defaults))
+    for field, expected in CHAT_OVERRIDES.items():
+        value = payload.get(field)
+        if value is None:
+            continue
+        # bool — подкласс int, но "max_new_tokens": true почти наверняка ошибка клиента.
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise ValueError(f"{field} must be of type {expected.__name__}")
+        if expected is int and value < 1:
+            raise ValueError(f"{field} must be positive")
+        setattr(request_args, field, value)
+    if not (request_args.message or "").strip():
+        raise ValueError("message is required")
+    return request_args
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Keep the model resident and answer POST /chat with JSON {"message": ..., "system_prompt": ...}."""
+    # Загружаем заранее: первый запрос не должен платить за загрузку весов.
+    load_chat_model(args.model_id, args.adapter_dir)
+
+    class ChatHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:  # noqa: N802 - http.server naming
+            if self.path.rstrip("/") != "/chat":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request_args = parse_chat_request(self.rfile.read(length), args)
+            except ValueError as exc:
+                self._reply(400, {"error": str(exc)})
+                return
+            try:
+                answer = run_once(request_args)
+            except Exception as exc:  # pragma: no cover - OOM, ошибки генерации
+                traceback.print_exc(file=sys.stderr)
+                self._reply(500, {"error": f"{type(exc).__name__}: {exc}"})
+                return
+            self._reply(200, {"answer": answer})
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
-    output = model.generate(**inputs, max_new_tokens=args.max_new_tokens, do_sample=True)
-    gen = output[0][inputs["input_ids"].shape[-1]:]
-    text = tokenizer.decode(gen, skip_special_tokens=True).strip()
-    print(text)
+        def _reply(self, status: int, body: dict) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    # Однопоточный сервер: generate() на одной GPU всё равно выполняется последовательно.
+    server = HTTPServer((args.host, args.port), ChatHandler)
+    print(f"Serving on http://{args.host}:{args.port}/chat", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if not Path(args.adapter_dir).exists():
+        print(f"Adapter dir not found: {args.adapter_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.serve:
+        serve(args)
+        return
+    print(run_once(args))
 
 
 if __name__ == "__main__":